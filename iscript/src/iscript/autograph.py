@@ -3,19 +3,27 @@
 
 import asyncio
 import base64
+import contextlib
+import contextvars
 import difflib
 import glob
+import hashlib
+import hmac
 import json
 import logging
 import os
 import re
+import shutil
 import tempfile
+import time
+import urllib.parse
 import zipfile
 
-import requests
+import aiohttp
 from mozpack import mozjar
-from requests_hawk import HawkAuth
 from scriptworker_client.aio import raise_future_exceptions, retry_async
+from scriptworker_client.autograph import read_streamed_response
+from scriptworker_client.exceptions import AutographResponseError
 from scriptworker_client.utils import makedirs, rm
 
 from iscript.constants import LANGPACK_AUTOGRAPH_KEY_ID, OMNIJA_AUTOGRAPH_KEY_ID
@@ -63,6 +71,13 @@ _WIDEVINE_NONBLESSED_FILENAMES = (
 # Langpacks expect the following re to match for addon id
 LANGPACK_RE = re.compile(r"^langpack-[a-zA-Z]+(?:-[a-zA-Z]+){0,2}@(?:firefox|devedition).mozilla.org$")
 
+# The `AutographClient` for the running task, if any
+_client = contextvars.ContextVar("autograph_client", default=None)
+# Read files to sign in blocks of this many bytes; a multiple of 3, so each
+# block base64 encodes without padding
+_READ_BLOCK_SIZE = 3 * 256 * 1024
+_FILE_INPUT_RE = re.compile(r'"@@file(\d+)@@"')
+
 
 # sign_widevine_dir {{{1
 async def sign_widevine_dir(config, sign_config, app_dir, autograph_fmt):
@@ -197,35 +212,217 @@ def remove_extra_files(top_dir, file_list):
 
 
 # autograph {{{1
-async def call_autograph(url, user, password, request_json):
+class FileInput:
+    """A signing request input that is read from `path` while the request is sent.
+
+    Pass one to ``make_signing_req`` instead of the file contents, so the file
+    is never held in memory.
+    """
+
+    def __init__(self, path):
+        """Initialize FileInput."""
+        self.path = path
+
+
+class SigningRequestBody:
+    """The json body of an autograph request, base64 encoding any `FileInput` on the fly.
+
+    Args:
+        request_json (list): the signing request, from ``make_signing_req``
+
+    Attributes:
+        size (int): the length of the body, in bytes
+
+    """
+
+    def __init__(self, request_json):
+        """Initialize SigningRequestBody."""
+        inputs = []
+
+        def default(o):
+            if not isinstance(o, FileInput):
+                raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+            inputs.append(o)
+            return f"@@file{len(inputs) - 1}@@"
+
+        pieces = _FILE_INPUT_RE.split(json.dumps(request_json, default=default))
+        # Every other piece is the index of a file input
+        self.parts = [piece.encode("utf-8") if i % 2 == 0 else inputs[int(piece)] for i, piece in enumerate(pieces)]
+        self.size = sum(len(part) if isinstance(part, bytes) else 4 * -(-os.path.getsize(part.path) // 3) + 2 for part in self.parts)
+
+    def iter_blocks(self):
+        """Yield the body, a block at a time."""
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            yield b'"'
+            with open(part.path, "rb") as fh:
+                while block := fh.read(_READ_BLOCK_SIZE):
+                    yield base64.b64encode(block)
+            yield b'"'
+
+    def content_hash(self, content_type):
+        """Return the HAWK payload hash of the body, for `get_hawk_header`."""
+        h = hashlib.sha256()
+        h.update(f"hawk.1.payload\n{content_type}\n".encode("utf-8"))
+        for block in self.iter_blocks():
+            h.update(block)
+        h.update(b"\n")
+        return base64.b64encode(h.digest()).decode("ascii")
+
+    async def __aiter__(self):
+        """Yield the body to aiohttp, reading and encoding it in an executor."""
+        loop = asyncio.get_running_loop()
+        blocks = self.iter_blocks()
+        while (block := await loop.run_in_executor(None, next, blocks, None)) is not None:
+            yield block
+
+
+def get_hawk_header(url, user, password, content_type, content_hash):
+    """Create a HAWK Authorization header for a POST to `url`.
+
+    ``mohawk.Sender`` needs the whole payload in memory, and can't take a
+    hash of it instead, so the header is built as described in the HAWK spec
+    (https://github.com/mozilla/hawk/blob/main/API.md) from a payload hash
+    computed while streaming the body.
+
+    Args:
+        url (str): the url to POST to
+        user (str): the autograph user
+        password (str): the autograph password
+        content_type (str): the content type of the body
+        content_hash (str): the HAWK payload hash of the body, from
+            ``SigningRequestBody.content_hash``
+
+    Returns:
+        str: the header
+
+    """
+    parts = urllib.parse.urlsplit(url)
+    resource = f"{parts.path}?{parts.query}" if parts.query else parts.path
+    port = parts.port or {"http": 80, "https": 443}[parts.scheme]
+    ts = str(int(time.time()))
+    nonce = base64.urlsafe_b64encode(os.urandom(6)).decode("ascii")
+    normalized = f"hawk.1.header\n{ts}\n{nonce}\nPOST\n{resource}\n{parts.hostname}\n{port}\n{content_hash}\n\n"
+    mac = base64.b64encode(hmac.new(password.encode("utf-8"), normalized.encode("utf-8"), hashlib.sha256).digest()).decode("ascii")
+    return f'Hawk id="{user}", ts="{ts}", nonce="{nonce}", hash="{content_hash}", mac="{mac}"'
+
+
+async def _post_to_autograph(session, url, user, password, request_json, stream_keys=None, tmp_dir=None):
+    body = SigningRequestBody(request_json)
+    content_hash = await asyncio.get_running_loop().run_in_executor(None, body.content_hash, "application/json")
+    headers = {
+        "Authorization": get_hawk_header(url, user, password, "application/json", content_hash),
+        "Content-Type": "application/json",
+        "Content-Length": str(body.size),
+    }
+    async with session.post(url, data=body, headers=headers) as resp:
+        if not resp.ok:
+            log.error("Autograph response: %s, %s", resp.status, (await resp.text())[:1000])
+        resp.raise_for_status()
+        if not stream_keys:
+            text = await resp.text()
+            log.debug("Autograph response: %s", text[:120])
+            return json.loads(text)
+        try:
+            return await read_streamed_response(resp, stream_keys, tmp_dir)
+        except AutographResponseError as e:
+            raise IScriptError(str(e)) from e
+
+
+class AutographClient:
+    """A shared HTTP client for autograph requests.
+
+    All requests made while the client is open go through one
+    ``aiohttp.ClientSession``, so connections to autograph are kept alive
+    and reused, and at most `concurrency` of them are in flight at once.
+    Concurrent widevine and omni.ja signing of several apps then overlaps
+    its autograph traffic, without flooding the server.
+
+    Use it as an async context manager around the signing; `call_autograph`
+    picks it up from there.
+
+    Args:
+        concurrency (int, optional): the maximum number of concurrent
+            requests. If None or 0, don't limit them.
+
+    Attributes:
+        requests (int): the number of requests made
+
+    """
+
+    def __init__(self, concurrency=None):
+        """Initialize AutographClient."""
+        self.concurrency = concurrency
+        self.requests = 0
+        self._semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        self._session = None
+        self._token = None
+
+    async def __aenter__(self):
+        """Open the session, and make this the client for `call_autograph`."""
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency or 0))
+        self._token = _client.set(self)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """Close the session."""
+        _client.reset(self._token)
+        await self._session.close()
+
+    async def post(self, url, user, password, request_json, stream_keys=None, tmp_dir=None):
+        """POST `request_json` to `url`, and return the json response.
+
+        See `call_autograph` for the arguments.
+
+        Raises:
+            aiohttp.ClientError: on failure
+
+        """
+        async with self._semaphore or contextlib.nullcontext():
+            self.requests += 1
+            return await _post_to_autograph(self._session, url, user, password, request_json, stream_keys=stream_keys, tmp_dir=tmp_dir)
+
+
+async def call_autograph(url, user, password, request_json, stream_keys=None, tmp_dir=None):
     """Call autograph and return the json response.
 
+    The request goes through the open `AutographClient`, if there is one, and
+    through a one-off session otherwise. Any `FileInput` in the request is
+    streamed from disk.
+
     Args:
         url (str): the endpoint url
         user (str): the autograph user
         password (str): the autograph password
         request_json (dict): list of dictionaries, from ``make_signing_req``
+        stream_keys (set, optional): the keys of the response whose values
+            are base64 decoded into files in `tmp_dir` as they arrive, and
+            replaced with the paths of those files.
+        tmp_dir (str, optional): the directory for the `stream_keys` files
 
     Raises:
-        requests.RequestException: on failure
+        aiohttp.ClientError: on failure
+        IScriptError: if a streamed response is invalid
 
     Returns:
         dict: the response json
 
     """
-    auth = HawkAuth(id=user, key=password)
-    with requests.Session() as session:
-        r = session.post(url, json=request_json, auth=auth)
-        log.debug("Autograph response: %s", r.text[:120] if len(r.text) >= 120 else r.text)
-        r.raise_for_status()
-        return r.json()
+    client = _client.get()
+    if client is not None:
+        return await client.post(url, user, password, request_json, stream_keys=stream_keys, tmp_dir=tmp_dir)
+    async with aiohttp.ClientSession() as session:
+        return await _post_to_autograph(session, url, user, password, request_json, stream_keys=stream_keys, tmp_dir=tmp_dir)
 
 
 def make_signing_req(input_bytes, fmt, keyid=None, extension_id=None):
     """Make a signing request object to pass to autograph.
 
     Args:
-        input_bytes (bytestring): the hash or filedata to sign
+        input_bytes (bytestring or FileInput): the hash or filedata to sign,
+            or the file to stream it from
         fmt (string): the format to sign with
         keyid (string, optional): the keyid to use to sign with. If ``None``,
             we use the default keyid configured in autograph. Defaults to ``None``.
@@ -234,8 +431,10 @@ def make_signing_req(input_bytes, fmt, keyid=None, extension_id=None):
         list: the signing request json
 
     """
-    base64_input = base64.b64encode(input_bytes).decode("ascii")
-    sign_req = {"input": base64_input}
+    if isinstance(input_bytes, FileInput):
+        sign_req = {"input": input_bytes}
+    else:
+        sign_req = {"input": base64.b64encode(input_bytes).decode("ascii")}
 
     if keyid:
         sign_req["keyid"] = keyid
@@ -251,6 +450,12 @@ def make_signing_req(input_bytes, fmt, keyid=None, extension_id=None):
     return [sign_req]
 
 
+def _get_autograph_credentials(sign_config, fmt):
+    """Return the autograph url, user and password for `fmt`."""
+    short_fmt = fmt.replace("autograph_", "")
+    return sign_config[f"{short_fmt}_url"], sign_config[f"{short_fmt}_user"], sign_config[f"{short_fmt}_pass"]
+
+
 async def sign_with_autograph(sign_config, input_bytes, fmt, autograph_method, keyid=None, extension_id=None):
     """Signs data with autograph and returns the result.
 
@@ -264,7 +469,7 @@ async def sign_with_autograph(sign_config, input_bytes, fmt, autograph_method, k
         extension_id (str): which id to send to autograph for the extension (optional)
 
     Raises:
-        Requests.RequestException: on failure
+        aiohttp.ClientError: on failure
 
     Returns:
         bytes: the signed data
@@ -274,10 +479,7 @@ async def sign_with_autograph(sign_config, input_bytes, fmt, autograph_method, k
         raise IScriptError(f"Unsupported autograph method: {autograph_method}")
 
     sign_req = make_signing_req(input_bytes, fmt, keyid=keyid, extension_id=extension_id)
-    short_fmt = fmt.replace("autograph_", "")
-    url = sign_config[f"{short_fmt}_url"]
-    user = sign_config[f"{short_fmt}_user"]
-    pw = sign_config[f"{short_fmt}_pass"]
+    url, user, pw = _get_autograph_credentials(sign_config, fmt)
 
     log.debug("signing data with format %s with %s", fmt, autograph_method)
 
@@ -294,6 +496,9 @@ async def sign_with_autograph(sign_config, input_bytes, fmt, autograph_method, k
 async def sign_file_with_autograph(sign_config, from_, fmt, to=None, keyid=None, extension_id=None):
     """Signs file with autograph and writes the results to a file.
 
+    The file is streamed to autograph from disk, and the signed file is
+    decoded to disk as it arrives, so neither is held in memory.
+
     Args:
         sign_config (dict): the running config for this key
         from_ (str): the source file to sign
@@ -303,26 +508,32 @@ async def sign_file_with_autograph(sign_config, from_, fmt, to=None, keyid=None,
         extension_id (str, optional): the extension id to use when signing.
 
     Raises:
-        Requests.RequestException: on failure
+        aiohttp.ClientError: on failure
 
     Returns:
         str: the path to the signed file
 
     """
     to = to or from_
-    input_bytes = open(from_, "rb").read()
-    signed_bytes = base64.b64decode(
-        await sign_with_autograph(
-            sign_config,
-            input_bytes,
-            fmt,
-            "file",
-            keyid=keyid,
-            extension_id=extension_id,
-        )
+    sign_req = make_signing_req(FileInput(from_), fmt, keyid=keyid, extension_id=extension_id)
+    url, user, pw = _get_autograph_credentials(sign_config, fmt)
+    log.debug("signing file %s with format %s", from_, fmt)
+    sign_resp = await retry_async(
+        call_autograph,
+        args=(f"{url}/sign/file", user, pw, sign_req),
+        kwargs={"stream_keys": {"signed_file"}, "tmp_dir": os.path.dirname(os.path.abspath(to))},
+        attempts=3,
+        sleeptime_kwargs={"delay_factor": 2.0},
     )
-    with open(to, "wb") as fout:
-        fout.write(signed_bytes)
+    signed_path = sign_resp[0]["signed_file"]
+    try:
+        # The decoded file is next to `to`, so it can be moved into place;
+        # keep the mode of the file it replaces
+        shutil.copymode(to if os.path.exists(to) else from_, signed_path)
+        os.replace(signed_path, to)
+    except BaseException:
+        rm(signed_path)
+        raise
     return to
 
 
@@ -336,7 +547,7 @@ async def sign_hash_with_autograph(sign_config, hash_, fmt, keyid=None):
         keyid (str): which key to use on autograph (optional)
 
     Raises:
-        Requests.RequestException: on failure
+        aiohttp.ClientError: on failure
 
     Returns:
         bytes: the signature
@@ -374,7 +585,7 @@ async def sign_omnija_with_autograph(config, sign_config, app_path, fmt):
         app_path (str): the path to the .app dir
 
     Raises:
-        Requests.RequestException: on failure
+        aiohttp.ClientError: on failure
 
     Returns:
         str: the path to the signature file
@@ -399,9 +610,7 @@ async def sign_omnija_with_autograph(config, sign_config, app_path, fmt):
             extension_id="omni.ja@mozilla.org",
         )
         await merge_omnija_files(orig=from_, signed=signed_out, to=merged_out)
-        with open(from_, "wb") as fout:
-            with open(merged_out, "rb") as fin:
-                fout.write(fin.read())
+        shutil.copyfile(merged_out, from_)
     return files_to_sign
 
 
@@ -451,7 +660,7 @@ async def sign_widevine_with_autograph(sign_config, from_, fmt, blessed, to=None
             `{from_}.sig`. Defaults to None.
 
     Raises:
-        Requests.RequestException: on failure
+        aiohttp.ClientError: on failure
 
     Returns:
         str: the path to the signature file
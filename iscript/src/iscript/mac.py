@@ -229,58 +229,73 @@ async def sign_single_files(config, sign_config, all_paths):
             )
 
 
-async def _do_sign_file(top_dir, abs_file, file_, sign_command, app_path_len, app_executable):
-    # Deal with inner .app's in sign_app, not here.
-    if top_dir[app_path_len:].count(".app") > 0:
-        log.debug("Skipping %s because it's part of an inner app.", abs_file)
-        return
-    # app_executable gets signed with the outer package.
-    if file_ == app_executable:
-        log.debug("Skipping %s because it's the main executable.", abs_file)
-        return
-    dir_ = os.path.dirname(abs_file)
-    await retry_async(
-        run_command,
-        args=[sign_command + [file_]],
-        kwargs={"cwd": dir_, "exception": IScriptError, "output_log_on_exception": True},
-        retry_exceptions=(IScriptError,),
-    )
+# codesign scheduling {{{1
+@attr.s
+class CodesignNode(object):
+    """A file or bundle to codesign, after everything inside it.
 
+    Attributes:
+        cwd (str): the directory to run codesign in.
+        name (str): the file or bundle to sign, relative to ``cwd``.
+        sign_command (list): the codesign command, without the path to sign.
+        deps (list): the nodes that have to be signed first.
 
-# sign_app {{{1
-async def sign_app(sign_config, app_path, entitlements_path, provisioning_profile_path=None):
-    """Sign the .app.
+    """
+
+    cwd = attr.ib()
+    name = attr.ib()
+    sign_command = attr.ib()
+    deps = attr.ib(factory=list)
+
+    @property
+    def path(self):
+        """str: the absolute path to sign."""
+        return os.path.join(self.cwd, self.name)
+
+
+def _add_bundle_node(nodes, node):
+    """Add the bundle ``node`` to ``nodes``, depending on every node inside it."""
+    prefix = node.path + os.sep
+    node.deps = [n for n in nodes if n.path.startswith(prefix)]
+    nodes.append(node)
 
-    Largely taken from build-tools' ``dmg_signfile``.
+
+def get_codesign_nodes(sign_config, app_path, entitlements_path, top_level=True):
+    """Build the signing graph of an app bundle.
+
+    codesign has to go inside-out: the files in a bundle are signed before
+    the bundle that seals them. Frameworks and nested ``.app`` / ``.appex``
+    bundles depend on everything inside them, and the app bundle itself on
+    everything else.
+
+    Only the ``sign_dirs`` directly under ``Contents/`` are searched, and any
+    directory in ``skip_dirs`` is skipped. Files directly in ``Contents/`` and
+    the bundle executable are sealed with the bundle rather than signed on
+    their own. Symlinks aren't signed either: in versioned frameworks,
+    ``Foo.framework/Foo`` links to ``Versions/Current/Foo``, which is already
+    signed under its own path, and signing both at once would have two
+    codesign processes rewriting the same file.
 
     Args:
         sign_config (dict): the running config
-        app_path (str): the path to the app to be signed (extracted)
+        app_path (str): the path to the .app or .appex directory
         entitlements_path (str): the path to the entitlements file for signing
-        provisioning_profile_path (str): the path to a provisioning profile to insert
-                                         into the build prior to signing
+        top_level (bool, optional): whether this is the outermost bundle.
+            Defaults to True.
 
-    Raises:
-        IScriptError: on error.
+    Returns:
+        list: the ``CodesignNode`` objects, with the app bundle last.
 
     """
-    parent_dir = os.path.dirname(app_path)
-    app_name = os.path.basename(app_path)
-    await run_command(["xattr", "-cr", app_name], cwd=parent_dir, exception=IScriptError)
     identity = sign_config["identity"]
     keychain = sign_config["signing_keychain"]
-    log.debug(f"sign_app: signing {app_name}")
-
     app_executable = get_bundle_executable(app_path)
-    app_path_len = len(app_path)
     contents_dir = os.path.join(app_path, "Contents")
-
-    if provisioning_profile_path:
-        log.debug("inserting provisioning profile into app")
-        copy2(provisioning_profile_path, os.path.join(contents_dir, "embedded.provisionprofile"))
+    nodes = []
+    frameworks = []
 
     for top_dir, dirs, files in os.walk(contents_dir):
-        for dir_ in dirs:
+        for dir_ in list(dirs):
             abs_dir = os.path.join(top_dir, dir_)
             if top_dir == contents_dir and dir_ not in sign_config["sign_dirs"]:
                 log.debug(f"Skipping {abs_dir} because it's not in `sign_dirs`.")
@@ -291,61 +306,141 @@ async def sign_app(sign_config, app_path, entitlements_path, provisioning_profil
                 dirs.remove(dir_)
                 continue
             if dir_.endswith((".app", ".appex")):
-                await sign_app(sign_config, abs_dir, entitlements_path)
+                nodes.extend(get_codesign_nodes(sign_config, abs_dir, entitlements_path, top_level=False))
+                dirs.remove(dir_)
+                continue
             if dir_.endswith(".framework"):
-                # Sign the entire .framework folder
+                # Sign the entire .framework folder once its contents are signed
                 #  codesign cannot determine if it's a Framework or an app bundle if signing the binary directly
                 sign_command = _get_sign_command(identity, keychain, sign_config, file_=dir_, entitlements_path=entitlements_path)
-                abs_file = os.path.join(top_dir, dir_)
-                await _do_sign_file(top_dir, abs_file, dir_, sign_command, app_path_len, app_executable)
-                continue
+                frameworks.append(CodesignNode(top_dir, dir_, sign_command))
         if top_dir == contents_dir:
             log.debug("Skipping file iteration in %s because it's the root directory.", top_dir)
             continue
 
         for file_ in files:
             abs_file = os.path.join(top_dir, file_)
+            # app_executable gets signed with the outer package.
+            if file_ == app_executable:
+                log.debug("Skipping %s because it's the main executable.", abs_file)
+                continue
+            if os.path.islink(abs_file):
+                log.debug("Skipping %s because it's a symlink.", abs_file)
+                continue
             sign_command = _get_sign_command(identity, keychain, sign_config, file_=file_, entitlements_path=entitlements_path)
-            await _do_sign_file(top_dir, abs_file, file_, sign_command, app_path_len, app_executable)
-
-    await sign_libclearkey(contents_dir, _get_sign_command(identity, keychain, sign_config, entitlements_path=entitlements_path), app_path)
+            nodes.append(CodesignNode(top_dir, file_, sign_command))
+
+    # Inner frameworks first, so each framework depends on those inside it
+    for framework in sorted(frameworks, key=lambda n: n.path.count(os.sep), reverse=True):
+        _add_bundle_node(nodes, framework)
+
+    if top_level:
+        # Special case Contents/Resources/gmp-clearkey/0.1/libclearkey.dylib
+        # which is living in the wrong place (bug 1100450), but isn't trivial to move.
+        # Only do this for the top level app and not nested apps
+        clearkey = CodesignNode(
+            os.path.join(contents_dir, "Resources/gmp-clearkey/0.1"),
+            "libclearkey.dylib",
+            _get_sign_command(identity, keychain, sign_config, entitlements_path=entitlements_path),
+        )
+        if os.path.exists(clearkey.path) and not any(n.path == clearkey.path for n in nodes):
+            nodes.append(clearkey)
 
-    # sign bundle
     sign_command = _get_sign_command(identity, keychain, sign_config, entitlements_path=entitlements_path)
+    _add_bundle_node(nodes, CodesignNode(os.path.dirname(app_path), os.path.basename(app_path), sign_command))
+    return nodes
+
+
+def get_codesign_layers(nodes):
+    """Group the signing graph into layers that can each be signed concurrently.
+
+    Every node is in a later layer than all of its ``deps``, so leaf files
+    come first, then the frameworks and nested bundles that contain them,
+    and the app bundle last.
+
+    Args:
+        nodes (list): the ``CodesignNode`` objects
+
+    Returns:
+        list: a list of lists of ``CodesignNode`` objects
+
+    """
+    depths = {}
+
+    def get_depth(node):
+        if id(node) not in depths:
+            depths[id(node)] = 1 + max((get_depth(dep) for dep in node.deps), default=-1)
+        return depths[id(node)]
+
+    layers = []
+    for node in nodes:
+        depth = get_depth(node)
+        while len(layers) <= depth:
+            layers.append([])
+        layers[depth].append(node)
+    return layers
+
+
+async def _codesign(node):
+    log.debug("Signing %s", node.path)
     await retry_async(
         run_command,
-        args=[sign_command + [app_name]],
-        kwargs={"cwd": parent_dir, "exception": IScriptError, "output_log_on_exception": True},
+        args=[node.sign_command + [node.name]],
+        kwargs={"cwd": node.cwd, "exception": IScriptError, "output_log_on_exception": True},
         retry_exceptions=(IScriptError,),
     )
 
 
-async def sign_libclearkey(contents_dir, sign_command, app_path):
-    """Sign libclearkey if it exists.
-
-    Special case Contents/Resources/gmp-clearkey/0.1/libclearkey.dylib
-    which is living in the wrong place (bug 1100450), but isn't trivial to move.
-    Only do this for the top level app and not nested apps
+async def run_codesign_layers(layers, concurrency):
+    """Sign each layer of the signing graph in turn, up to ``concurrency`` nodes at a time.
 
     Args:
-        contents_dir (str): the ``Contents/`` directory path
-        sign_command (list): the command to sign with
-        app_path (str): the path to the .app dir
+        layers (list): the layers, from ``get_codesign_layers``
+        concurrency (int): the maximum number of concurrent codesign processes
 
     Raises:
         IScriptError: on failure
 
     """
-    if "Contents/" not in app_path:
-        dir_ = os.path.join(contents_dir, "Resources/gmp-clearkey/0.1/")
-        file_ = "libclearkey.dylib"
-        if os.path.exists(os.path.join(dir_, file_)):
-            await retry_async(
-                run_command,
-                args=[sign_command + [file_]],
-                kwargs={"cwd": dir_, "exception": IScriptError, "output_log_on_exception": True},
-                retry_exceptions=(IScriptError,),
-            )
+    semaphore = asyncio.Semaphore(concurrency)
+    for i, layer in enumerate(layers):
+        log.debug("Signing layer %d of %d: %d paths", i + 1, len(layers), len(layer))
+        await raise_future_exceptions([asyncio.ensure_future(semaphore_wrapper(semaphore, _codesign(node))) for node in layer])
+
+
+# sign_app {{{1
+async def sign_app(sign_config, app_path, entitlements_path, provisioning_profile_path=None):
+    """Sign the .app.
+
+    Largely taken from build-tools' ``dmg_signfile``. The signing graph of
+    the app is built up front with ``get_codesign_nodes``, and signed
+    inside-out, one layer at a time; the files within a layer are signed
+    concurrently, up to ``codesign_concurrency`` at once. Every app in a task
+    is signed at the same time, so that many codesign processes can run per
+    app. Defaults to 4; workers with more cores can raise it in their config.
+
+    Args:
+        sign_config (dict): the running config
+        app_path (str): the path to the app to be signed (extracted)
+        entitlements_path (str): the path to the entitlements file for signing
+        provisioning_profile_path (str): the path to a provisioning profile to insert
+                                         into the build prior to signing
+
+    Raises:
+        IScriptError: on error.
+
+    """
+    parent_dir = os.path.dirname(app_path)
+    app_name = os.path.basename(app_path)
+    await run_command(["xattr", "-cr", app_name], cwd=parent_dir, exception=IScriptError)
+    log.debug(f"sign_app: signing {app_name}")
+
+    if provisioning_profile_path:
+        log.debug("inserting provisioning profile into app")
+        copy2(provisioning_profile_path, os.path.join(app_path, "Contents", "embedded.provisionprofile"))
+
+    layers = get_codesign_layers(get_codesign_nodes(sign_config, app_path, entitlements_path))
+    await run_codesign_layers(layers, sign_config.get("codesign_concurrency", 4))
 
 
 # verify_app_signature {{{1
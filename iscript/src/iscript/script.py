@@ -7,6 +7,7 @@ import os
 from scriptworker_client.client import sync_main
 from scriptworker_client.utils import run_command
 
+from iscript.autograph import AutographClient
 from iscript.exceptions import IScriptError
 from iscript.hardened_sign import sign_hardened_behavior
 from iscript.mac import (
@@ -81,7 +82,9 @@ async def async_main(config, task):
     # Raises if behavior not supported
     behavior = check_behavior(task, behavior, sign_config["supported_behaviors"])
     func, args = get_behavior_function(behavior)
-    await func(config, task, **args)
+    async with AutographClient(concurrency=config.get("autograph_concurrency")) as client:
+        await func(config, task, **args)
+    log.info("Made %d autograph requests", client.requests)
 
 
 def get_default_config(base_dir=None):
@@ -100,6 +103,7 @@ def get_default_config(base_dir=None):
         "work_dir": os.path.join(base_dir, "work"),
         "artifact_dir": os.path.join(base_dir, "artifacts"),
         "schema_file": os.path.join(os.path.dirname(__file__), "data", "i_task_schema.json"),
+        "autograph_concurrency": 10,
     }
     return default_config
 
@@ -1,11 +1,18 @@
+import asyncio
 import base64
+import json
 import os
 import os.path
+import pathlib
 import shutil
-from contextlib import contextmanager
+import tempfile
+from contextlib import asynccontextmanager, contextmanager
 from hashlib import file_digest
 
+import aiohttp
+import mohawk
 import pytest
+from aiohttp import web
 from scriptworker_client.utils import makedirs
 
 import iscript.autograph as autograph
@@ -60,64 +67,179 @@ def sign_config():
 async def noop_async(*args, **kwargs): ...
 
 
+def fake_streamed_response(data, tmp_dir):
+    """Write `data` to a file in `tmp_dir`, like `call_autograph` does for a streamed `signed_file`."""
+    fd, path = tempfile.mkstemp(dir=tmp_dir)
+    with os.fdopen(fd, "wb") as fh:
+        fh.write(data)
+    return [{"signed_file": path}]
+
+
 def noop_sync(*args, **kwargs): ...
 
 
 # sign_file_with_autograph {{{1
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
-    "to,expected,format,url",
+    "to,format,prefix",
     (
-        (None, "from", "autograph_widevine", "https://autograph-hsm.dev.mozaws.net"),
-        ("to", "to", "autograph_widevine", "https://autograph-hsm.dev.mozaws.net"),
-        ("to", "to", "stage_autograph_widevine", "https://autograph-stage.dev.mozaws.net"),
-        ("to", "to", "gcp_prod_autograph_widevine", "https://autograph-gcp.dev.mozaws.net"),
+        (None, "autograph_widevine", ""),
+        ("to", "autograph_widevine", ""),
+        ("to", "stage_autograph_widevine", "stage_"),
+        ("to", "gcp_prod_autograph_widevine", "gcp_prod_"),
     ),
 )
-async def test_sign_file_with_autograph(sign_config, mocker, to, expected, format, url):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+async def test_sign_file_with_autograph(sign_config, tmp_path, to, format, prefix):
+    from_ = tmp_path / "from"
+    data = os.urandom(autograph._READ_BLOCK_SIZE * 2 + 7)
+    from_.write_bytes(data)
+    from_.chmod(0o755)
+    to = to and str(tmp_path / to)
+    stats = {}
+    async with fake_autograph(stats=stats) as url:
+        sign_config[f"{prefix}widevine_url"] = url
+        assert await autograph.sign_file_with_autograph(sign_config, str(from_), format, to=to) == (to or str(from_))
+    assert stats["requests"] == [[{"input": base64.b64encode(data).decode("ascii")}]]
+    assert stats["paths"] == ["/sign/file"]
+    # The fake autograph echoes the input back
+    assert pathlib.Path(to or from_).read_bytes() == data
+    # The decoded response is cleaned up
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted({"from", os.path.basename(to or "from")})
+    # The signed file keeps the mode of the file it was signed from
+    assert os.stat(to or from_).st_mode & 0o777 == 0o755
 
-    session_mock = mocker.MagicMock()
-    session_mock.post.return_value.json.return_value = [{"signed_file": "bW96aWxsYQ=="}]
 
-    Session_mock = mocker.Mock()
-    Session_mock.return_value.__enter__ = mocker.Mock(return_value=session_mock)
-    Session_mock.return_value.__exit__ = mocker.Mock()
-    mocker.patch("iscript.autograph.requests.Session", Session_mock, create=True)
+@pytest.mark.asyncio
+@pytest.mark.parametrize("to", (None, "to"))
+async def test_sign_file_with_autograph_raises_http_error(sign_config, mocker, tmp_path, to):
+    from_ = tmp_path / "from"
+    from_.write_bytes(b"0xdeadbeef")
 
-    assert await autograph.sign_file_with_autograph(sign_config, "from", format, to=to) == expected
-    open_mock.assert_called()
-    kwargs = {"input": "MHhkZWFkYmVlZg=="}
-    expected_url = f"{url}/sign/file"
-    session_mock.post.assert_called_with(expected_url, auth=mocker.ANY, json=[kwargs])
+    async def fake_retry_async(func, args=(), kwargs=None, attempts=5, sleeptime_kwargs=None):
+        await func(*args, **(kwargs or {}))
 
+    mocker.patch.object(autograph, "retry_async", new=fake_retry_async)
 
-@pytest.mark.asyncio
-@pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_file_with_autograph_raises_http_error(sign_config, mocker, to, expected):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+    async with fake_autograph(status=500) as url:
+        sign_config["widevine_url"] = url
+        with pytest.raises(aiohttp.ClientResponseError):
+            await autograph.sign_file_with_autograph(sign_config, str(from_), "autograph_widevine", to=to and str(tmp_path / to))
+    assert from_.read_bytes() == b"0xdeadbeef"
+    assert [p.name for p in tmp_path.iterdir()] == ["from"]
+
+
+# get_hawk_header {{{1
+@pytest.mark.parametrize("url", ("https://autograph.example.com/sign/file", "http://localhost:8000/sign/file?x=1"))
+@pytest.mark.parametrize("streamed", (False, True))
+def test_get_hawk_header(tmp_path, streamed, url):
+    input_path = tmp_path / "input"
+    input_path.write_bytes(os.urandom(100000))
+    if streamed:
+        request_json = autograph.make_signing_req(autograph.FileInput(str(input_path)), "autograph_widevine", "file")
+    else:
+        request_json = [{"input": base64.b64encode(input_path.read_bytes()).decode("ascii")}]
+    body = autograph.SigningRequestBody(request_json)
+    header = autograph.get_hawk_header(url, "user", "password", "application/json", body.content_hash("application/json"))
+    # The header would be accepted by the server for this exact payload
+    mohawk.Receiver(
+        lambda id_: {"id": id_, "key": "password", "algorithm": "sha256"},
+        header,
+        url,
+        "POST",
+        content=b"".join(body.iter_blocks()),
+        content_type="application/json",
+        seen_nonce=lambda *args: False,
+    )
+    with pytest.raises(mohawk.exc.MisComputedContentHash):
+        mohawk.Receiver(
+            lambda id_: {"id": id_, "key": "password", "algorithm": "sha256"},
+            header,
+            url,
+            "POST",
+            content=b"".join(body.iter_blocks()) + b" ",
+            content_type="application/json",
+        )
+
+
+# call_autograph {{{1
+@asynccontextmanager
+async def fake_autograph(status=200, delay=0, stats=None, response_body=None):
+    """Serve a fake autograph that checks HAWK auth, and counts concurrent requests and connections."""
+    stats = {} if stats is None else stats
+    stats.update({"requests": [], "paths": [], "in_flight": 0, "max_in_flight": 0, "connections": set()})
+
+    async def handle(request):
+        body = await request.read()
+        mohawk.Receiver(
+            lambda id_: {"id": id_, "key": "widevine_pass", "algorithm": "sha256"},
+            request.headers["Authorization"],
+            str(request.url),
+            request.method,
+            content=body,
+            content_type=request.headers["Content-Type"],
+            seen_nonce=lambda *args: False,
+        )
+        sign_req = json.loads(body)
+        stats["requests"].append(sign_req)
+        stats["paths"].append(request.path)
+        stats["connections"].add(request.transport.get_extra_info("peername"))
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        await asyncio.sleep(delay)
+        stats["in_flight"] -= 1
+        if response_body is not None:
+            return web.Response(body=response_body, status=status, content_type="application/json")
+        if request.path == "/sign/file":
+            return web.json_response([{"signed_file": sign_req[0]["input"]}], status=status)
+        return web.json_response([{"signature": "c2lnbmF0dXJl"}], status=status)
+
+    app = web.Application(client_max_size=1 << 30)
+    app.router.add_post("/sign/hash", handle)
+    app.router.add_post("/sign/file", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        yield f"http://127.0.0.1:{runner.addresses[0][1]}"
+    finally:
+        await runner.cleanup()
 
-    session_mock = mocker.MagicMock()
-    post_mock_response = session_mock.post.return_value
-    post_mock_response.raise_for_status.side_effect = autograph.requests.exceptions.RequestException
-    post_mock_response.json.return_value = [{"signed_file": "bW96aWxsYQ=="}]
 
-    @contextmanager
-    def session_context():
-        yield session_mock
+@pytest.mark.asyncio
+async def test_call_autograph_no_client():
+    async with fake_autograph() as url:
+        assert await autograph.call_autograph(f"{url}/sign/hash", "widevine_user", "widevine_pass", [{"input": "aGFzaA=="}]) == [{"signature": "c2lnbmF0dXJl"}]
 
-    mocker.patch("iscript.autograph.requests.Session", session_context)
 
-    async def fake_retry_async(func, args=(), attempts=5, sleeptime_kwargs=None):
-        await func(*args)
+@pytest.mark.asyncio
+@pytest.mark.parametrize("body,match", ((b'[{"signed_file": "YWJj', "Truncated"), (b'[{"signed_file": "YWJ"}]', "Invalid base64")))
+async def test_call_autograph_stream_errors(tmp_path, body, match):
+    async with fake_autograph(response_body=body) as url:
+        with pytest.raises(IScriptError, match=match):
+            await autograph.call_autograph(
+                f"{url}/sign/file", "widevine_user", "widevine_pass", [{"input": "YWJj"}], stream_keys={"signed_file"}, tmp_dir=str(tmp_path)
+            )
+    assert list(tmp_path.iterdir()) == []
 
-    mocker.patch.object(autograph, "retry_async", new=fake_retry_async)
 
-    with pytest.raises(autograph.requests.exceptions.RequestException):
-        await autograph.sign_file_with_autograph(sign_config, "from", "autograph_widevine", to=to)
-    open_mock.assert_called()
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency,expected_max_in_flight", ((2, 2), (None, 6)))
+async def test_autograph_client(sign_config, concurrency, expected_max_in_flight):
+    stats = {}
+    async with fake_autograph(delay=0.05, stats=stats) as url:
+        sign_config["widevine_url"] = url
+        async with autograph.AutographClient(concurrency=concurrency) as client:
+            signatures = await asyncio.gather(*(autograph.sign_hash_with_autograph(sign_config, b"hash%d" % i, "autograph_widevine") for i in range(6)))
+            # Connections are kept alive and reused
+            await autograph.sign_hash_with_autograph(sign_config, b"hash", "autograph_widevine")
+    assert signatures == [b"signature"] * 6
+    assert client.requests == 7
+    assert len(stats["requests"]) == 7
+    assert stats["max_in_flight"] == expected_max_in_flight
+    assert len(stats["connections"]) == expected_max_in_flight
+    # The client is only used within its context
+    assert autograph._client.get() is None
 
 
 # sign_widevine_dir {{{1
@@ -305,9 +427,10 @@ async def test_omnija_autograph(mocker, tmp_path, sign_config, fmt, expected_url
     merge = mocker.patch("iscript.autograph.merge_omnija_files")
     merge.side_effect = lambda orig, signed, to: shutil.copy(signed, to)
 
-    async def fake_call(url, *args, **kwargs):
+    async def fake_call(url, *args, stream_keys=None, tmp_dir=None):
         assert expected_url in url
-        return [{"signed_file": base64.b64encode(b"sigomnijasig")}]
+        assert stream_keys == {"signed_file"}
+        return fake_streamed_response(b"sigomnijasig", tmp_dir)
 
     mocker.patch.object(autograph, "call_autograph", fake_call)
 
@@ -334,9 +457,9 @@ async def test_langpack_autograph(mocker, tmp_path, sign_config, fmt, expected_u
     lid = mocker.patch("iscript.autograph.langpack_id")
     lid.return_value = "test-xpi"
 
-    async def fake_call(url, *args, **kwargs):
+    async def fake_call(url, *args, stream_keys=None, tmp_dir=None):
         assert expected_url in url
-        return [{"signed_file": base64.b64encode(b"siglangpacksig")}]
+        return fake_streamed_response(b"siglangpacksig", tmp_dir)
 
     mocker.patch.object(autograph, "call_autograph", fake_call)
 
@@ -504,7 +627,7 @@ async def test_langpack_sign(sign_config, mocker, tmp_path):
     langpack_app = App(orig_path=filename, formats=["autograph_langpack"], artifact_prefix=TEST_DATA_DIR)
     config = {"artifact_dir": tmp_path / "artifacts"}
 
-    async def mocked_call_autograph(url, user, password, request_json):
+    async def mocked_call_autograph(url, user, password, request_json, stream_keys=None, tmp_dir=None):
         mock_ever_called[0] = True
         # url/user/pass comes from test sign_config
         assert url.startswith("https://autograph-hsm.dev.mozaws.net/langpack")
@@ -512,7 +635,8 @@ async def test_langpack_sign(sign_config, mocker, tmp_path):
         assert password == "langpack_pass"
         assert len(request_json) == 1
         assert request_json[0]["options"]["id"] == "langpack-en-CA@firefox.mozilla.org"
-        return [{"signed_file": base64.b64encode(open(filename, "rb").read())}]
+        assert request_json[0]["input"].path == filename
+        return fake_streamed_response(open(filename, "rb").read(), tmp_dir)
 
     mock_obj = mocker.patch.object(autograph, "call_autograph", new=mocked_call_autograph)
 
@@ -188,6 +188,154 @@ async def test_sign_app(mocker, tmpdir, sign_with_entitlements, has_clearkey, sk
     await mac.sign_app(sign_config, app_path, entitlements_path, "test")
 
 
+def _make_nested_app(tmpdir):
+    """Create an app with frameworks and nested apps, and return its path."""
+    app_path = os.path.join(tmpdir, "foo.app")
+    contents_dir = os.path.join(app_path, "Contents")
+    inner_app = os.path.join(contents_dir, "MacOS", "inner.app")
+    for path in (
+        "Info.plist",
+        "MacOS/main",
+        "MacOS/lib1.dylib",
+        "MacOS/lib2.dylib",
+        "MacOS/skipme/lib.dylib",
+        "Frameworks/Outer.framework/Versions/A/Outer",
+        "Frameworks/Outer.framework/Versions/A/Frameworks/Inner.framework/Versions/A/Inner",
+        "Frameworks/Outer.framework/Versions/A/Helper.app/Contents/MacOS/helper",
+        "Resources/not_in_sign_dirs.dylib",
+        "Resources/gmp-clearkey/0.1/libclearkey.dylib",
+    ):
+        touch(os.path.join(contents_dir, path))
+    for path in ("MacOS/inner", "MacOS/inner.dylib", "Library/skipme/lib.dylib"):
+        touch(os.path.join(inner_app, "Contents", path))
+    # Versioned framework layout
+    outer_framework = os.path.join(contents_dir, "Frameworks/Outer.framework")
+    os.symlink("A", os.path.join(outer_framework, "Versions/Current"))
+    os.symlink("Versions/Current/Outer", os.path.join(outer_framework, "Outer"))
+    return app_path
+
+
+# get_codesign_nodes {{{1
+def test_get_codesign_layers(mocker, tmpdir):
+    sign_config = {
+        "identity": "id",
+        "signing_keychain": "keychain",
+        "designated_requirements": "",
+        "sign_dirs": ("MacOS", "Frameworks", "Library"),
+        "skip_dirs": ("skipme",),
+        "hardened_runtime_only_files": ["lib1.dylib"],
+    }
+    app_path = _make_nested_app(tmpdir)
+    executables = {"foo.app": "main", "inner.app": "inner", "Helper.app": "Helper"}
+    mocker.patch.object(mac, "get_bundle_executable", side_effect=lambda path: executables[os.path.basename(path)])
+    nodes = mac.get_codesign_nodes(sign_config, app_path, "entitlements")
+    assert nodes[-1].path == app_path
+    assert nodes[-1].deps == nodes[:-1]
+    layers = [sorted(os.path.relpath(n.path, app_path) for n in layer) for layer in mac.get_codesign_layers(nodes)]
+    assert layers == [
+        [
+            "Contents/Frameworks/Outer.framework/Versions/A/Frameworks/Inner.framework/Versions/A/Inner",
+            "Contents/Frameworks/Outer.framework/Versions/A/Helper.app/Contents/MacOS/helper",
+            "Contents/Frameworks/Outer.framework/Versions/A/Outer",
+            "Contents/MacOS/inner.app/Contents/MacOS/inner.dylib",
+            "Contents/MacOS/lib1.dylib",
+            "Contents/MacOS/lib2.dylib",
+            "Contents/Resources/gmp-clearkey/0.1/libclearkey.dylib",
+        ],
+        [
+            "Contents/Frameworks/Outer.framework/Versions/A/Frameworks/Inner.framework",
+            "Contents/Frameworks/Outer.framework/Versions/A/Helper.app",
+            "Contents/MacOS/inner.app",
+        ],
+        ["Contents/Frameworks/Outer.framework"],
+        ["."],
+    ]
+    # The framework binary symlink isn't signed as well as its target
+    assert len({os.path.realpath(n.path) for n in nodes}) == len(nodes)
+    by_path = {os.path.relpath(n.path, app_path): n for n in nodes}
+    assert "-o" in by_path["Contents/MacOS/lib1.dylib"].sign_command
+    assert "-o" not in by_path["Contents/MacOS/lib2.dylib"].sign_command
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency,expected_max_in_flight", ((3, 3), (None, 4)))
+async def test_sign_app_stub_codesign(mocker, tmpdir, concurrency, expected_max_in_flight):
+    """Sign with a stub ``codesign``, and check the order and overlap of the calls."""
+    bin_dir = os.path.join(tmpdir, "bin")
+    log_path = os.path.join(tmpdir, "codesign.log")
+    makedirs(bin_dir)
+    for name, script in (
+        ("codesign", f'#!/bin/sh\nfor last; do :; done\necho "start $PWD/$last" >> {log_path}\nsleep 0.1\necho "end $PWD/$last" >> {log_path}\n'),
+        ("xattr", "#!/bin/sh\n"),
+    ):
+        with open(os.path.join(bin_dir, name), "w") as fh:
+            fh.write(script)
+        os.chmod(os.path.join(bin_dir, name), 0o755)
+    mocker.patch.dict(os.environ, {"PATH": f"{bin_dir}:{os.environ['PATH']}"})
+    mocker.patch.object(mac, "get_bundle_executable", return_value="main")
+    sign_config = {
+        "identity": "id",
+        "signing_keychain": "keychain",
+        "designated_requirements": "",
+        "sign_dirs": ("MacOS", "Frameworks"),
+        "skip_dirs": tuple(),
+    }
+    if concurrency:
+        sign_config["codesign_concurrency"] = concurrency
+    app_path = _make_nested_app(tmpdir)
+
+    await mac.sign_app(sign_config, app_path, "entitlements")
+
+    with open(log_path) as fh:
+        events = [line.split(" ", 1) for line in fh.read().splitlines()]
+    signed = {}
+    in_flight = max_in_flight = 0
+    for event, path in events:
+        path = os.path.relpath(os.path.normpath(path), app_path)
+        in_flight += 1 if event == "start" else -1
+        max_in_flight = max(max_in_flight, in_flight)
+        signed.setdefault(path, []).append(event)
+    # Each file is signed once, and no more than codesign_concurrency at a time
+    assert all(v == ["start", "end"] for v in signed.values())
+    assert len({os.path.realpath(os.path.join(app_path, path)) for path in signed}) == len(signed)
+    assert max_in_flight == expected_max_in_flight
+    order = [os.path.relpath(os.path.normpath(path), app_path) for event, path in events if event == "end"]
+    assert order[-1] == "."
+    assert order.index("Contents/Frameworks/Outer.framework/Versions/A/Outer") < order.index("Contents/Frameworks/Outer.framework")
+    assert order.index("Contents/Frameworks/Outer.framework/Versions/A/Frameworks/Inner.framework") < order.index("Contents/Frameworks/Outer.framework")
+    assert order.index("Contents/MacOS/inner.app/Contents/MacOS/inner.dylib") < order.index("Contents/MacOS/inner.app")
+    assert "Contents/MacOS/main" not in signed
+
+
+@pytest.mark.asyncio
+async def test_sign_app_codesign_failure(mocker, tmpdir):
+    sign_config = {
+        "identity": "id",
+        "signing_keychain": "keychain",
+        "designated_requirements": "",
+        "sign_dirs": ("MacOS", "Frameworks"),
+        "skip_dirs": tuple(),
+    }
+    app_path = _make_nested_app(tmpdir)
+    signed = []
+
+    async def fake_run_command(cmd, cwd=None, **kwargs):
+        if cmd[0] != "codesign":
+            return
+        signed.append(os.path.join(cwd, cmd[-1]))
+        if cmd[-1] == "lib1.dylib":
+            raise IScriptError("codesign failed")
+
+    mocker.patch.object(mac, "run_command", new=fake_run_command)
+    mocker.patch.object(mac, "retry_async", new=lambda func, args=(), kwargs=None, **_: func(*args, **(kwargs or {})))
+    mocker.patch.object(mac, "get_bundle_executable", return_value="main")
+    with pytest.raises(IScriptError, match="codesign failed"):
+        await mac.sign_app(sign_config, app_path, "entitlements")
+    # Nothing that depends on the failed layer is signed
+    assert app_path not in signed
+    assert os.path.join(app_path, "Contents", "MacOS", "inner.app") not in signed
+
+
 # verify_app_signature {{{1
 @pytest.mark.asyncio
 async def test_verify_app_signature_noop(mocker):
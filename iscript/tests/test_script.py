@@ -59,7 +59,7 @@ def test_get_default_config(tmpdir):
     """``get_default_config`` returns a dict with expected keys/values."""
     config = script.get_default_config(base_dir=tmpdir)
     assert config["work_dir"] == os.path.join(tmpdir, "work")
-    for k in ("artifact_dir", "schema_file"):
+    for k in ("artifact_dir", "schema_file", "autograph_concurrency"):
         assert k in config
 
 
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""Helpers for talking to autograph, shared by the scripts that sign with it.
+
+Attributes:
+    log (logging.Logger): the log object for the module
+
+"""
+
+import base64
+import json
+import logging
+import os
+import re
+import tempfile
+
+from scriptworker_client.exceptions import AutographResponseError
+from scriptworker_client.utils import rm
+
+log = logging.getLogger(__name__)
+
+RESPONSE_CHUNK_SIZE = 1024 * 1024
+_JSON_STRING_SPECIAL_RE = re.compile(rb'["\\]')
+_JSON_STRUCTURAL_RE = re.compile(rb'[":]')
+
+
+# AutographResponseStream {{{1
+class AutographResponseStream:
+    """Incrementally parse an autograph JSON response, decoding large values to disk.
+
+    The string values of any key in `stream_keys` are base64 decoded into
+    temporary files under `tmp_dir` as the response arrives, and replaced with
+    the path to that file in the parsed response. Everything else in the
+    envelope is small, and is parsed with `json.loads` once the response is
+    complete. This keeps memory usage constant regardless of the size of the
+    signed artifact.
+
+    Args:
+        stream_keys (set): the keys whose values should be decoded to disk
+        tmp_dir (str): the directory to create the decoded files in
+
+    """
+
+    def __init__(self, stream_keys, tmp_dir):
+        """Initialize AutographResponseStream."""
+        self.stream_keys = set(stream_keys)
+        self.tmp_dir = tmp_dir
+        self.paths = []
+        self._skeleton = bytearray()
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._value_key = None
+        self._out = None
+        self._b64_buffer = b""
+
+    def feed(self, chunk):
+        """Parse the next chunk of the response body."""
+        pos = 0
+        while pos < len(chunk):
+            if self._out is not None:
+                end = chunk.find(b'"', pos)
+                stop = len(chunk) if end == -1 else end
+                self._write_b64(chunk[pos:stop])
+                if end == -1:
+                    return
+                self._finish_stream()
+                pos = end + 1
+            elif self._in_string:
+                if self._escape:
+                    self._skeleton += chunk[pos : pos + 1]
+                    self._escape = False
+                    pos += 1
+                    continue
+                m = _JSON_STRING_SPECIAL_RE.search(chunk, pos)
+                if not m:
+                    self._skeleton += chunk[pos:]
+                    return
+                i = m.start()
+                self._skeleton += chunk[pos : i + 1]
+                pos = i + 1
+                if m.group() == b"\\":
+                    self._escape = True
+                else:
+                    self._in_string = False
+                    self._last_string = bytes(self._skeleton[self._string_start :])
+            else:
+                m = _JSON_STRUCTURAL_RE.search(chunk, pos)
+                stop = m.start() if m else len(chunk)
+                if chunk[pos:stop].strip():
+                    self._last_string = self._value_key = None
+                self._skeleton += chunk[pos:stop]
+                if not m:
+                    return
+                pos = stop + 1
+                if m.group() == b":":
+                    self._skeleton += b":"
+                    self._value_key = json.loads(self._last_string) if self._last_string else None
+                    self._last_string = None
+                elif self._value_key in self.stream_keys:
+                    self._value_key = None
+                    self._start_stream()
+                else:
+                    self._value_key = None
+                    self._in_string = True
+                    self._string_start = len(self._skeleton)
+                    self._skeleton += b'"'
+
+    def close(self):
+        """Finish parsing, and return the response with the streamed values replaced by paths.
+
+        Raises:
+            AutographResponseError: if the response is incomplete or isn't valid json
+
+        """
+        if self._out is not None or self._in_string:
+            raise AutographResponseError("Truncated autograph response")
+        try:
+            return json.loads(self._skeleton)
+        except ValueError as e:
+            raise AutographResponseError(f"Invalid autograph response: {e}")
+
+    def discard(self):
+        """Remove any files written so far, e.g. if the request failed part way through."""
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        for path in self.paths:
+            rm(path)
+        self.paths = []
+
+    def _start_stream(self):
+        fd, path = tempfile.mkstemp(prefix="autograph", suffix=".out", dir=self.tmp_dir)
+        self._out = os.fdopen(fd, "wb")
+        self.paths.append(path)
+        self._b64_buffer = b""
+        self._skeleton += json.dumps(path).encode("utf-8")
+
+    def _write_b64(self, data):
+        data = self._b64_buffer + data
+        if b"\\" in data:
+            # Base64 only needs escaping for "/", and only by overly cautious
+            # encoders. An escape may be split across chunks.
+            data = data.replace(b"\\/", b"/")
+            if data.count(b"\\") > int(data.endswith(b"\\")):
+                raise AutographResponseError("Unexpected escape sequence in autograph response")
+        usable = len(data) // 4 * 4
+        if usable and data[usable - 1 : usable] == b"\\":
+            usable -= 4
+        self._out.write(base64.b64decode(data[:usable]))
+        self._b64_buffer = data[usable:]
+
+    def _finish_stream(self):
+        if b"\\" in self._b64_buffer:
+            raise AutographResponseError("Unexpected escape sequence in autograph response")
+        if self._b64_buffer:
+            try:
+                self._out.write(base64.b64decode(self._b64_buffer))
+            except ValueError as e:
+                raise AutographResponseError(f"Invalid base64 in autograph response: {e}")
+        self._out.close()
+        self._out = None
+        self._b64_buffer = b""
+
+
+# read_streamed_response {{{1
+async def read_streamed_response(resp, stream_keys, tmp_dir):
+    """Read an aiohttp autograph response through an `AutographResponseStream`.
+
+    Any files written so far are removed if reading the response fails.
+
+    Args:
+        resp (aiohttp.ClientResponse): the autograph response
+        stream_keys (set): the keys whose values should be decoded to disk
+        tmp_dir (str): the directory to create the decoded files in
+
+    Raises:
+        AutographResponseError: if the response is invalid
+
+    Returns:
+        the response json, with the streamed values replaced by paths
+
+    """
+    stream = AutographResponseStream(stream_keys, tmp_dir)
+    try:
+        async for chunk in resp.content.iter_chunked(RESPONSE_CHUNK_SIZE):
+            stream.feed(chunk)
+        return stream.close()
+    except BaseException:
+        stream.discard()
+        raise
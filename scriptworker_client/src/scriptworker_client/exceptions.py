@@ -76,3 +76,7 @@ class DownloadError(ClientError):
 
 class LockfileError(ClientError):
     """Scriptworker-client lockfile acquiring error."""
+
+
+class AutographResponseError(TaskError):
+    """Scriptworker-client invalid autograph response error."""
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Test scriptworker_client.autograph"""
+import base64
+import json
+import os
+
+import pytest
+
+import scriptworker_client.autograph as autograph
+from scriptworker_client.exceptions import AutographResponseError
+
+
+class FakeStreamReader:
+    def __init__(self, data, exception=None):
+        self.data = data
+        self.exception = exception
+
+    async def iter_chunked(self, n):
+        # Use tiny chunks to exercise the incremental parsing
+        for i in range(0, len(self.data), 3):
+            yield self.data[i : i + 3]
+        if self.exception:
+            raise self.exception
+
+
+class FakeResponse:
+    def __init__(self, data, exception=None):
+        self.content = FakeStreamReader(data, exception)
+
+
+# AutographResponseStream {{{1
+@pytest.mark.parametrize("chunk_size", (1, 2, 3, 7, 1024))
+@pytest.mark.parametrize("escape_slashes", (True, False))
+def test_autograph_response_stream(tmp_path, chunk_size, escape_slashes):
+    contents = [os.urandom(1000), b"", b"\xff" * 300]
+    resp = [
+        {
+            "ref": 'a "quoted" \\ ref',
+            "signed_files": [{"name": f"file{i}.rpm", "content": base64.b64encode(c).decode()} for i, c in enumerate(contents)],
+            "options": {"content": None, "nested": ["content", 1, True]},
+        }
+    ]
+    data = json.dumps(resp, indent=1).encode()
+    if escape_slashes:
+        data = data.replace(b"/", b"\\/")
+    stream = autograph.AutographResponseStream({"content"}, str(tmp_path))
+    for i in range(0, len(data), chunk_size):
+        stream.feed(data[i : i + chunk_size])
+    result = stream.close()
+
+    assert result[0]["ref"] == 'a "quoted" \\ ref'
+    assert result[0]["options"] == {"content": None, "nested": ["content", 1, True]}
+    assert [f["name"] for f in result[0]["signed_files"]] == ["file0.rpm", "file1.rpm", "file2.rpm"]
+    for f, expected in zip(result[0]["signed_files"], contents):
+        with open(f["content"], "rb") as fh:
+            assert fh.read() == expected
+    assert sorted(stream.paths) == sorted(f["content"] for f in result[0]["signed_files"])
+
+
+@pytest.mark.parametrize(
+    "data,match",
+    (
+        (b'[{"signed_file": "YWJj', "Truncated"),
+        (b'[{"signed_file": "YW\\nJj"}]', "escape sequence"),
+        (b'[{"signed_file": "YWJ"}]', "Invalid base64"),
+        (b'[{"signed_file": "YWJj"}', "Invalid autograph response"),
+    ),
+)
+def test_autograph_response_stream_errors(tmp_path, data, match):
+    stream = autograph.AutographResponseStream({"signed_file"}, str(tmp_path))
+    with pytest.raises(AutographResponseError, match=match):
+        stream.feed(data)
+        stream.close()
+    stream.discard()
+    assert list(tmp_path.iterdir()) == []
+
+
+# read_streamed_response {{{1
+@pytest.mark.asyncio
+async def test_read_streamed_response(tmp_path):
+    data = os.urandom(3000)
+    resp = FakeResponse(json.dumps([{"signed_file": base64.b64encode(data).decode()}]).encode())
+    result = await autograph.read_streamed_response(resp, {"signed_file"}, str(tmp_path))
+    with open(result[0]["signed_file"], "rb") as fh:
+        assert fh.read() == data
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("data,exception", ((b'[{"signed_file": "YWJj', None), (b'[{"signed_file": "YWJjZGVm', ConnectionResetError)))
+async def test_read_streamed_response_cleans_up(tmp_path, data, exception):
+    with pytest.raises(exception or AutographResponseError):
+        await autograph.read_streamed_response(FakeResponse(data, exception), {"signed_file"}, str(tmp_path))
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,174 @@
+"""Content-addressed cache of autograph signing results.
+
+Reruns and sibling tasks often send identical bytes to autograph. The cache
+lets signingscript reuse a previous signed output or detached signature
+instead, keyed by the sha256 of the input and everything else that affects
+the signature.
+
+Each entry is a pair of files in ``cache_dir``: ``<key>`` holds the signed
+data, and ``<key>.json`` holds its sha256 and size, so we can catch
+corrupted entries. Entries are evicted least recently used first once the
+cache grows past ``max_size`` bytes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+
+from signingscript.utils import mkdir
+
+log = logging.getLogger(__name__)
+
+
+class SigningCache:
+    """On-worker signing result cache.
+
+    Args:
+        cache_dir (str): the directory to keep cache entries in. Created if
+            it doesn't exist.
+        max_size (int): the maximum total size of the cached data, in bytes.
+
+    Attributes:
+        hits (int): the number of successful lookups
+        misses (int): the number of failed lookups, including corrupt entries
+
+    """
+
+    def __init__(self, cache_dir, max_size):
+        """Initialize SigningCache."""
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        mkdir(cache_dir)
+
+    @staticmethod
+    def make_key(input_digest, fmt, keyid=None, cert_type=None, extension_id=None):
+        """Return the cache key for a signing request.
+
+        Args:
+            input_digest (str): the sha256 hexdigest of the input
+            fmt (str): the signing format
+            keyid (str, optional): the autograph key id
+            cert_type (str, optional): the task cert type
+            extension_id (str, optional): the extension id, for xpi formats
+
+        Returns:
+            str: the cache key
+
+        """
+        key = json.dumps([input_digest, fmt, keyid, cert_type, extension_id])
+        return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+    def _data_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _meta_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _lookup(self, key):
+        """Return the path to a verified cache entry, or None."""
+        data_path = self._data_path(key)
+        try:
+            with open(self._meta_path(key)) as fh:
+                meta = json.load(fh)
+            with open(data_path, "rb") as fh:
+                digest = hashlib.file_digest(fh, "sha256").hexdigest()
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if digest != meta.get("sha256"):
+            log.warning("Signing cache entry %s is corrupt; removing it", key)
+            self._remove(key)
+            self.misses += 1
+            return None
+        # Bump the entry for LRU eviction
+        os.utime(self._meta_path(key))
+        self.hits += 1
+        return data_path
+
+    def get_file(self, key, to):
+        """Copy the cached data for `key` to `to`.
+
+        Returns:
+            bool: True on a cache hit, False otherwise
+
+        """
+        data_path = self._lookup(key)
+        if data_path is None:
+            return False
+        shutil.copyfile(data_path, to)
+        log.info("Signing cache hit for %s", to)
+        return True
+
+    def get_bytes(self, key):
+        """Return the cached data for `key`, or None."""
+        data_path = self._lookup(key)
+        if data_path is None:
+            return None
+        with open(data_path, "rb") as fh:
+            return fh.read()
+
+    def put_file(self, key, path):
+        """Store a copy of `path` as the cached data for `key`."""
+        with open(path, "rb") as fh:
+            self._put(key, fh)
+
+    def put_bytes(self, key, data):
+        """Store `data` as the cached data for `key`."""
+        with tempfile.TemporaryFile() as fh:
+            fh.write(data)
+            fh.seek(0)
+            self._put(key, fh)
+
+    def _put(self, key, fileobj):
+        h = hashlib.new("sha256")
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    block = fileobj.read(1024 * 1024)
+                    if not block:
+                        break
+                    h.update(block)
+                    out.write(block)
+                size = out.tell()
+            os.replace(tmp_path, self._data_path(key))
+            with open(self._meta_path(key), "w") as fh:
+                json.dump({"sha256": h.hexdigest(), "size": size}, fh)
+        except OSError:
+            log.exception("Couldn't store signing cache entry %s", key)
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            return
+        self.evict()
+
+    def _remove(self, key):
+        pathlib.Path(self._meta_path(key)).unlink(missing_ok=True)
+        pathlib.Path(self._data_path(key)).unlink(missing_ok=True)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in `max_size`."""
+        entries = []
+        total = 0
+        for meta_path in pathlib.Path(self.cache_dir).glob("*.json"):
+            try:
+                mtime = meta_path.stat().st_mtime
+                size = pathlib.Path(self.cache_dir, meta_path.stem).stat().st_size
+            except OSError:
+                continue
+            entries.append((mtime, size, meta_path.stem))
+            total += size
+        for _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            log.debug("Evicting signing cache entry %s (%d bytes)", key, size)
+            self._remove(key)
+            total -= size
+
+    def log_stats(self):
+        """Log the hit and miss counters."""
+        log.info("Signing cache: %d hits, %d misses", self.hits, self.misses)
@@ -0,0 +1,183 @@
+"""Adaptive concurrency limits for autograph requests.
+
+Signing fans out to autograph from several places at once (widevine,
+authenticode, omnija, ...). Without a limit a big task can swamp autograph,
+which answers with 429s and 5xxs that we then retry, making everything
+slower.
+
+`AutographConcurrencyLimiter` keeps a separate window of allowed in-flight
+requests per autograph server, and adjusts it AIMD style, like TCP
+congestion control: the window grows by about one request per window's
+worth of successful requests while latency is stable, and is cut in half on
+a 429, a 5xx or a timeout. Requests over the window wait in a FIFO queue.
+
+Latency is the time until autograph starts responding, so that streaming
+big responses doesn't count, and is averaged separately for each endpoint,
+because signing a hash is much quicker than signing a file.
+"""
+
+import asyncio
+import collections
+import contextlib
+import logging
+from urllib.parse import urlsplit
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+
+def _is_overload_error(exc):
+    """Return True if `exc` means autograph is overloaded."""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, asyncio.TimeoutError)
+
+
+class _ServerWindow:
+    """The concurrency state of a single autograph server."""
+
+    def __init__(self, name, window):
+        self.name = name
+        self.window = float(window)
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.latency = {}
+        self.last_decrease = None
+        self.max_in_flight = 0
+        self.queued = 0
+        self.decreases = 0
+
+
+class AutographConcurrencyLimiter:
+    """AIMD limit on in-flight autograph requests, per server.
+
+    Args:
+        initial_window (int): the number of concurrent requests to allow per
+            server to begin with
+        max_window (int): the most concurrent requests to ever allow per server
+        min_window (int, optional): the fewest concurrent requests to allow per
+            server. Defaults to 1
+        decrease_factor (float, optional): what to multiply the window by when
+            a server is overloaded. Defaults to 0.5
+        latency_tolerance (float, optional): how much slower than the recent
+            average a request can be while still counting as stable latency.
+            Defaults to 1.5
+
+    """
+
+    def __init__(self, initial_window, max_window, min_window=1, decrease_factor=0.5, latency_tolerance=1.5):
+        """Initialize AutographConcurrencyLimiter."""
+        self.initial_window = max(min_window, min(initial_window, max_window))
+        self.max_window = max_window
+        self.min_window = min_window
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self._servers = {}
+
+    def _get_server(self, url):
+        parts = urlsplit(url)
+        name = f"{parts.scheme}://{parts.netloc}"
+        if name not in self._servers:
+            self._servers[name] = _ServerWindow(name, self.initial_window)
+        return self._servers[name]
+
+    @contextlib.asynccontextmanager
+    async def request(self, url):
+        """Wait for a free slot on the server of `url`, and hold it for the duration.
+
+        Overload errors raised inside the block shrink the window; successful
+        requests with stable latency grow it. The block gets a function to
+        call once the response headers are in, which is when the latency is
+        measured. If it isn't called, the whole block counts.
+        """
+        loop = asyncio.get_running_loop()
+        server = self._get_server(url)
+        endpoint = urlsplit(url).path
+        await self._acquire(server)
+        start = loop.time()
+        latency = None
+
+        def response_started():
+            nonlocal latency
+            if latency is None:
+                latency = loop.time() - start
+
+        try:
+            yield response_started
+        except Exception as e:
+            if _is_overload_error(e):
+                self._on_overload(server, start, e)
+            raise
+        else:
+            response_started()
+            self._on_success(server, endpoint, latency)
+        finally:
+            server.in_flight -= 1
+            self._wake(server)
+
+    async def _acquire(self, server):
+        if not server.waiters and server.in_flight < int(server.window):
+            self._take_slot(server)
+            return
+        future = asyncio.get_running_loop().create_future()
+        server.waiters.append(future)
+        server.queued += 1
+        log.info("autograph %s: window %d full, %d in flight, %d queued", server.name, int(server.window), server.in_flight, len(server.waiters))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were handed a slot, but got cancelled before using it
+                server.in_flight -= 1
+                self._wake(server)
+            else:
+                server.waiters.remove(future)
+            raise
+
+    def _take_slot(self, server):
+        server.in_flight += 1
+        server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+    def _wake(self, server):
+        while server.waiters and server.in_flight < int(server.window):
+            future = server.waiters.popleft()
+            if not future.done():
+                self._take_slot(server)
+                future.set_result(None)
+
+    def _on_success(self, server, endpoint, latency):
+        average = server.latency.get(endpoint)
+        stable = average is None or latency <= average * self.latency_tolerance
+        server.latency[endpoint] = latency if average is None else 0.8 * average + 0.2 * latency
+        if not stable or server.window >= self.max_window:
+            return
+        old_window = int(server.window)
+        server.window = min(self.max_window, server.window + 1 / server.window)
+        if int(server.window) > old_window:
+            log.info("autograph %s: raising window to %d (%d in flight, %d queued)", server.name, int(server.window), server.in_flight, len(server.waiters))
+            self._wake(server)
+
+    def _on_overload(self, server, start, exc):
+        # Only cut the window once per overload event: requests that were
+        # already in flight when we last cut it don't count again.
+        if server.last_decrease is not None and start < server.last_decrease:
+            return
+        server.last_decrease = asyncio.get_running_loop().time()
+        server.window = max(self.min_window, server.window * self.decrease_factor)
+        server.decreases += 1
+        log.warning(
+            "autograph %s: %s; cutting window to %d (%d in flight, %d queued)", server.name, exc, int(server.window), server.in_flight, len(server.waiters)
+        )
+
+    def log_stats(self):
+        """Log the final state of each server's window."""
+        for server in self._servers.values():
+            log.info(
+                "autograph %s: final window %d, max %d in flight, %d requests queued, window cut %d times",
+                server.name,
+                int(server.window),
+                server.max_in_flight,
+                server.queued,
+                server.decreases,
+            )
@@ -10,6 +10,24 @@ import os
 import sys
 
 
+def _include_file(rel_path_file):
+    """Return True if the file should be listed in the precomplete file."""
+    return not (
+        rel_path_file.endswith("channel-prefs.js")
+        or rel_path_file.endswith("update-settings.ini")
+        or "/ChannelPrefs.framework/" in rel_path_file
+        or rel_path_file.startswith("ChannelPrefs.framework/")
+        or "/UpdateSettings.framework/" in rel_path_file
+        or rel_path_file.startswith("UpdateSettings.framework/")
+        or "distribution/" in rel_path_file
+    )
+
+
+def _include_dir(rel_path_dir):
+    """Return True if the directory should be listed in the precomplete file."""
+    return rel_path_dir.find("distribution/") == -1
+
+
 def get_build_entries(root_path):
     """Iterates through the root_path, creating a list for each file and
     directory. Excludes any file paths ending with channel-prefs.js.
@@ -21,22 +39,14 @@ def get_build_entries(root_path):
             parent_dir_rel_path = root[len(root_path) + 1 :]
             rel_path_file = os.path.join(parent_dir_rel_path, file_name)
             rel_path_file = rel_path_file.replace("\\", "/")
-            if not (
-                rel_path_file.endswith("channel-prefs.js")
-                or rel_path_file.endswith("update-settings.ini")
-                or "/ChannelPrefs.framework/" in rel_path_file
-                or rel_path_file.startswith("ChannelPrefs.framework/")
-                or "/UpdateSettings.framework/" in rel_path_file
-                or rel_path_file.startswith("UpdateSettings.framework/")
-                or "distribution/" in rel_path_file
-            ):
+            if _include_file(rel_path_file):
                 rel_file_path_set.add(rel_path_file)
 
         for dir_name in dirs:
             parent_dir_rel_path = root[len(root_path) + 1 :]
             rel_path_dir = os.path.join(parent_dir_rel_path, dir_name)
             rel_path_dir = rel_path_dir.replace("\\", "/") + "/"
-            if rel_path_dir.find("distribution/") == -1:
+            if _include_dir(rel_path_dir):
                 rel_dir_path_set.add(rel_path_dir)
 
     rel_file_path_list = list(rel_file_path_set)
@@ -47,28 +57,47 @@ def get_build_entries(root_path):
     return rel_file_path_list, rel_dir_path_list
 
 
+def get_build_entries_from_paths(file_paths, dir_paths):
+    """Like get_build_entries, but from lists of file and directory paths
+    relative to the root, e.g. taken from the members of an archive, rather
+    than by walking the disk.
+    """
+    rel_file_path_list = sorted({p for p in file_paths if _include_file(p)}, reverse=True)
+    rel_dir_path_list = sorted({p.rstrip("/") + "/" for p in dir_paths if _include_dir(p.rstrip("/") + "/")}, reverse=True)
+    return rel_file_path_list, rel_dir_path_list
+
+
+def get_precomplete_contents(rel_file_path_list, rel_dir_path_list):
+    """Return the contents of the precomplete file for the given entries."""
+    lines = ['remove "{}"\n'.format(rel_file_path) for rel_file_path in rel_file_path_list]
+    lines.extend('rmdir "{}"\n'.format(rel_dir_path) for rel_dir_path in rel_dir_path_list)
+    return "".join(lines).encode("utf-8")
+
+
+def get_precomplete_root(precomplete_dir):
+    """Return the root to enumerate for a precomplete file in precomplete_dir,
+    and the precomplete file's path relative to that root.
+    """
+    # If inside a Mac bundle use the root of the bundle for the path.
+    if os.path.basename(precomplete_dir) == "Resources":
+        return os.path.normpath(os.path.join(precomplete_dir, "../../")), "Contents/Resources/precomplete"
+    return precomplete_dir, "precomplete"
+
+
 def generate_precomplete(root_path):
     """Creates the precomplete file containing the remove and rmdir
     application update instructions. The given directory is used
     for the location to enumerate and to create the precomplete file.
     """
-    rel_path_precomplete = "precomplete"
-    # If inside a Mac bundle use the root of the bundle for the path.
-    if os.path.basename(root_path) == "Resources":
-        root_path = os.path.abspath(os.path.join(root_path, "../../"))
-        rel_path_precomplete = "Contents/Resources/precomplete"
+    root_path, rel_path_precomplete = get_precomplete_root(root_path)
+    root_path = os.path.abspath(root_path)
 
     precomplete_file_path = os.path.join(root_path, rel_path_precomplete)
     # Open the file so it exists before building the list of files and open it
     # in binary mode to prevent OS specific line endings.
     precomplete_file = open(precomplete_file_path, "wb")
     rel_file_path_list, rel_dir_path_list = get_build_entries(root_path)
-    for rel_file_path in rel_file_path_list:
-        precomplete_file.write('remove "{}"\n'.format(rel_file_path).encode("utf-8"))
-
-    for rel_dir_path in rel_dir_path_list:
-        precomplete_file.write('rmdir "{}"\n'.format(rel_dir_path).encode("utf-8"))
-
+    precomplete_file.write(get_precomplete_contents(rel_file_path_list, rel_dir_path_list))
     precomplete_file.close()
 
 
@@ -0,0 +1,157 @@
+"""Structured per-task signing metrics.
+
+`SigningMetrics` collects what each signing operation cost: the format,
+input and output sizes, wall time, time spent waiting for a format slot,
+RSS growth, and the requests, retries, bytes and queue wait on autograph.
+It also keeps aggregate timings for functions decorated with
+`time_function` and `time_async_function`. `async_main` writes it out as
+``public/logs/signing-metrics.json``.
+
+The active collector and the operation being measured are held in context
+variables, so helpers deep in the signing code, like `call_autograph`, can
+record to them without being handed the context, and asyncio tasks they
+start inherit them.
+"""
+
+import contextlib
+import contextvars
+import json
+import resource
+import threading
+import time
+
+_collector = contextvars.ContextVar("signing_metrics", default=None)
+_operation = contextvars.ContextVar("signing_metrics_operation", default=None)
+
+# Counters kept both per operation and for the whole task
+_COUNTERS = (
+    "queue_wait",
+    "autograph_calls",
+    "autograph_requests",
+    "autograph_queue_wait",
+    "autograph_bytes_sent",
+    "autograph_bytes_received",
+)
+
+
+def get_rss():
+    """Return the maximum resident set size for this process."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _with_retries(counters):
+    counters = dict(counters)
+    # Every autograph call is attempted at least once; any extra requests are retries
+    counters["autograph_retries"] = counters["autograph_requests"] - counters["autograph_calls"]
+    return counters
+
+
+class SigningMetrics:
+    """Collect the signing metrics of a task.
+
+    Attributes:
+        operations (list): a dict per signing operation, in the order they finished
+        functions (dict): call counts and timings per decorated function name
+        totals (dict): the counters summed over the whole task
+
+    """
+
+    def __init__(self):
+        """Initialize SigningMetrics."""
+        self.start_time = time.time()
+        self.start_rss = get_rss()
+        self.operations = []
+        self.functions = {}
+        self.totals = dict.fromkeys(_COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    def activate(self):
+        """Make this the collector for the current context, and any tasks started from it."""
+        _collector.set(self)
+
+    def record_function(self, name, duration, rss_delta):
+        """Add a call of the function `name` to the function timings."""
+        with self._lock:
+            stats = self.functions.setdefault(name, {"calls": 0, "total_time": 0.0, "max_time": 0.0, "max_rss_delta": 0})
+            stats["calls"] += 1
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+            stats["max_rss_delta"] = max(stats["max_rss_delta"], rss_delta)
+
+    def _add_counters(self, operation, counters):
+        with self._lock:
+            for name, value in counters.items():
+                self.totals[name] += value
+                if operation is not None:
+                    operation[name] += value
+
+    def _get_formats(self):
+        formats = {}
+        for operation in self.operations:
+            stats = formats.setdefault(operation["format"], {"count": 0, "failures": 0, "size": 0, "wall_time": 0.0, **dict.fromkeys(_COUNTERS, 0)})
+            stats["count"] += 1
+            stats["failures"] += not operation["succeeded"]
+            stats["size"] += operation["size"] or 0
+            stats["wall_time"] += operation["wall_time"]
+            for name in _COUNTERS:
+                stats[name] += operation[name]
+        return {fmt: _with_retries(stats) for fmt, stats in formats.items()}
+
+    def to_dict(self):
+        """Return the metrics as a json serializable dict."""
+        return {
+            "wall_time": time.time() - self.start_time,
+            "max_rss": get_rss(),
+            "rss_delta": get_rss() - self.start_rss,
+            "totals": _with_retries(self.totals),
+            "formats": self._get_formats(),
+            "operations": [_with_retries(operation) for operation in self.operations],
+            "functions": self.functions,
+        }
+
+    def write(self, path):
+        """Write the metrics to `path` as json."""
+        with open(path, "w") as fh:
+            json.dump(self.to_dict(), fh, indent=2, sort_keys=True)
+
+
+def record_function(name, duration, rss_delta):
+    """Record a function call on the active collector, if there is one."""
+    collector = _collector.get()
+    if collector is not None:
+        collector.record_function(name, duration, rss_delta)
+
+
+def add_counters(**counters):
+    """Add to the counters of the active collector and operation, if there are any."""
+    collector = _collector.get()
+    if collector is not None:
+        collector._add_counters(_operation.get(), counters)
+
+
+@contextlib.contextmanager
+def measure_operation(path, fmt, size=None):
+    """Measure signing `path` with `fmt` on the active collector.
+
+    Yields:
+        dict: the operation record; callers can fill in ``signed_size``. If
+            there is no active collector, a throwaway dict.
+
+    """
+    operation = {"path": path, "format": fmt, "size": size, "signed_size": None, "succeeded": False, **dict.fromkeys(_COUNTERS, 0)}
+    collector = _collector.get()
+    if collector is None:
+        yield operation
+        return
+    token = _operation.set(operation)
+    start = time.time()
+    start_rss = get_rss()
+    try:
+        yield operation
+        operation["succeeded"] = True
+    finally:
+        operation["wall_time"] = time.time() - start
+        operation["rss_delta"] = get_rss() - start_rss
+        _operation.reset(token)
+        with collector._lock:
+            collector.operations.append(operation)
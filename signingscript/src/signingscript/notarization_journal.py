@@ -0,0 +1,117 @@
+"""A journal of Apple notarization submissions, to resume them on a rerun.
+
+Notarizing a large .pkg can take Apple 30-60 minutes. If the task fails or
+is killed while waiting, a rerun would otherwise submit everything again and
+wait all over. `NotarizationJournal` records the submission id and state of
+each path as it goes through the pipeline, in
+``public/logs/notarization-journal.json``. On a rerun, the journal of the
+previous run is downloaded from the queue, and any submission that was
+already made is waited on rather than resubmitted.
+
+Paths are keyed by the digest of the upstream artifact they came from, plus
+their name inside it, so a rerun only reuses submissions of identical files.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+JOURNAL_ARTIFACT = "public/logs/notarization-journal.json"
+
+# Submitted to Apple, and waiting on it
+SUBMITTED = "submitted"
+# Apple accepted the submission
+ACCEPTED = "accepted"
+# The notarization ticket has been stapled
+STAPLED = "stapled"
+
+
+class NotarizationJournal:
+    """The submission id and state of each path being notarized.
+
+    The journal is rewritten in the artifact dir on every update, rather than
+    when the task is done, so it's uploaded even if the task fails midway.
+
+    Args:
+        artifact_dir (str): the artifact dir to write the journal to
+
+    Attributes:
+        path (str): the path the journal is written to
+        entries (dict): the submission id and state per key
+
+    """
+
+    def __init__(self, artifact_dir):
+        """Initialize NotarizationJournal."""
+        self.path = os.path.join(artifact_dir, JOURNAL_ARTIFACT)
+        self.entries = {}
+        self._keys = {}
+
+    def register(self, path, key):
+        """Track `path` as `key` in the journal.
+
+        Args:
+            path (str): the local path to notarize
+            key (str): the key identifying its content across runs
+
+        """
+        self._keys[path] = key
+
+    def get_submission_id(self, path):
+        """Return the id of an earlier submission of `path` that can be waited on, or None."""
+        entry = self.entries.get(self._keys.get(path))
+        if entry and entry["state"] in (SUBMITTED, ACCEPTED):
+            return entry["submission_id"]
+        return None
+
+    def update(self, path, submission_id, state):
+        """Record the submission id and state of `path`, and write the journal.
+
+        Paths that weren't registered aren't journaled.
+        """
+        key = self._keys.get(path)
+        if key is None:
+            return
+        self.entries[key] = {"name": os.path.basename(path), "submission_id": submission_id, "state": state}
+        self.write()
+
+    def write(self):
+        """Write the journal to `path`, atomically."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.path), delete=False) as fh:
+            json.dump({"submissions": self.entries}, fh, indent=2, sort_keys=True)
+        os.replace(fh.name, self.path)
+
+    async def load_previous_run(self, session, root_url, task_id, run_id):
+        """Load the journal of the latest earlier run of this task that wrote one.
+
+        The journal is only an optimization, so failing to download it is
+        logged rather than raised.
+
+        Args:
+            session (aiohttp.ClientSession): the session to download with
+            root_url (str): the taskcluster root url
+            task_id (str): the id of this task
+            run_id (int): the id of this run
+
+        """
+        for previous_run_id in range(run_id - 1, -1, -1):
+            url = f"{root_url.rstrip('/')}/api/queue/v1/task/{task_id}/runs/{previous_run_id}/artifacts/{JOURNAL_ARTIFACT}"
+            try:
+                async with session.get(url) as resp:
+                    if resp.status == 404:
+                        log.info(f"No notarization journal for run {previous_run_id}")
+                        continue
+                    resp.raise_for_status()
+                    journal = json.loads(await resp.read())
+            except (aiohttp.ClientError, ValueError) as e:
+                log.warning(f"Couldn't load the notarization journal of run {previous_run_id}: {e}")
+                continue
+            self.entries.update(journal.get("submissions", {}))
+            log.info(f"Loaded {len(self.entries)} notarization submissions from run {previous_run_id}")
+            return
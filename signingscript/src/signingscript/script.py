@@ -2,16 +2,35 @@
 """Signing script."""
 
 import asyncio
+import concurrent.futures
 import json
 import logging
+import multiprocessing
 import os
 from dataclasses import asdict
 
 import aiohttp
 import scriptworker.client
+from scriptworker.utils import raise_future_exceptions
 
+from signingscript import workspace
+from signingscript.cache import SigningCache
+from signingscript.concurrency import AutographConcurrencyLimiter
 from signingscript.exceptions import SigningScriptError
-from signingscript.task import apple_notarize_stacked, build_filelist_dict, sign, task_cert_type, task_signing_formats
+from signingscript.metrics import SigningMetrics
+from signingscript.task import (
+    apple_notarize_stacked,
+    build_filelist_dict,
+    get_batch_signing_function,
+    sign,
+    sign_batch,
+    task_cert_type,
+    task_signing_formats,
+)
+
+# signingscript.sign needs signingscript.task to be imported first
+# isort: split
+from signingscript.sign import AutographHashBatcher
 from signingscript.utils import copy_to_dir, load_apple_notarization_configs, load_autograph_configs, load_json
 
 log = logging.getLogger(__name__)
@@ -26,63 +45,204 @@ async def async_main(context):
 
     """
     work_dir = context.config["work_dir"]
-    async with aiohttp.ClientSession() as session:
-        all_signing_formats = task_signing_formats(context)
-        if {"autograph_gpg", "gcp_prod_autograph_gpg", "stage_autograph_gpg"}.intersection(all_signing_formats):
-            if not context.config.get("gpg_pubkey"):
-                raise Exception("GPG format is enabled but gpg_pubkey is not defined")
-            if not os.path.exists(context.config["gpg_pubkey"]):
-                raise Exception("gpg_pubkey ({}) doesn't exist!".format(context.config["gpg_pubkey"]))
-            await set_up_gpg_keyring(context)
-            copy_to_dir(context.config["gpg_pubkey"], context.config["artifact_dir"], target="public/build/KEY")
-
-        if {"autograph_widevine", "gcp_prod_autograph_widevine", "stage_autograph_widevine"}.intersection(all_signing_formats):
-            if not context.config.get("widevine_cert"):
-                raise Exception("Widevine format is enabled, but widevine_cert is not defined")
-
-        if {"apple_notarization", "apple_notarization_geckodriver", "apple_notarization_stacked", "apple_notarization_openh264_plugin"}.intersection(
-            all_signing_formats
-        ):
-            if not context.config.get("apple_notarization_configs", False):
-                raise Exception("Apple notarization is enabled but apple_notarization_configs is not defined")
-            setup_apple_notarization_credentials(context)
-
-        context.session = session
-        context.autograph_configs = load_autograph_configs(context.config["autograph_configs"])
-        if "mar_channels" in context.config:
-            context.mar_channels = load_json(context.config["mar_channels"])
-        else:
-            context.mar_channels = {}
-
-        # TODO: Make task.sign take in the whole filelist_dict and return a dict of output files.
-        #       That would likely mean changing all behaviors to accept and deal with multiple files at once.
-
-        filelist_dict = build_filelist_dict(context)
-        for path, path_dict in filelist_dict.items():
-            if path_dict["formats"] == ["apple_notarization_stacked"]:
-                # Skip if only format is notarization_stacked - handled below
-                continue
-            if "apple_notarization_stacked" in path_dict["formats"]:
-                raise SigningScriptError("apple_notarization_stacked cannot be mixed with other signing types")
-            copy_to_dir(path_dict["full_path"], context.config["work_dir"], target=path)
-            log.info("signing %s", path)
-            output_files = await sign(context, os.path.join(work_dir, path), path_dict["formats"], authenticode_comment=path_dict.get("comment"))
-            for source in output_files:
-                source = os.path.relpath(source, work_dir)
-                copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source)
-
-        # notarization_stacked is a special format that takes in all files at once instead of sequentially like other formats
-        # Should be fixed in https://github.com/mozilla-releng/scriptworker-scripts/issues/980
-        notarization_dict = {path: path_dict for path, path_dict in filelist_dict.items() if "apple_notarization_stacked" in path_dict["formats"]}
-        if notarization_dict:
-            output_files = await apple_notarize_stacked(context, notarization_dict)
-            for source in output_files:
-                source = os.path.relpath(source, work_dir)
-                copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source)
+    context.signing_metrics = SigningMetrics()
+    context.signing_metrics.activate()
+    context.process_pool = None
+    try:
+        async with aiohttp.ClientSession() as session:
+            all_signing_formats = task_signing_formats(context)
+            if {"autograph_gpg", "gcp_prod_autograph_gpg", "stage_autograph_gpg"}.intersection(all_signing_formats):
+                if not context.config.get("gpg_pubkey"):
+                    raise Exception("GPG format is enabled but gpg_pubkey is not defined")
+                if not os.path.exists(context.config["gpg_pubkey"]):
+                    raise Exception("gpg_pubkey ({}) doesn't exist!".format(context.config["gpg_pubkey"]))
+                await set_up_gpg_keyring(context)
+                copy_to_dir(context.config["gpg_pubkey"], context.config["artifact_dir"], target="public/build/KEY")
+
+            if {"autograph_widevine", "gcp_prod_autograph_widevine", "stage_autograph_widevine"}.intersection(all_signing_formats):
+                if not context.config.get("widevine_cert"):
+                    raise Exception("Widevine format is enabled, but widevine_cert is not defined")
+
+            if {"apple_notarization", "apple_notarization_geckodriver", "apple_notarization_stacked", "apple_notarization_openh264_plugin"}.intersection(
+                all_signing_formats
+            ):
+                if not context.config.get("apple_notarization_configs", False):
+                    raise Exception("Apple notarization is enabled but apple_notarization_configs is not defined")
+                setup_apple_notarization_credentials(context)
+
+            context.session = session
+            context.signing_format_semaphores = {}
+            context.signing_cache = None
+            if context.config.get("signing_cache_dir"):
+                context.signing_cache = SigningCache(context.config["signing_cache_dir"], context.config["signing_cache_max_size"])
+            context.autograph_limiter = None
+            if context.config.get("autograph_concurrency_max"):
+                context.autograph_limiter = AutographConcurrencyLimiter(
+                    context.config["autograph_concurrency_initial"],
+                    context.config["autograph_concurrency_max"],
+                    latency_tolerance=context.config["autograph_concurrency_latency_tolerance"],
+                )
+            # One worker per cpu unless configured otherwise. Workers only get
+            # spawned once there's work for them; forking a process with
+            # threads running isn't safe.
+            context.process_pool = concurrent.futures.ProcessPoolExecutor(
+                context.config.get("process_pool_workers") or os.cpu_count(), mp_context=multiprocessing.get_context("spawn")
+            )
+            context.workspace = None
+            if context.config.get("workspace_eager_reclaim") or context.config.get("workspace_disk_budget"):
+                context.workspace = workspace.WorkspaceManager(work_dir, context.config.get("workspace_disk_budget"))
+                context.workspace.activate()
+            context.hash_batcher = None
+            if context.config.get("autograph_hash_batch_window"):
+                context.hash_batcher = AutographHashBatcher(
+                    session, context.config["autograph_hash_batch_window"], context.config["autograph_hash_batch_size"], limiter=context.autograph_limiter
+                )
+            context.autograph_configs = load_autograph_configs(context.config["autograph_configs"])
+            if "mar_channels" in context.config:
+                context.mar_channels = load_json(context.config["mar_channels"])
+            else:
+                context.mar_channels = {}
+
+            # TODO: Make task.sign take in the whole filelist_dict and return a dict of output files.
+            #       That would likely mean changing all behaviors to accept and deal with multiple files at once.
+
+            filelist_dict = build_filelist_dict(context)
+            signing_dict = {}
+            batch_dict = {}
+            for path, path_dict in filelist_dict.items():
+                if path_dict["formats"] == ["apple_notarization_stacked"]:
+                    # Skip if only format is notarization_stacked - handled below
+                    continue
+                if "apple_notarization_stacked" in path_dict["formats"]:
+                    raise SigningScriptError("apple_notarization_stacked cannot be mixed with other signing types")
+                if (
+                    context.config.get("autograph_files_batch_max_bytes")
+                    and len(path_dict["formats"]) == 1
+                    and get_batch_signing_function(path_dict["formats"][0])
+                ):
+                    batch_dict[path] = path_dict
+                    continue
+                signing_dict[path] = path_dict
+            await sign_batches(context, batch_dict)
+            await sign_paths(context, signing_dict)
 
+            # notarization_stacked is a special format that takes in all files at once instead of sequentially like other formats
+            # Should be fixed in https://github.com/mozilla-releng/scriptworker-scripts/issues/980
+            notarization_dict = {path: path_dict for path, path_dict in filelist_dict.items() if "apple_notarization_stacked" in path_dict["formats"]}
+            if notarization_dict:
+                output_files = await apple_notarize_stacked(context, notarization_dict)
+                for source in output_files:
+                    source = os.path.relpath(source, work_dir)
+                    copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source, hardlink=True)
+
+        if context.signing_cache:
+            context.signing_cache.log_stats()
+        if context.autograph_limiter:
+            context.autograph_limiter.log_stats()
+        if context.workspace:
+            context.workspace.log_stats()
+    finally:
+        if context.process_pool:
+            context.process_pool.shutdown()
+        write_signing_metrics(context)
     log.info("Done!")
 
 
+def write_signing_metrics(context):
+    """Write the task's signing metrics to `public/logs/signing-metrics.json`.
+
+    Args:
+        context (Context): the signing context.
+
+    """
+    metrics_path = os.path.join(context.config["work_dir"], "signing-metrics.json")
+    context.signing_metrics.write(metrics_path)
+    copy_to_dir(metrics_path, context.config["artifact_dir"], target="public/logs/signing-metrics.json")
+
+
+async def sign_path(context, path, path_dict):
+    """Copy a single upstream artifact into `work_dir`, sign it, and copy the results to `artifact_dir`.
+
+    Args:
+        context (Context): the signing context.
+        path (str): the relative path of the upstream artifact.
+        path_dict (dict): the `build_filelist_dict` entry for `path`.
+
+    """
+    work_dir = context.config["work_dir"]
+    # Waits for the disk budget, and reclaims scratch directories once the
+    # outputs are in `artifact_dir`, if there is a `WorkspaceManager`
+    async with workspace.artifact(path):
+        copy_to_dir(path_dict["full_path"], work_dir, target=path)
+        log.info("signing %s", path)
+        output_files = await sign(context, os.path.join(work_dir, path), path_dict["formats"], authenticode_comment=path_dict.get("comment"))
+        for source in output_files:
+            source = os.path.relpath(source, work_dir)
+            copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source, hardlink=True)
+
+
+async def sign_paths(context, filelist_dict):
+    """Sign every path in `filelist_dict`, up to `max_concurrent_artifacts` at a time.
+
+    Each path is independent, so we can overlap the autograph round-trips of
+    several artifacts. The formats for a single path are still applied in order
+    by `task.sign`. The first failure cancels the remaining work and is raised.
+
+    Args:
+        context (Context): the signing context.
+        filelist_dict (dict): the relative paths to sign, as returned by
+            `build_filelist_dict`.
+
+    """
+    max_concurrent = context.config.get("max_concurrent_artifacts") or 1
+    semaphore = asyncio.Semaphore(max_concurrent)
+    log.info("Signing %d artifacts, %d at a time", len(filelist_dict), max_concurrent)
+
+    async def _bounded_sign_path(path, path_dict):
+        async with semaphore:
+            await sign_path(context, path, path_dict)
+
+    tasks = [asyncio.create_task(_bounded_sign_path(path, path_dict)) for path, path_dict in filelist_dict.items()]
+    if not tasks:
+        return
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for t in pending:
+        t.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    # Raise the first failure, in filelist order
+    for t in tasks:
+        if t in done:
+            t.result()
+
+
+async def sign_batches(context, filelist_dict):
+    """Sign the paths in `filelist_dict` that share a format together, and copy the results to `artifact_dir`.
+
+    Every path must have a single format with a batch signing function (see
+    `task.get_batch_signing_function`). Each format is signed in one
+    `task.sign_batch` call, concurrently with the other formats.
+
+    Args:
+        context (Context): the signing context.
+        filelist_dict (dict): the relative paths to sign, as returned by
+            `build_filelist_dict`.
+
+    """
+    work_dir = context.config["work_dir"]
+    paths_by_format = {}
+    for path, path_dict in filelist_dict.items():
+        copy_to_dir(path_dict["full_path"], work_dir, target=path)
+        paths_by_format.setdefault(path_dict["formats"][0], []).append(os.path.join(work_dir, path))
+
+    async def _sign_batch(fmt, paths):
+        log.info("signing %d files with %s together", len(paths), fmt)
+        for source in await sign_batch(context, paths, fmt):
+            source = os.path.relpath(source, work_dir)
+            copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source, hardlink=True)
+
+    await raise_future_exceptions([asyncio.ensure_future(_sign_batch(fmt, paths)) for fmt, paths in paths_by_format.items()])
+
+
 async def set_up_gpg_keyring(context):
     with open(context.config["gpg_pubkey"], "rb") as pubkey, open(os.path.join(context.config["work_dir"], "trustedkeys.gpg"), "wb") as keyring:
         p = await asyncio.create_subprocess_exec("gpg", "--dearmor", stdin=pubkey, stdout=keyring)
@@ -116,6 +276,21 @@ def get_default_config(base_dir=None):
         "hfsplus": "hfsplus",
         "gpg_pubkey": None,
         "widevine_cert": None,
+        "max_concurrent_artifacts": 1,
+        "max_concurrent_artifacts_per_format": None,
+        "signing_cache_dir": None,
+        "signing_cache_max_size": 10 * 1024 * 1024 * 1024,
+        "autograph_hash_batch_window": 0,
+        "autograph_hash_batch_size": 32,
+        "autograph_files_batch_max_bytes": 0,
+        "autograph_concurrency_initial": 16,
+        "autograph_concurrency_max": 0,
+        "autograph_concurrency_latency_tolerance": 1.5,
+        "tarball_compression_threads": 1,
+        "apple_notarization_concurrency": 8,
+        "process_pool_workers": 0,
+        "workspace_eager_reclaim": False,
+        "workspace_disk_budget": 0,
     }
     return default_config
 
@@ -3,37 +3,50 @@
 
 import asyncio
 import base64
-import difflib
+import contextlib
+import copy
 import fnmatch
-import glob
 import hashlib
 import json
 import logging
 import lzma
+import mmap
 import os
 import pathlib
 import re
-import resource
 import shutil
+import stat
+import struct
 import subprocess
 import sys
 import tarfile
 import tempfile
 import time
+import traceback
 import zipfile
+import zlib
 from functools import wraps
 from io import BytesIO
 
 import mohawk
+import winsign.pefile
 import winsign.sign
-from mardor.reader import MarReader
-from mardor.writer import add_signature_block
-from scriptworker.utils import get_single_item_from_sequence, makedirs, raise_future_exceptions, retry_async, rm
+from mardor.format import extras_header, index_header, mar, mar_header
+from mardor.signing import make_hasher, verify_signature
+from scriptworker.utils import get_single_item_from_sequence, makedirs, raise_future_exceptions, retry_async, rm, semaphore_wrapper
+from scriptworker_client.autograph import read_streamed_response
+from scriptworker_client.exceptions import AutographResponseError
 from winsign.crypto import load_pem_certs
 
-from signingscript import task, utils
-from signingscript.createprecomplete import generate_precomplete
+from signingscript import metrics, task, utils, workspace
+from signingscript.createprecomplete import (
+    get_build_entries_from_paths,
+    get_precomplete_contents,
+    get_precomplete_root,
+)
 from signingscript.exceptions import SigningScriptError
+from signingscript.metrics import get_rss
+from signingscript.notarization_journal import ACCEPTED, STAPLED, SUBMITTED, NotarizationJournal
 from signingscript.rcodesign import RCodesignError, rcodesign_notarize, rcodesign_notary_wait, rcodesign_staple
 
 log = logging.getLogger(__name__)
@@ -47,8 +60,9 @@ except ImportError:
 
 sys.path.append(os.path.abspath(os.path.join(os.path.realpath(os.path.dirname(__file__)), "vendored", "mozbuild")))  # append the mozbuild vendor
 
-from mozbuild.action.tooltool import safe_extract  # noqa  # isort:skip
+from mozbuild.action.tooltool import safe_extract, validate_tar_member  # noqa  # isort:skip
 from mozpack import mozjar  # noqa  # isort:skip
+from mozpack import path as mozpath  # noqa  # isort:skip
 
 # These files load the Widevine CDM and therefore need a .sig file to be
 # generated.
@@ -101,10 +115,15 @@ _DEFAULT_MAR_VERIFY_KEYS = {
 # Langpacks expect the following re to match for addon id
 LANGPACK_RE = re.compile(r"^langpack-[a-zA-Z]+(?:-[a-zA-Z]+){0,2}@(?:firefox|devedition).mozilla.org$")
 
-
-def get_rss():
-    """Return the maximum resident set size for this process."""
-    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# Read files to sign in big blocks; a multiple of 3 so each block base64
+# encodes without padding.
+_ENCODE_BLOCK_SIZE = 3 * 256 * 1024
+# Requests bigger than this aren't copied to a temporary file before sending
+_SPOOL_MAX_SIZE = 32 * 1024 * 1024
+# The response keys holding whole signed files, per autograph method
+_STREAMED_RESPONSE_KEYS = {"file": {"signed_file"}, "files": {"content"}}
+# Block size for copying archive members around
+_COPY_BLOCK_SIZE = 1024 * 1024
 
 
 def time_async_function(f):
@@ -118,7 +137,9 @@ def time_async_function(f):
             return await f(*args, **kwargs)
         finally:
             rss = get_rss()
-            log.debug("%s took %.2fs; RSS:%s (%+d)", f.__name__, time.time() - start, rss, rss - start_rss)
+            duration = time.time() - start
+            log.debug("%s took %.2fs; RSS:%s (%+d)", f.__name__, duration, rss, rss - start_rss)
+            metrics.record_function(f.__name__, duration, rss - start_rss)
 
     return wrapped
 
@@ -134,7 +155,9 @@ def time_function(f):
             return f(*args, **kwargs)
         finally:
             rss = get_rss()
-            log.debug("%s took %.2fs; RSS:%s (%+d)", f.__name__, time.time() - start, rss, rss - start_rss)
+            duration = time.time() - start
+            log.debug("%s took %.2fs; RSS:%s (%+d)", f.__name__, duration, rss, rss - start_rss)
+            metrics.record_function(f.__name__, duration, rss - start_rss)
 
     return wrapped
 
@@ -294,31 +317,30 @@ async def sign_widevine_zip(context, orig_path, fmt):
         str: the path to the signed archive
 
     """
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_widevine`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="wvzip", dir=context.config["work_dir"])
+    # This will get cleaned up when we nuke `work_dir`, or once this artifact
+    # is done if eager workspace reclamation is on (see `workspace`).
+    tmp_dir = workspace.mkdtemp("wvzip", context.config["work_dir"])
     # Get file list
     all_files = await _get_zipfile_files(orig_path)
     files_to_sign = _get_widevine_signing_files(all_files)
     log.debug("Widevine files to sign: %s", files_to_sign)
     if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_zipfile(context, orig_path, tmp_dir=tmp_dir)
+        sigfiles = {from_: f"{from_}.sig" for from_ in files_to_sign}
+        # Regenerate the `precomplete` file, which is used for cleanup before
+        # applying a complete mar, from the member list plus the sigfiles.
+        precomplete_name, precomplete = _get_zip_precomplete(all_files, sigfiles.values())
+        # Only extract the files we change; the rest of the members are
+        # copied over as they are by `_rewrite_zipfile`
+        extracted = await _extract_zipfile(context, orig_path, files=[*files_to_sign, precomplete_name], tmp_dir=tmp_dir)
         tasks = []
         # Sign the appropriate inner files
         for from_, blessed in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            to = f"{from_}.sig"
-            tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, from_, blessed, fmt, to=to)))
-            all_files.append(to)
+            to = os.path.join(tmp_dir, sigfiles[from_])
+            tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, os.path.join(tmp_dir, from_), blessed, fmt, to=to)))
+            extracted.append(to)
         await raise_future_exceptions(tasks)
-        remove_extra_files(tmp_dir, all_files)
-        # Regenerate the `precomplete` file, which is used for cleanup before
-        # applying a complete mar.
-        _run_generate_precomplete(context, tmp_dir)
-        await _create_zipfile(context, orig_path, all_files, mode="w", tmp_dir=tmp_dir)
+        _write_precomplete(context, os.path.join(tmp_dir, precomplete_name), precomplete)
+        await _rewrite_zipfile(context, orig_path, extracted, tmp_dir=tmp_dir)
     return orig_path
 
 
@@ -327,10 +349,10 @@ async def sign_widevine_zip(context, orig_path, fmt):
 async def sign_widevine_tar(context, orig_path, fmt):
     """Sign the internals of a tarfile with the widevine key.
 
-    Extract the entire tarball, but only sign a handful of files (see
-    `_WIDEVINE_BLESSED_FILENAMES` and `_WIDEVINE_UNBLESSED_FILENAMES).
-    The blessed files should be signed with the `widevine_blessed` format.
-    Then recreate the tarball.
+    Only extract and sign a handful of files (see `_WIDEVINE_BLESSED_FILENAMES`
+    and `_WIDEVINE_UNBLESSED_FILENAMES). The blessed files should be signed
+    with the `widevine_blessed` format. Then rewrite the tarball in a single
+    streaming pass, with a regenerated `precomplete` and the sigfiles added.
 
     Ideally we would be able to append the sigfiles to the original tarball,
     but that's not possible with compressed tarballs.
@@ -345,37 +367,35 @@ async def sign_widevine_tar(context, orig_path, fmt):
 
     """
     _, compression = os.path.splitext(orig_path)
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_widevine`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="wvtar", dir=context.config["work_dir"])
+    # This will get cleaned up when we nuke `work_dir`, or once this artifact
+    # is done if eager workspace reclamation is on (see `workspace`).
+    tmp_dir = workspace.mkdtemp("wvtar", context.config["work_dir"])
     # Get file list
-    all_files = await _get_tarfile_files(orig_path, compression)
+    tar_members = await _get_tarfile_members(orig_path, compression)
+    all_files = [m.name for m in tar_members if m.isfile()]
     files_to_sign = _get_widevine_signing_files(all_files)
     log.debug("Widevine files to sign: %s", files_to_sign)
     if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_tarfile(context, orig_path, compression, tmp_dir=tmp_dir)
+        # Move the sig location on mac. This should be noop on linux.
+        sigfiles = {from_: _get_mac_sigpath(os.path.join(tmp_dir, from_)) for from_ in files_to_sign}
+        log.debug("Sigfile paths: %s", sigfiles)
+        # Regenerate the `precomplete` file, which is used for cleanup before
+        # applying a complete mar, from the member list plus the sigfiles.
+        precomplete_name, precomplete = _get_tar_precomplete(tar_members, [os.path.relpath(to, tmp_dir) for to in sigfiles.values()])
+
+        # Only extract the files we change; the rest of the members are
+        # streamed over as they are by `_rewrite_tarfile`
+        await _extract_tarfile(context, orig_path, compression, tmp_dir=tmp_dir, files=[*files_to_sign, precomplete_name])
         tasks = []
         # Sign the appropriate inner files
         for from_, blessed in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            # Don't try to sign directories
-            if not os.path.isfile(from_):
-                continue
-            # Move the sig location on mac. This should be noop on linux.
-            to = _get_mac_sigpath(from_)
-            log.debug("Adding %s to the sigfile paths...", to)
+            to = sigfiles[from_]
             makedirs(os.path.dirname(to))
-            tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, from_, blessed, fmt, to=to)))
-            all_files.append(to)
+            tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, os.path.join(tmp_dir, from_), blessed, fmt, to=to)))
         await raise_future_exceptions(tasks)
-        remove_extra_files(tmp_dir, all_files)
-        # Regenerate the `precomplete` file, which is used for cleanup before
-        # applying a complete mar.
-        _run_generate_precomplete(context, tmp_dir)
-        await _create_tarfile(context, orig_path, all_files, compression, tmp_dir=tmp_dir)
+        precomplete_path = os.path.join(tmp_dir, precomplete_name)
+        _write_precomplete(context, precomplete_path, precomplete)
+        await _rewrite_tarfile(context, orig_path, compression, all_files, [precomplete_path], append_files=list(sigfiles.values()), tmp_dir=tmp_dir)
     return orig_path
 
 
@@ -430,23 +450,23 @@ async def sign_omnija_zip(context, orig_path, fmt):
         str: the path to the signed archive
 
     """
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_omnija`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="ojzip", dir=context.config["work_dir"])
+    # This will get cleaned up when we nuke `work_dir`, or once this artifact
+    # is done if eager workspace reclamation is on (see `workspace`).
+    tmp_dir = workspace.mkdtemp("ojzip", context.config["work_dir"])
     # Get file list
     all_files = await _get_zipfile_files(orig_path)
     files_to_sign = _get_omnija_signing_files(all_files)
     log.debug("Omnija files to sign: %s", files_to_sign)
     if files_to_sign:
-        all_files = await _extract_zipfile(context, orig_path, tmp_dir=tmp_dir)
+        # Only the omni.ja files need to be on disk; the rest of the members
+        # are copied over as-is
+        extracted_files = await _extract_zipfile(context, orig_path, files=list(files_to_sign), tmp_dir=tmp_dir)
         tasks = []
         # Sign the appropriate inner files
-        for from_, _ in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
+        for from_ in extracted_files:
             tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, from_, fmt)))
         await raise_future_exceptions(tasks)
-        await _create_zipfile(context, orig_path, all_files, mode="w", tmp_dir=tmp_dir)
+        await _rewrite_zipfile(context, orig_path, extracted_files, tmp_dir=tmp_dir)
     return orig_path
 
 
@@ -457,7 +477,8 @@ async def sign_omnija_tar(context, orig_path, fmt):
 
     Extract the files to sign, then sign them with autograph, recreating the omni.ja
     from the original to preserve performance tweeks but adding signing info.
-    Then recreate the tarball.
+    The omni.ja files are signed concurrently, then swapped in while the
+    tarball is rewritten in a single streaming pass.
 
     Args:
         context (Context): the signing context
@@ -469,28 +490,22 @@ async def sign_omnija_tar(context, orig_path, fmt):
 
     """
     _, compression = os.path.splitext(orig_path)
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_widevine`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="ojtar", dir=context.config["work_dir"])
+    # This will get cleaned up when we nuke `work_dir`, or once this artifact
+    # is done if eager workspace reclamation is on (see `workspace`).
+    tmp_dir = workspace.mkdtemp("ojtar", context.config["work_dir"])
     # Get file list
     all_files = await _get_tarfile_files(orig_path, compression)
     files_to_sign = _get_omnija_signing_files(all_files)
     log.debug("Omnija files to sign: %s", files_to_sign)
     if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_tarfile(context, orig_path, compression, tmp_dir=tmp_dir)
+        # Only extract the omni.ja files; the rest of the members are
+        # streamed over as they are by `_rewrite_tarfile`
+        extracted_files = await _extract_tarfile(context, orig_path, compression, tmp_dir=tmp_dir, files=list(files_to_sign))
         tasks = []
-        # Sign the appropriate inner files
-        for from_, _ in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            # Don't try to sign directories
-            if not os.path.isfile(from_):
-                continue
+        for from_ in extracted_files:
             tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, from_, fmt)))
         await raise_future_exceptions(tasks)
-        await _create_tarfile(context, orig_path, all_files, compression, tmp_dir=tmp_dir)
+        await _rewrite_tarfile(context, orig_path, compression, all_files, extracted_files, tmp_dir=tmp_dir)
     return orig_path
 
 
@@ -584,57 +599,181 @@ def _get_omnija_signing_files(file_list):
     return files
 
 
-# _run_generate_precomplete {{{1
-def _run_generate_precomplete(context, tmp_dir):
-    """Regenerate `precomplete` file with widevine sig paths for complete mar."""
+# _write_precomplete {{{1
+def _write_precomplete(context, path, precomplete):
+    """Replace the `precomplete` file at `path`, and write the diff to `public/logs`."""
     log.info("Generating `precomplete` file...")
-    path = _ensure_one_precomplete(tmp_dir, "before")
     with open(path, "r") as fh:
         before = fh.readlines()
-    generate_precomplete(os.path.dirname(path))
-    path = _ensure_one_precomplete(tmp_dir, "after")
-    with open(path, "r") as fh:
-        after = fh.readlines()
-    # Create diff file
-    diff_path = os.path.join(context.config["work_dir"], "precomplete.diff")
-    with open(diff_path, "w") as fh:
-        for line in difflib.ndiff(before, after):
-            fh.write(line)
+    with open(path, "wb") as fh:
+        fh.write(precomplete)
+    _write_precomplete_diff(context, before, precomplete.decode("utf-8").splitlines(keepends=True))
+
+
+# _write_precomplete_diff {{{1
+def _iter_line_diff(before, after):
+    """Yield the lines of `before` and `after` prefixed like `difflib.ndiff`, in linear time.
+
+    `difflib.ndiff` is quadratic, which is slow for the thousands of mostly
+    identical lines of a full install. This walks both lists in step instead:
+    lines that only exist on one side are removed or added, and lines that
+    moved are shown as removed then added, rather than searching for the
+    longest common subsequence.
+    """
+    before_set = set(before)
+    i = j = 0
+    while i < len(before) and j < len(after):
+        if before[i] == after[j]:
+            yield f"  {after[j]}"
+            i += 1
+            j += 1
+        elif after[j] not in before_set:
+            yield f"+ {after[j]}"
+            j += 1
+        else:
+            # before[i] was removed, or moved further down
+            yield f"- {before[i]}"
+            i += 1
+    for line in before[i:]:
+        yield f"- {line}"
+    for line in after[j:]:
+        yield f"+ {line}"
+
+
+def _write_precomplete_diff(context, before, after):
+    """Write the diff between the `before` and `after` precomplete lines to `public/logs`."""
+    # Artifacts are signed concurrently, so each diff needs its own path in work_dir
+    fd, diff_path = tempfile.mkstemp(prefix="precomplete", suffix=".diff", dir=context.config["work_dir"])
+    with os.fdopen(fd, "w") as fh:
+        fh.writelines(_iter_line_diff(before, after))
     utils.copy_to_dir(diff_path, context.config["artifact_dir"], target="public/logs/precomplete.diff")
+    os.remove(diff_path)
 
 
-# _ensure_one_precomplete {{{1
-def _ensure_one_precomplete(tmp_dir, adj):
-    """Ensure we only have one `precomplete` file in `tmp_dir`."""
-    return get_single_item_from_sequence(
-        glob.glob(os.path.join(tmp_dir, "**", "precomplete"), recursive=True),
+# _get_tar_precomplete {{{1
+def _resolve_tar_symlink(name, symlinks):
+    """Return the normalized path a tar symlink points to, following symlink chains."""
+    seen = set()
+    while name in symlinks and name not in seen:
+        seen.add(name)
+        name = os.path.normpath(os.path.join(os.path.dirname(name), symlinks[name]))
+    return name
+
+
+def _get_precomplete_from_paths(files, dirs, archive_type):
+    """Regenerate the `precomplete` file of an archive from the normalized paths of its members.
+
+    Args:
+        files (set): the paths of the files in the archive
+        dirs (set): the paths of the directories in the archive
+        archive_type (str): the kind of archive, for error messages
+
+    Returns:
+        tuple: the name of the `precomplete` member and its new contents
+
+    Raises:
+        SigningScriptError: if there isn't exactly one `precomplete` file
+
+    """
+    precomplete_name = get_single_item_from_sequence(
+        [f for f in files if os.path.basename(f) == "precomplete"],
         condition=lambda _: True,
         ErrorClass=SigningScriptError,
-        no_item_error_message='No `precomplete` file found in "{}"'.format(tmp_dir),
-        too_many_item_error_message='More than one `precomplete` file {} in "{}"'.format(adj, tmp_dir),
+        no_item_error_message=f"No `precomplete` file found in the {archive_type}",
+        too_many_item_error_message=f"More than one `precomplete` file in the {archive_type}",
+    )
+    root, _ = get_precomplete_root(os.path.dirname(precomplete_name))
+    root = "" if root == "." else root
+    prefix = f"{root}/" if root else ""
+    rel_file_path_list, rel_dir_path_list = get_build_entries_from_paths(
+        [f[len(prefix) :] for f in files if f.startswith(prefix)],
+        [d[len(prefix) :] for d in dirs if d.startswith(prefix)],
     )
+    return precomplete_name, get_precomplete_contents(rel_file_path_list, rel_dir_path_list)
 
 
-# remove_extra_files {{{1
-def remove_extra_files(top_dir, file_list):
-    """Find any extra files in `top_dir`, given an expected `file_list`.
+def _add_parent_dirs(paths, dirs):
+    """Add the parent directories of `paths` that aren't archive members themselves to `dirs`."""
+    for name in paths:
+        parent = os.path.dirname(name)
+        while parent and parent not in dirs:
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+
+
+def _get_tar_precomplete(members, extra_files=()):
+    """Regenerate the `precomplete` file of a tarball from its member list.
+
+    This matches running `generate_precomplete` on the extracted tarball,
+    without having to extract it.
 
     Args:
-        top_dir (str): the dir to walk
-        file_list (list): the list of expected files
+        members (list): the `TarInfo` objects of the tarball
+        extra_files (list): the relative paths of files that will be added
+            to the tarball, e.g. widevine sigfiles
 
     Returns:
-        list: the list of extra files
+        tuple: the name of the `precomplete` member and its new contents
+
+    Raises:
+        SigningScriptError: if there isn't exactly one `precomplete` file
 
     """
-    all_files = [os.path.realpath(f) for f in glob.glob(os.path.join(top_dir, "**", "*"), recursive=True)]
-    good_files = [os.path.realpath(f) for f in file_list]
-    extra_files = list(set(all_files) - set(good_files))
-    for f in extra_files:
-        if os.path.isfile(f):
-            log.warning("Extra file to clean up: {}".format(f))
-            rm(f)
-    return extra_files
+    files = set()
+    dirs = set()
+    symlinks = {}
+    for member in members:
+        name = os.path.normpath(member.name)
+        if name == ".":
+            continue
+        if member.isdir():
+            dirs.add(name)
+        elif member.issym():
+            symlinks[name] = member.linkname
+        else:
+            files.add(name)
+    files.update(os.path.normpath(f) for f in extra_files)
+    _add_parent_dirs(list(files) + list(dirs) + list(symlinks), dirs)
+    for name in symlinks:
+        # os.walk lists symlinks to directories as directories
+        if _resolve_tar_symlink(name, symlinks) in dirs:
+            dirs.add(name)
+        else:
+            files.add(name)
+    return _get_precomplete_from_paths(files, dirs, "tarball")
+
+
+# _get_zip_precomplete {{{1
+def _get_zip_precomplete(names, extra_files=()):
+    """Regenerate the `precomplete` file of a zipfile from its member names.
+
+    This matches running `generate_precomplete` on the extracted zipfile,
+    without having to extract it. `zipfile` extracts symlinks as regular
+    files, so they're listed as files.
+
+    Args:
+        names (list): the member names of the zipfile
+        extra_files (list): the relative paths of files that will be added
+            to the zipfile, e.g. widevine sigfiles
+
+    Returns:
+        tuple: the name of the `precomplete` member and its new contents
+
+    Raises:
+        SigningScriptError: if there isn't exactly one `precomplete` file
+
+    """
+    files = set()
+    dirs = set()
+    for name in names:
+        is_dir = name.endswith("/")
+        name = os.path.normpath(name)
+        if name == ".":
+            continue
+        (dirs if is_dir else files).add(name)
+    files.update(os.path.normpath(f) for f in extra_files)
+    _add_parent_dirs(list(files) + list(dirs), dirs)
+    return _get_precomplete_from_paths(files, dirs, "zipfile")
 
 
 # _convert_dmg_to_tar_gz {{{1
@@ -694,19 +833,109 @@ async def _extract_zipfile(context, from_, files=None, tmp_dir=None):
         raise SigningScriptError(e)
 
 
-# _create_zipfile {{{1
+# _rewrite_zipfile {{{1
+def _strip_zip64_extra(extra):
+    """Remove any zip64 extra field from `extra`; `ZipInfo.FileHeader` adds its own."""
+    stripped = b""
+    i = 0
+    while i + 4 <= len(extra):
+        field_id, field_len = struct.unpack("<HH", extra[i : i + 4])
+        if field_id != 0x0001:
+            stripped += extra[i : i + 4 + field_len]
+        i += 4 + field_len
+    return stripped
+
+
+def _copy_raw_zip_member(zin, zout, info):
+    """Copy the compressed data of `info` from `zin` to `zout` without recompressing it."""
+    zin.fp.seek(info.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, zin.fp.read(zipfile.sizeFileHeader))
+    # Skip the filename and extra field of the original local header
+    zin.fp.seek(fheader[10] + fheader[11], os.SEEK_CUR)
+    new_info = copy.copy(info)
+    # We know the sizes and crc up front, so write them in the local header
+    # rather than in a trailing data descriptor
+    new_info.flag_bits &= ~0x08
+    new_info.extra = _strip_zip64_extra(info.extra)
+    new_info.header_offset = zout.fp.tell()
+    zout.fp.write(new_info.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        block = zin.fp.read(min(remaining, _COPY_BLOCK_SIZE))
+        if not block:
+            raise SigningScriptError(f"Truncated zip member {info.filename}")
+        zout.fp.write(block)
+        remaining -= len(block)
+    zout.filelist.append(new_info)
+    zout.NameToInfo[new_info.filename] = new_info
+    zout.start_dir = zout.fp.tell()
+    zout._didModify = True
+
+
+def _zip_member_changed(info, path):
+    """Return True if the file at `path` differs from the zip member `info`."""
+    if os.path.getsize(path) != info.file_size:
+        return True
+    crc = 0
+    with open(path, "rb") as fh:
+        while block := fh.read(_COPY_BLOCK_SIZE):
+            crc = zlib.crc32(block, crc)
+    return crc != info.CRC
+
+
 @time_async_function
-async def _create_zipfile(context, to, files, tmp_dir=None, mode="w"):
+async def _rewrite_zipfile(context, from_, files, tmp_dir=None, to=None):
+    """Rewrite a zipfile, only recompressing the members that changed.
+
+    Members of `from_` that aren't in `files`, or that are byte for byte the
+    same as their extracted copy, keep their original compressed data. The
+    rest are deflated from `tmp_dir`, and any of `files` that aren't members
+    of `from_` yet (e.g. widevine sigfiles) are appended.
+
+    Args:
+        context (Context): the signing context
+        from_ (str): the original zipfile
+        files (list): the absolute paths of the extracted or added files
+        tmp_dir (str, optional): the directory `files` are relative to.
+            Defaults to `work_dir/unzipped`
+        to (str, optional): the zipfile to write. Defaults to `from_`
+
+    Returns:
+        str: the path to the rewritten zipfile
+
+    Raises:
+        SigningScriptError: on failure
+
+    """
     work_dir = context.config["work_dir"]
     tmp_dir = tmp_dir or os.path.join(work_dir, "unzipped")
+    to = to or from_
+    on_disk = {os.path.relpath(f, tmp_dir): f for f in files if os.path.isfile(f)}
+    fd, tmp_path = tempfile.mkstemp(prefix="rezip", suffix=".zip", dir=os.path.dirname(os.path.abspath(to)))
+    os.close(fd)
     try:
-        log.info("Creating zipfile {}...".format(to))
-        with zipfile.ZipFile(to, mode=mode, compression=zipfile.ZIP_DEFLATED) as z:
-            for f in files:
-                relpath = os.path.relpath(f, tmp_dir)
-                z.write(f, arcname=relpath)
+        log.info("Rewriting zipfile {}...".format(to))
+        recompressed = 0
+        with zipfile.ZipFile(from_, mode="r") as zin, zipfile.ZipFile(tmp_path, mode="w", compression=zipfile.ZIP_DEFLATED) as zout:
+            for info in zin.infolist():
+                path = on_disk.pop(info.filename, None)
+                if path is None or not _zip_member_changed(info, path):
+                    _copy_raw_zip_member(zin, zout, info)
+                    continue
+                new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                new_info.external_attr = info.external_attr
+                new_info.compress_type = zipfile.ZIP_DEFLATED
+                new_info.file_size = os.path.getsize(path)
+                with open(path, "rb") as src, zout.open(new_info, mode="w") as dst:
+                    shutil.copyfileobj(src, dst, _COPY_BLOCK_SIZE)
+                recompressed += 1
+            for relpath, path in on_disk.items():
+                zout.write(path, arcname=relpath)
+        log.debug("Recompressed %d and appended %d members of %s", recompressed, len(on_disk), to)
+        _replace_file(tmp_path, to)
         return to
     except Exception as e:
+        rm(tmp_path)
         raise SigningScriptError(e)
 
 
@@ -719,6 +948,14 @@ def _get_tarfile_compression(compression):
     return compression
 
 
+# _get_tarfile_members {{{1
+@time_async_function
+async def _get_tarfile_members(from_, compression):
+    compression = _get_tarfile_compression(compression)
+    with tarfile.open(from_, mode="r:{}".format(compression)) as t:
+        return t.getmembers()
+
+
 # _get_tarfile_files {{{1
 @time_async_function
 async def _get_tarfile_files(from_, compression):
@@ -729,21 +966,40 @@ async def _get_tarfile_files(from_, compression):
 
 
 # _extract_tarfile {{{1
+def _extract_tarfile_members(from_, compression, files, tmp_dir):
+    """Extract the members named in `files` from a tarball in a single streaming pass."""
+    wanted = {os.path.normpath(f) for f in files}
+    extracted = []
+    with tarfile.open(from_, mode="r:{}".format(compression)) as t:
+        for member in t:
+            if os.path.normpath(member.name) not in wanted:
+                continue
+            validate_tar_member(member, tmp_dir)
+            t.extract(member, path=tmp_dir)
+            extracted.append(os.path.join(tmp_dir, os.path.normpath(member.name)))
+            if len(extracted) == len(wanted):
+                break
+    return extracted
+
+
 @time_async_function
-async def _extract_tarfile(context, from_, compression, tmp_dir=None):
+async def _extract_tarfile(context, from_, compression, tmp_dir=None, files=None):
     work_dir = context.config["work_dir"]
     tmp_dir = tmp_dir or os.path.join(work_dir, "untarred")
     compression = _get_tarfile_compression(compression)
     try:
-        files = []
+        files_ = []
         rm(tmp_dir)
         utils.mkdir(tmp_dir)
+        if files is not None:
+            log.debug("Extracting {} from {} to {}...".format(files, from_, tmp_dir))
+            return await asyncio.get_running_loop().run_in_executor(None, _extract_tarfile_members, from_, compression, files, tmp_dir)
         with tarfile.open(from_, mode="r:{}".format(compression)) as t:
             safe_extract(t, path=tmp_dir)
             for name in t.getnames():
                 path = os.path.join(tmp_dir, name)
-                os.path.isfile(path) and files.append(path)
-        return files
+                os.path.isfile(path) and files_.append(path)
+        return files_
     except Exception as e:
         raise SigningScriptError(e)
 
@@ -758,16 +1014,68 @@ def _owner_filter(tarinfo_obj):
     return tarinfo_obj
 
 
-def _create_xz_tarfile(to, files, rel_dir):
-    """Creates an xz tarball with max compression"""
+@contextlib.contextmanager
+def _open_xz_tarfile(to):
+    """Open an xz tarball for writing with max compression."""
     filters = [
         {"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME},
     ]
     with lzma.open(to, "wb", filters=filters) as dest, tarfile.open(mode="w|", fileobj=dest) as tf:
-        for f in files:
-            relpath = os.path.relpath(f, rel_dir)
-            tf.add(f, arcname=relpath, filter=_owner_filter)
-    return to
+        yield tf
+
+
+def _get_parallel_compressor(compression, threads):
+    """Return the command to compress stdin with `threads` threads, or None.
+
+    The commands use the same compression levels as the single-threaded
+    python implementations, and write standard (multi-block or multi-stream)
+    gz/bz2/xz files that any decompressor can read.
+    """
+    if compression == "gz":
+        command = ["pigz", "-9", "-p", str(threads)]
+    elif compression == "bz2":
+        command = ["pbzip2", "-9", f"-p{threads}"]
+    else:
+        command = ["xz", "-9e", f"-T{threads}"]
+    if not shutil.which(command[0]):
+        log.warning("%s not found; falling back to single-threaded %s compression", command[0], compression)
+        return None
+    return command + ["-c"]
+
+
+@contextlib.contextmanager
+def _open_piped_tarfile(to, command):
+    """Open a tarball for writing, compressing it with `command`."""
+    with open(to, "wb") as dest:
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=dest)
+        try:
+            with tarfile.open(mode="w|", fileobj=proc.stdin) as tf:
+                yield tf
+            proc.stdin.close()
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        if proc.wait() != 0:
+            raise SigningScriptError("Command `{}` failed with exit code {}".format(" ".join(command), proc.returncode))
+
+
+def _open_tarfile_for_writing(context, to, compression):
+    """Open a tarball for writing with the given compression.
+
+    If `tarball_compression_threads` is set to more than one thread (or 0 for
+    one thread per cpu), compress with pigz, pbzip2 or xz when they're
+    installed. Otherwise compress in process on a single thread.
+    """
+    threads = context.config.get("tarball_compression_threads", 1)
+    if threads == 0:
+        threads = os.cpu_count()
+    command = threads > 1 and _get_parallel_compressor(compression, threads)
+    if command:
+        return _open_piped_tarfile(to, command)
+    if compression == "xz":
+        return _open_xz_tarfile(to)
+    return tarfile.open(to, mode="w:{}".format(compression))
 
 
 # _create_tarfile {{{1
@@ -778,10 +1086,7 @@ async def _create_tarfile(context, to, files, compression, tmp_dir=None):
     compression = _get_tarfile_compression(compression)
     try:
         log.info("Creating tarfile {}...".format(to))
-        if compression == "xz":
-            return _create_xz_tarfile(to, files, tmp_dir)
-
-        with tarfile.open(to, mode="w:{}".format(compression)) as t:
+        with _open_tarfile_for_writing(context, to, compression) as t:
             for f in files:
                 relpath = os.path.relpath(f, tmp_dir)
                 t.add(f, arcname=relpath, filter=_owner_filter)
@@ -790,93 +1095,329 @@ async def _create_tarfile(context, to, files, compression, tmp_dir=None):
         raise SigningScriptError(e)
 
 
-def _encode_single_file(fp, signing_req):
-    """Write signing_req for a single file to fp.
-
-    Does proper base64 and json encoding.
-    Tries not to hold onto a lot of memory.
-    """
-    fp.write(b"[{")
-    for k, v in signing_req.items():
-        fp.write(json.dumps(k).encode("utf8"))
-        fp.write(b":")
-        if hasattr(v, "read"):
-            # Make sure we're always reading from the beginning of the file
-            # Sometimes we have to retry the request
-            v.seek(0)
-            fp.write(b'"')
-            while True:
-                block = v.read(1020)
-                if not block:
-                    break
-                e = b64encode(block).encode("utf8")
-                fp.write(e)
-            fp.write(b'"')
-        else:
-            fp.write(json.dumps(v).encode("utf8"))
-        fp.write(b",")
-    fp.seek(-1, 1)
-    fp.write(b"}]")
+# _rewrite_tarfile {{{1
+def _rewrite_tarfile_members(context, from_, to, compression, all_files, replace_files, append_files, tmp_dir):
+    """Stream the members of `from_` to `to`, swapping in `replace_files`; see `_rewrite_tarfile`."""
+    regular_files = {os.path.normpath(f) for f in all_files}
+    replace = {os.path.normpath(os.path.relpath(f, tmp_dir)): f for f in replace_files}
+    symlinks = {}
+    with tarfile.open(from_, mode="r:{}".format(compression)) as src, _open_tarfile_for_writing(context, to, compression) as dst:
+        for member in src:
+            name = os.path.normpath(member.name)
+            if name in replace:
+                path = replace[name]
+                with open(path, "rb") as fh:
+                    dst.addfile(_owner_filter(dst.gettarinfo(path, arcname=name)), fh)
+                continue
+            if member.isdir():
+                continue
+            if member.issym():
+                symlinks[name] = member.linkname
+                # `_create_tarfile` only gets passed paths that are
+                # files, i.e. symlinks to regular files
+                if _resolve_tar_symlink(name, symlinks) not in regular_files:
+                    continue
+            elif not member.isreg() and not member.islnk():
+                continue
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.type = tarfile.REGTYPE if member.isreg() else member.type
+            tarinfo.mode = member.mode
+            tarinfo.mtime = member.mtime
+            if member.islnk():
+                tarinfo.linkname = os.path.normpath(member.linkname)
+            elif member.issym():
+                tarinfo.linkname = member.linkname
+                tarinfo.mode = 0o777
+            else:
+                tarinfo.size = member.size
+            dst.addfile(_owner_filter(tarinfo), src.extractfile(member) if member.isreg() else None)
+        for f in append_files:
+            dst.add(f, arcname=os.path.relpath(f, tmp_dir), filter=_owner_filter)
 
 
-def write_signing_req_to_disk(fp, signing_req):
-    """Write signing_req to fp.
+@time_async_function
+async def _rewrite_tarfile(context, from_, compression, all_files, replace_files=(), append_files=(), tmp_dir=None):
+    """Rewrite a tarball in a single streaming pass.
+
+    The members are streamed from `from_` to the new tarball, so the tarball
+    is never fully extracted to disk. The output matches `_create_tarfile` on
+    the extracted tarball: directories are skipped, names are normalized
+    and ownership goes through `_owner_filter`. The streaming runs in an
+    executor, so it doesn't block the event loop.
+
+    Args:
+        context (Context): the signing context
+        from_ (str): the tarball to rewrite in place
+        compression (str): the compression format of the tarball
+        all_files (list): the names of the regular file members, as returned
+            by `_get_tarfile_files`
+        replace_files (list): the absolute paths of files under `tmp_dir`
+            that replace the members of the same name, e.g. signed files
+            extracted with `_extract_tarfile`
+        append_files (list): the absolute paths of files under `tmp_dir`
+            to add to the end of the tarball
+        tmp_dir (str, optional): the directory `replace_files` and
+            `append_files` are relative to. Defaults to `work_dir/untarred`
+
+    Returns:
+        str: the path to the rewritten tarball
+
+    Raises:
+        SigningScriptError: on failure
 
-    Does proper base64 and json encoding.
-    Tries not to hold onto a lot of memory.
     """
-    if "files" in signing_req:
-        _encode_multiple_files(fp, signing_req)
-    else:
-        _encode_single_file(fp, signing_req)
+    work_dir = context.config["work_dir"]
+    tmp_dir = tmp_dir or os.path.join(work_dir, "untarred")
+    compression = _get_tarfile_compression(compression)
+    fd, tmp_path = tempfile.mkstemp(prefix="retar", suffix=f".tar.{compression}", dir=os.path.dirname(os.path.abspath(from_)))
+    os.close(fd)
+    try:
+        log.info("Rewriting tarfile {}...".format(from_))
+        await asyncio.get_running_loop().run_in_executor(
+            None, _rewrite_tarfile_members, context, from_, tmp_path, compression, all_files, replace_files, append_files, tmp_dir
+        )
+        _replace_file(tmp_path, from_)
+        return from_
+    except Exception as e:
+        rm(tmp_path)
+        if isinstance(e, SigningScriptError):
+            raise
+        raise SigningScriptError(e)
 
 
-def _encode_multiple_files(fp, signing_req):
-    """Write signing_req to fp.
+# _transcode_tarfile_to_zipfile {{{1
+@time_async_function
+async def _transcode_tarfile_to_zipfile(context, from_, compression, to):
+    """Repack a tarball as a zipfile in a single streaming pass.
+
+    Each member is read from the tarball and deflated straight into the
+    zipfile, so the tarball is never extracted to disk. The output matches
+    extracting the tarball and zipping up the extracted files: directories
+    are skipped, names are normalized, and symlinks and hardlinks to files
+    are stored as copies of their target. Permissions and modification times
+    are kept.
+
+    Args:
+        context (Context): the signing context
+        from_ (str): the tarball to repack
+        compression (str): the compression format of the tarball
+        to (str): the zipfile to write
+
+    Returns:
+        str: the path to the zipfile
+
+    Raises:
+        SigningScriptError: on failure
+
+    """
+    compression = _get_tarfile_compression(compression)
+    try:
+        log.info("Transcoding tarfile {} to zipfile {}...".format(from_, to))
+        files = {}
+        symlinks = {}
+        # Links to files later in the tarball, by the name of their target
+        pending = {}
+        with tarfile.open(from_, mode="r:{}".format(compression)) as src, zipfile.ZipFile(to, mode="w", compression=zipfile.ZIP_DEFLATED) as dst:
+
+            def add(name, target):
+                # Zip timestamps start in 1980
+                info = zipfile.ZipInfo(name, date_time=time.gmtime(max(target.mtime, 315532800))[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = (stat.S_IFREG | (target.mode & 0o7777)) << 16
+                info.file_size = target.size
+                with src.extractfile(target) as fh, dst.open(info, mode="w") as out:
+                    shutil.copyfileobj(fh, out, _COPY_BLOCK_SIZE)
+
+            for member in src:
+                validate_tar_member(member, os.path.dirname(os.path.abspath(to)))
+                name = os.path.normpath(member.name)
+                if member.isreg():
+                    files[name] = member
+                    add(name, member)
+                    for link_name in pending.pop(name, []):
+                        add(link_name, member)
+                    continue
+                if member.issym():
+                    symlinks[name] = member.linkname
+                    target_name = _resolve_tar_symlink(name, symlinks)
+                elif member.islnk():
+                    target_name = os.path.normpath(member.linkname)
+                else:
+                    continue
+                if target_name in files:
+                    add(name, files[target_name])
+                else:
+                    pending.setdefault(target_name, []).append(name)
+        # Whatever is left points to directories, or nowhere
+        for target_name, links in pending.items():
+            log.debug("Skipping links to %s, which isn't a file: %s", target_name, ", ".join(links))
+        return to
+    except Exception as e:
+        rm(to)
+        if isinstance(e, SigningScriptError):
+            raise
+        raise SigningScriptError(e)
 
-    Does proper base64 and json encoding.
-    Tries not to hold onto a lot of memory.
-    """
-    _signing_req = signing_req.copy()
-    input_files = _signing_req.pop("files")
-    fp.write(b"[{")
-    for k, v in _signing_req.items():
-        fp.write(json.dumps(k).encode("utf8"))
-        fp.write(b":")
-        fp.write(json.dumps(v).encode("utf8"))
-        fp.write(b",")
-    fp.write(b'"files":[')
-    for i, input_file in enumerate(input_files):
+
+def _signing_req_parts(signing_req):
+    """Yield the json encoding of a single signing request, piece by piece.
+
+    Everything is yielded as utf8 encoded bytes, except for the file objects
+    holding the data to sign, which are yielded as-is so the caller can
+    base64 encode them without reading them into memory.
+    """
+    yield b"{"
+    for i, (k, v) in enumerate(signing_req.items()):
         if i > 0:
-            fp.write(b",")
-        fp.write(b'{"name":')
-        fp.write(json.dumps(os.path.basename(input_file["name"])).encode("utf8"))
-        fp.write(b',"content":"')
-        input_file["content"].seek(0)
+            yield b","
+        yield json.dumps(k).encode("utf8")
+        yield b":"
+        if k == "files":
+            yield b"["
+            for j, input_file in enumerate(v):
+                if j > 0:
+                    yield b","
+                yield b'{"name":'
+                yield json.dumps(os.path.basename(input_file["name"])).encode("utf8")
+                yield b',"content":"'
+                yield input_file["content"]
+                yield b'"}'
+            yield b"]"
+        elif hasattr(v, "read"):
+            yield b'"'
+            yield v
+            yield b'"'
+        else:
+            yield json.dumps(v).encode("utf8")
+    yield b"}"
+
+
+def _signing_reqs_parts(signing_reqs):
+    """Yield the json encoding of a list of signing requests, as `_signing_req_parts` does."""
+    if isinstance(signing_reqs, dict):
+        signing_reqs = [signing_reqs]
+    yield b"["
+    for i, signing_req in enumerate(signing_reqs):
+        if i > 0:
+            yield b","
+        yield from _signing_req_parts(signing_req)
+    yield b"]"
+
+
+def iter_signing_req(signing_req, block_size=_ENCODE_BLOCK_SIZE):
+    """Yield the full json encoding of `signing_req` as bytes.
+
+    File objects are read from the beginning (we may be retrying a request)
+    in `block_size` blocks, and base64 encoded as we go.
+
+    Args:
+        signing_req (dict or list): the signing request(s) to encode
+        block_size (int, optional): how much to read from files at once. Must
+            be a multiple of 3, so that the blocks encode without padding.
+
+    """
+    for part in _signing_reqs_parts(signing_req):
+        if isinstance(part, bytes):
+            yield part
+            continue
+        part.seek(0)
         while True:
-            block = input_file["content"].read(1020)
+            block = part.read(block_size)
             if not block:
                 break
-            fp.write(base64.b64encode(block))
-        fp.write(b'"}')
-    fp.write(b"]}]")
+            yield base64.b64encode(block)
 
 
-def get_hawk_content_hash(request_body, content_type):
-    """Generate the content hash of the given request."""
+def _new_hawk_hash(content_type):
     h = hashlib.new("sha256")
     h.update(b"hawk.1.payload\n")
     h.update(content_type.encode("utf8"))
     h.update(b"\n")
-    while True:
-        block = request_body.read(1024)
-        if not block:
-            break
-        h.update(block)
+    return h
+
+
+def _finish_hawk_hash(h):
     h.update(b"\n")
     return b64encode(h.digest())
 
 
+def write_signing_req_to_disk(fp, signing_req, content_type="application/json"):
+    """Write signing_req to fp.
+
+    Does proper base64 and json encoding in a single pass, without holding
+    onto a lot of memory, and computes the HAWK payload hash along the way.
+
+    Returns:
+        str: the HAWK content hash of what was written
+
+    """
+    h = _new_hawk_hash(content_type)
+    for block in iter_signing_req(signing_req):
+        h.update(block)
+        fp.write(block)
+    return _finish_hawk_hash(h)
+
+
+def _real_file_size(fileobj):
+    """Return the size of a file object backed by a real file, or None."""
+    try:
+        return os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, OSError, TypeError, ValueError):
+        return None
+
+
+class SigningRequestBody:
+    """A re-iterable request body that encodes a signing request on the fly.
+
+    Unlike `write_signing_req_to_disk`, this doesn't need a temporary copy of
+    the encoded request: the length is precomputed from the input file sizes,
+    and each iteration (e.g. each retry) re-reads and encodes the inputs. Only
+    usable when every input is a real file (see `from_signing_req`).
+
+    The inputs are encoded once for the HAWK hash and once more as they're
+    sent; both passes read and encode in the default executor, to keep the
+    event loop free.
+
+    Args:
+        signing_req (dict or list): the signing request(s) to encode
+        size (int): the length of the encoded request
+
+    """
+
+    def __init__(self, signing_req, size):
+        """Initialize SigningRequestBody."""
+        self.signing_req = signing_req
+        self.size = size
+
+    @classmethod
+    def from_signing_req(cls, signing_req):
+        """Create a SigningRequestBody, or return None if an input isn't a real file."""
+        size = 0
+        for part in _signing_reqs_parts(signing_req):
+            if isinstance(part, bytes):
+                size += len(part)
+                continue
+            file_size = _real_file_size(part)
+            if file_size is None:
+                return None
+            size += 4 * ((file_size + 2) // 3)
+        return cls(signing_req, size)
+
+    def content_hash(self, content_type):
+        """Compute the HAWK content hash of the encoded request."""
+        h = _new_hawk_hash(content_type)
+        for block in iter_signing_req(self.signing_req):
+            h.update(block)
+        return _finish_hawk_hash(h)
+
+    async def __aiter__(self):
+        """Yield the encoded request."""
+        loop = asyncio.get_running_loop()
+        blocks = iter_signing_req(self.signing_req)
+        while (block := await loop.run_in_executor(None, next, blocks, None)) is not None:
+            yield block
+
+
 def get_hawk_header(url, user, password, content_type, content_hash):
     """Create a HAWK Authentication header."""
     r = mohawk.base.Resource(credentials={"id": user, "key": password, "algorithm": "sha256"}, url=url, method="POST", content_type=content_type)
@@ -887,34 +1428,60 @@ def get_hawk_header(url, user, password, content_type, content_hash):
     return auth_header
 
 
-@time_async_function
-async def call_autograph(session, url, user, password, sign_req):
-    """Call autograph and return the json response."""
-    content_type = "application/json"
+async def _read_streamed_response(resp, stream_keys, tmp_dir):
+    """Read an aiohttp response through `scriptworker_client.autograph.read_streamed_response`."""
+    try:
+        return await read_streamed_response(resp, stream_keys, tmp_dir)
+    except AutographResponseError as e:
+        raise SigningScriptError(str(e)) from e
 
-    request_body = tempfile.TemporaryFile("w+b")
-    write_signing_req_to_disk(request_body, sign_req)
-    request_body.seek(0)
 
-    content_hash = get_hawk_content_hash(request_body, content_type)
+@time_async_function
+async def call_autograph(session, url, user, password, sign_req, stream_keys=None, tmp_dir=None, limiter=None):
+    """Call autograph and return the json response.
 
-    auth_header = get_hawk_header(url, user, password, content_type, content_hash)
+    If `stream_keys` is set, the values of those keys are decoded to files
+    in `tmp_dir` as the response is read, and replaced with their paths (see
+    `scriptworker_client.autograph.AutographResponseStream`).
 
-    request_body.seek(0, 2)
-    req_size = request_body.tell()
-    log.debug("req_size: %s", req_size)
-    request_body.seek(0)
+    If `limiter` is set, the request waits for a free slot on its
+    `AutographConcurrencyLimiter` first, and reports back how long autograph
+    took to respond and whether it was overloaded.
+    """
+    content_type = "application/json"
 
-    resp = await session.post(url, data=request_body, headers={"Authorization": auth_header, "Content-Type": content_type, "Content-Length": str(req_size)})
-    if resp.ok:
-        log.debug("Autograph response: %s", resp.status)
-    else:
-        log.error("Autograph response: %s, %s", resp.status, await resp.text())
-    resp.raise_for_status()
-    # TODO: Write this out to temporary file. The responses can be large,
-    # especially in the case of APK/omnija signing where the entire file is
-    # being sent and returned.
-    return await resp.json()
+    async def post(request_body, req_size, content_hash):
+        log.debug("req_size: %s", req_size)
+        auth_header = get_hawk_header(url, user, password, content_type, content_hash)
+        headers = {"Authorization": auth_header, "Content-Type": content_type, "Content-Length": str(req_size)}
+        queued = time.monotonic()
+        async with limiter.request(url) if limiter else contextlib.nullcontext(lambda: None) as response_started:
+            metrics.add_counters(autograph_requests=1, autograph_queue_wait=time.monotonic() - queued, autograph_bytes_sent=req_size)
+            async with session.post(url, data=request_body, headers=headers) as resp:
+                response_started()
+                if resp.ok:
+                    log.debug("Autograph response: %s", resp.status)
+                else:
+                    log.error("Autograph response: %s, %s", resp.status, await resp.text())
+                resp.raise_for_status()
+                if stream_keys:
+                    result = await _read_streamed_response(resp, stream_keys, tmp_dir)
+                else:
+                    result = await resp.json()
+                metrics.add_counters(autograph_bytes_received=resp.content.total_bytes)
+                return result
+
+    # Large requests are encoded on the fly from the input files; small ones
+    # are spooled to a temporary file.
+    request_body = SigningRequestBody.from_signing_req(sign_req)
+    if request_body is not None and request_body.size > _SPOOL_MAX_SIZE:
+        content_hash = await asyncio.get_running_loop().run_in_executor(None, request_body.content_hash, content_type)
+        return await post(request_body, request_body.size, content_hash)
+    with tempfile.TemporaryFile("w+b") as request_body:
+        content_hash = write_signing_req_to_disk(request_body, sign_req, content_type)
+        req_size = request_body.tell()
+        request_body.seek(0)
+        return await post(request_body, req_size, content_hash)
 
 
 def b64encode(input_bytes):
@@ -987,7 +1554,7 @@ def _xpi_signing_options(fmt):
 
 
 @time_async_function
-async def sign_with_autograph(session, server, input_, fmt, autograph_method, keyid=None, extension_id=None):
+async def sign_with_autograph(session, server, input_, fmt, autograph_method, keyid=None, extension_id=None, tmp_dir=None, limiter=None):
     """Signs data with autograph and returns the result.
 
     Args:
@@ -999,13 +1566,19 @@ async def sign_with_autograph(session, server, input_, fmt, autograph_method, ke
                                 one of 'file', 'hash', 'data', or 'files'
         keyid (str): which key to use on autograph (optional)
         extension_id (str): which id to send to autograph for the extension (optional)
+        tmp_dir (str): if set, stream the signed files for the 'file' and 'files'
+                       methods into this directory instead of holding them in memory (optional)
+        limiter (AutographConcurrencyLimiter): limits the number of concurrent
+                                               requests to the server (optional)
 
     Raises:
         aiohttp.ClientError: on failure
         SigningScriptError: when no suitable signing server is found for fmt
 
     Returns:
-        bytes: the signed data
+        bytes: the signed data. If `tmp_dir` is set, the path to the signed file
+               ('file') or the `content` of each signed file ('files') is the
+               path to the decoded file instead.
 
     """
     if autograph_method not in {"file", "hash", "data", "files"}:
@@ -1016,9 +1589,18 @@ async def sign_with_autograph(session, server, input_, fmt, autograph_method, ke
 
     url = f"{server.url}/sign/{autograph_method}"
 
+    stream_keys = None
+    if tmp_dir and autograph_method in _STREAMED_RESPONSE_KEYS:
+        stream_keys = _STREAMED_RESPONSE_KEYS[autograph_method]
+
     log.debug(f"sign_with_autograph: url: {url}, keyid: {keyid}, client_id: {server.client_id}")
+    metrics.add_counters(autograph_calls=1)
     sign_resp = await retry_async(
-        call_autograph, args=(session, url, server.client_id, server.access_key, sign_req), attempts=3, sleeptime_kwargs={"delay_factor": 2.0}
+        call_autograph,
+        args=(session, url, server.client_id, server.access_key, sign_req),
+        kwargs={"stream_keys": stream_keys, "tmp_dir": tmp_dir, "limiter": limiter},
+        attempts=3,
+        sleeptime_kwargs={"delay_factor": 2.0},
     )
 
     if autograph_method == "file":
@@ -1054,13 +1636,38 @@ async def sign_file_with_autograph(context, from_, fmt, to=None, extension_id=No
     a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
     log.debug(f"got autograph config: url: {a.url}, id: {a.client_id}, formats: {a.formats}, key_id: {a.key_id}")
     to = to or from_
-    input_file = open(from_, "rb")
-    signed_bytes = base64.b64decode(await sign_with_autograph(context.session, a, input_file, fmt, "file", extension_id=extension_id))
-    with open(to, "wb") as fout:
-        fout.write(signed_bytes)
+    cache = getattr(context, "signing_cache", None)
+    if cache:
+        cache_key = cache.make_key(utils.get_hash(from_, "sha256"), fmt, a.key_id, cert_type, extension_id)
+        if cache.get_file(cache_key, to):
+            return to
+    with open(from_, "rb") as input_file:
+        signed_path = await sign_with_autograph(
+            context.session,
+            a,
+            input_file,
+            fmt,
+            "file",
+            extension_id=extension_id,
+            tmp_dir=os.path.dirname(os.path.abspath(to)),
+            limiter=context.autograph_limiter,
+        )
+    _replace_file(signed_path, to)
+    if cache:
+        cache.put_file(cache_key, to)
     return to
 
 
+def _replace_file(src, dst):
+    """Atomically move `src` over `dst`, keeping the permissions of `dst` if it exists."""
+    try:
+        mode = os.stat(dst).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = utils.get_default_file_mode()
+    os.chmod(src, mode)
+    os.replace(src, dst)
+
+
 async def verify_gpg(context, from_, signature):
     keyring = os.path.join(context.config["work_dir"], "trustedkeys.gpg")
     await utils.execute_subprocess(["gpgv", "--keyring", str(keyring), str(signature), str(from_)])
@@ -1086,14 +1693,231 @@ async def sign_gpg_with_autograph(context, from_, fmt, **kwargs):
     cert_type = task.task_cert_type(context)
     a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
     to = f"{from_}.asc"
-    input_file = open(from_, "rb")
-    signature = await sign_with_autograph(context.session, a, input_file, fmt, "data")
-    with open(to, "w") as fout:
-        fout.write(signature)
+    cache = getattr(context, "signing_cache", None)
+    cache_key = cache and cache.make_key(utils.get_hash(from_, "sha256"), fmt, a.key_id, cert_type)
+    if not (cache and cache.get_file(cache_key, to)):
+        input_file = open(from_, "rb")
+        signature = await sign_with_autograph(context.session, a, input_file, fmt, "data", limiter=context.autograph_limiter)
+        with open(to, "w") as fout:
+            fout.write(signature)
+        if cache:
+            cache.put_file(cache_key, to)
     await verify_gpg(context, from_, to)
     return [from_, to]
 
 
+def _chunk_paths_by_size(paths, max_bytes):
+    """Split `paths` into chunks of files adding up to at most `max_bytes`.
+
+    The budget is on the size of the files, before base64 encoding. A file
+    bigger than `max_bytes` gets a chunk of its own.
+
+    Yields:
+        list: the paths in each chunk, in order
+
+    """
+    chunk = []
+    chunk_size = 0
+    for path in paths:
+        size = os.path.getsize(path)
+        if chunk and chunk_size + size > max_bytes:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(path)
+        chunk_size += size
+    if chunk:
+        yield chunk
+
+
+@time_async_function
+async def sign_inputs_with_autograph(session, server, inputs, fmt, autograph_method, keyid=None, limiter=None):
+    """Sign several inputs in a single multi-input autograph request.
+
+    Args:
+        session (aiohttp.ClientSession): client session object
+        server (Autograph): the server to connect to sign
+        inputs (list): the file objects to sign
+        fmt (str): the format to sign with
+        autograph_method (str): which autograph method to use to sign. must be
+                                one of 'hash' or 'data'
+        keyid (str): which key to use on autograph (optional)
+        limiter (AutographConcurrencyLimiter): limits the number of concurrent
+                                               requests to the server (optional)
+
+    Raises:
+        aiohttp.ClientError: on failure
+        SigningScriptError: if autograph doesn't return one signature per input
+
+    Returns:
+        list: the signature of each input, in order
+
+    """
+    if autograph_method not in {"hash", "data"}:
+        raise SigningScriptError(f"Unsupported autograph method for multiple inputs: {autograph_method}")
+    keyid = keyid or server.key_id
+    sign_reqs = [make_signing_req(input_, fmt, autograph_method, keyid=keyid) for input_ in inputs]
+    url = f"{server.url}/sign/{autograph_method}"
+    log.debug(f"sign_inputs_with_autograph: sending {len(inputs)} inputs to {url}, keyid: {keyid}")
+    metrics.add_counters(autograph_calls=1)
+    sign_resp = await retry_async(
+        call_autograph,
+        args=(session, url, server.client_id, server.access_key, sign_reqs),
+        kwargs={"limiter": limiter},
+        attempts=3,
+        sleeptime_kwargs={"delay_factor": 2.0},
+    )
+    if len(sign_resp) != len(inputs):
+        raise SigningScriptError(f"Expected {len(inputs)} signatures from autograph, got {len(sign_resp)}")
+    return [r["signature"] for r in sign_resp]
+
+
+@time_async_function
+async def sign_gpg_files_with_autograph(context, paths, fmt):
+    """Sign several files with autograph, in as few requests as possible.
+
+    Like `sign_gpg_with_autograph`, but the files are sent in multi-input
+    `/sign/data` requests of up to `autograph_files_batch_max_bytes` each.
+    Once all the signatures are written, they're verified in parallel, one
+    per cpu at a time.
+
+    Args:
+        context (Context): the signing context
+        paths (list): the source files to sign
+        fmt (str): the format to sign with
+
+    Raises:
+        aiohttp.ClientError: on failure
+        SigningScriptError: when no suitable signing server is found for fmt
+
+    Returns:
+        list: the paths to the signed files, each followed by its sig.
+
+    """
+    cert_type = task.task_cert_type(context)
+    a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
+    cache = getattr(context, "signing_cache", None)
+    cache_keys = {}
+    to_sign = []
+    for from_ in paths:
+        if cache:
+            cache_keys[from_] = cache.make_key(utils.get_hash(from_, "sha256"), fmt, a.key_id, cert_type)
+            if cache.get_file(cache_keys[from_], f"{from_}.asc"):
+                continue
+        to_sign.append(from_)
+
+    async def _sign_chunk(chunk):
+        with contextlib.ExitStack() as stack:
+            inputs = [stack.enter_context(open(from_, "rb")) for from_ in chunk]
+            signatures = await sign_inputs_with_autograph(context.session, a, inputs, fmt, "data", limiter=context.autograph_limiter)
+        for from_, signature in zip(chunk, signatures):
+            with open(f"{from_}.asc", "w") as fout:
+                fout.write(signature)
+            if cache:
+                cache.put_file(cache_keys[from_], f"{from_}.asc")
+
+    chunks = list(_chunk_paths_by_size(to_sign, context.config["autograph_files_batch_max_bytes"]))
+    log.info(f"Signing {len(to_sign)} of {len(paths)} files with {fmt} in {len(chunks)} requests")
+    await raise_future_exceptions([asyncio.ensure_future(_sign_chunk(chunk)) for chunk in chunks])
+    # Each verification is a gpgv process, so run one per cpu at a time
+    semaphore = asyncio.Semaphore(os.cpu_count())
+    await raise_future_exceptions([asyncio.ensure_future(semaphore_wrapper(semaphore, verify_gpg(context, from_, f"{from_}.asc"))) for from_ in paths])
+    return [path for from_ in paths for path in (from_, f"{from_}.asc")]
+
+
+class AutographHashBatcher:
+    """Coalesce concurrent hash signing requests into multi-input autograph requests.
+
+    Autograph accepts a list of signing requests in a single call. Callers of
+    `sign_hash` for the same (server, format, keyid) within `window` seconds
+    of each other are sent together in one HAWK-signed request, and each
+    caller gets its own signature back. A batch is sent early once it reaches
+    `max_batch_size` inputs.
+
+    Args:
+        session (aiohttp.ClientSession): client session object
+        window (float): how long to wait for more requests, in seconds
+        max_batch_size (int): the maximum number of inputs per request
+        limiter (AutographConcurrencyLimiter, optional): limits the number of
+            concurrent requests to each server
+
+    """
+
+    def __init__(self, session, window, max_batch_size, limiter=None):
+        """Initialize AutographHashBatcher."""
+        self.session = session
+        self.limiter = limiter
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending = {}
+        self._timers = {}
+        self._requests = set()
+
+    async def sign_hash(self, server, hash_, fmt, keyid=None):
+        """Sign `hash_`, batched with any other concurrent requests.
+
+        Args:
+            server (Autograph): the server to connect to sign
+            hash_ (bytes): the input hash to sign
+            fmt (str): the format to sign with
+            keyid (str): which key to use on autograph (optional)
+
+        Raises:
+            aiohttp.ClientError: on failure
+
+        Returns:
+            bytes: the signature
+
+        """
+        loop = asyncio.get_running_loop()
+        batch_key = (server.url, fmt, keyid or server.key_id)
+        future = loop.create_future()
+        batch = self._pending.setdefault(batch_key, [])
+        batch.append((hash_, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(batch_key, server)
+        elif batch_key not in self._timers:
+            self._timers[batch_key] = loop.call_later(self.window, self._flush, batch_key, server)
+        return await future
+
+    def _flush(self, batch_key, server):
+        timer = self._timers.pop(batch_key, None)
+        if timer:
+            timer.cancel()
+        batch = self._pending.pop(batch_key, [])
+        if batch:
+            request = asyncio.ensure_future(self._send(server, batch_key, batch))
+            # Keep a reference until it's done, so it doesn't get garbage collected
+            self._requests.add(request)
+            request.add_done_callback(self._requests.discard)
+
+    async def _send(self, server, batch_key, batch):
+        _, fmt, keyid = batch_key
+        url = f"{server.url}/sign/hash"
+        sign_reqs = [make_signing_req(BytesIO(hash_), fmt, "hash", keyid=keyid) for hash_, _ in batch]
+        log.debug(f"AutographHashBatcher: sending {len(batch)} hashes to {url}, keyid: {keyid}")
+        metrics.add_counters(autograph_calls=1)
+        try:
+            sign_resp = await retry_async(
+                call_autograph,
+                args=(self.session, url, server.client_id, server.access_key, sign_reqs),
+                kwargs={"limiter": self.limiter},
+                attempts=3,
+                sleeptime_kwargs={"delay_factor": 2.0},
+            )
+            if len(sign_resp) != len(batch):
+                raise SigningScriptError(f"Expected {len(batch)} signatures from autograph, got {len(sign_resp)}")
+            signatures = [base64.b64decode(r["signature"]) for r in sign_resp]
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), signature in zip(batch, signatures):
+            if not future.done():
+                future.set_result(signature)
+
+
 @time_async_function
 async def sign_hash_with_autograph(context, hash_, fmt, keyid=None):
     """Signs hash with autograph and returns the result.
@@ -1114,8 +1938,22 @@ async def sign_hash_with_autograph(context, hash_, fmt, keyid=None):
     """
     cert_type = task.task_cert_type(context)
     a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
-    input_file = BytesIO(hash_)
-    signature = base64.b64decode(await sign_with_autograph(context.session, a, input_file, fmt, "hash", keyid))
+    cache = getattr(context, "signing_cache", None)
+    if cache:
+        cache_key = cache.make_key(hashlib.sha256(hash_).hexdigest(), fmt, keyid or a.key_id, cert_type)
+        signature = cache.get_bytes(cache_key)
+        if signature is not None:
+            return signature
+    batcher = getattr(context, "hash_batcher", None)
+    if batcher:
+        signature = await batcher.sign_hash(a, hash_, fmt, keyid)
+    else:
+        input_file = BytesIO(hash_)
+        signature = base64.b64decode(
+            await sign_with_autograph(context.session, a, input_file, fmt, "hash", keyid, limiter=context.autograph_limiter)
+        )
+    if cache:
+        cache.put_bytes(cache_key, signature)
     return signature
 
 
@@ -1179,35 +2017,39 @@ def get_mar_verification_key(cert_type, fmt, keyid):
         raise SigningScriptError(f"Can't find mar verify key for {fmt}, {cert_type} ({keyid}):\n{err}")
 
 
-def verify_mar_signature(cert_type, fmt, mar, keyid=None):
-    """Verify a mar signature, via mardor.
+def verify_mar_hash_signature(cert_type, fmt, digest, signature, keyid=None):
+    """Verify a mar signature against the hash it signs, via mardor.
 
     Args:
         cert_type (str): the cert scope string
         fmt (str): the signing format
-        mar (str): the path to the mar file
+        digest (bytes): the hash of the signed mar's signature data
+        signature (bytes): the signature of ``digest``
         keyid (str, optional): the key id to use (can be None)
 
     Raises:
-        SigningScriptError: if the signature doesn't verify, or the nick isn't found
+        SigningScriptError: if the signature doesn't verify, or the key isn't found
 
     """
     mar_verify_key = get_mar_verification_key(cert_type, fmt, keyid)
-    try:
-        mar_path = os.path.join(os.path.dirname(sys.executable), "mar")
-        cmd = [mar_path, "-k", mar_verify_key, "-v", mar]
-        log.info("Running %s", cmd)
-        subprocess.check_call(cmd, stdout=sys.stdout, stderr=sys.stderr)
-        log.info("Verified signature.")
-    except subprocess.CalledProcessError as e:
-        raise SigningScriptError(e)
+    with open(mar_verify_key, "rb") as fh:
+        keydata = fh.read()
+    if not verify_signature(keydata, signature, digest, "sha384"):
+        raise SigningScriptError(f"mar signature doesn't verify with {mar_verify_key}")
+    log.info("Verified signature.")
 
 
-def validate_mar_channel(context, mar):
-    """Verify the mar channel matches an authorized pattern"""
+def validate_mar_channel(context, productinfo):
+    """Verify the mar channel matches an authorized pattern
+
+    Args:
+        context (Context): the signing context
+        productinfo (tuple): the (productversion, channel) of the mar, or None
+
+    """
     cert_type = task.task_cert_type(context)
     try:
-        channel_id = mar.productinfo[1]
+        channel_id = productinfo[1]
     except TypeError:
         raise SigningScriptError("Can't find mar channel id")
     allowed_channels = context.mar_channels.get(cert_type, [])
@@ -1216,6 +2058,68 @@ def validate_mar_channel(context, mar):
     raise SigningScriptError(f"Cannot use mar channel id {channel_id}, expected one of {allowed_channels}")
 
 
+def _get_mar_productinfo(mardata):
+    """Return the (productversion, channel) of parsed mar data, like ``MarReader.productinfo``."""
+    for section in mardata.additional.sections if mardata.additional else ():
+        if section.id == 1:
+            return str(section.productversion), str(section.channel)
+    return None
+
+
+def _write_mar_with_signature_block(src, dst, algorithm_id, signature_size):
+    """Copy the mar `src` to `dst` with a single, zeroed, signature block.
+
+    This writes the same file as ``mardor.writer.add_signature_block``, but
+    hashes the signature data as it goes, so the mar is only read once.
+
+    Args:
+        src (file object): the mar to copy
+        dst (file object): the file object to write to
+        algorithm_id (int): the mar signature algorithm id
+        signature_size (int): the size of the signature to reserve
+
+    Returns:
+        tuple: the mar's productinfo, the hash of its signature data, and the
+            offset of the signature in `dst`
+
+    """
+    mardata = mar.parse_stream(src)
+    extras = extras_header.build(mardata.additional)
+    # The mar header, then the filesize and count of the signatures header, then one signature entry
+    sig_offset = mar_header.sizeof() + 12 + 8
+    data_offset = sig_offset + signature_size + len(extras)
+    index = mardata.index
+    for entry in index.entries:
+        entry.offset += data_offset - mardata.data_offset
+    index_data = index_header.build(index)
+    index_offset = data_offset + mardata.data_length
+    filesize = index_offset + len(index_data)
+
+    hasher = make_hasher(algorithm_id)
+
+    def write(data, signed=True):
+        dst.write(data)
+        if signed:
+            hasher.update(data)
+
+    # Everything but the signature itself is covered by the signature
+    write(mar_header.build({"index_offset": index_offset}))
+    write(struct.pack(">QI", filesize, 1))
+    write(struct.pack(">II", algorithm_id, signature_size))
+    write(b"\0" * signature_size, signed=False)
+    write(extras)
+    src.seek(mardata.data_offset)
+    remaining = mardata.data_length
+    while remaining:
+        block = src.read(min(remaining, _COPY_BLOCK_SIZE))
+        if not block:
+            raise SigningScriptError("mar data is truncated")
+        write(block)
+        remaining -= len(block)
+    write(index_data)
+    return _get_mar_productinfo(mardata), hasher.finalize(), sig_offset
+
+
 @time_async_function
 async def sign_mar384_with_autograph_hash(context, from_, fmt, to=None, **kwargs):
     """Signs a hash with autograph, injects it into the file, and writes the result to arg `to` or `from_` if `to` is None.
@@ -1241,40 +2145,36 @@ async def sign_mar384_with_autograph_hash(context, from_, fmt, to=None, **kwargs
     # Call to check that we have a server available
     get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
 
-    hash_algo, expected_signature_length = "sha384", 512
-
-    # Add a dummy signature into a temporary file (TODO: dedup with mardor.cli do_hash)
-    with tempfile.TemporaryFile() as tmp:
-        with open(from_, "rb") as f:
-            add_signature_block(f, tmp, hash_algo)
-
-        tmp.seek(0)
-
-        with MarReader(tmp) as m:
-            validate_mar_channel(context, m)
-
-            hashes = m.calculate_hashes()
-        h = hashes[0][1]
-
-    signature = await sign_hash_with_autograph(context, h, fmt, keyid)
-
-    # Add a signature to the MAR file (TODO: dedup with mardor.cli do_add_signature)
-    if len(signature) != expected_signature_length:
-        raise SigningScriptError(
-            "signed mar hash signature has invalid length for hash algo {}. Got {} expected {}.".format(hash_algo, len(signature), expected_signature_length)
-        )
-
-    # use the tmp file in case param `to` is `from_` which causes stream errors
-    tmp_dst = tempfile.NamedTemporaryFile(mode="w+b", delete=False)
-    with open(tmp_dst.name, "w+b") as dst:
-        with open(from_, "rb") as src:
-            add_signature_block(src, dst, hash_algo, signature)
+    hash_algo, algorithm_id, expected_signature_length = "sha384", 2, 512
 
+    # Write the mar with an empty signature block next to its destination,
+    # hashing it on the way, then fill in the signature and rename it into
+    # place. This also works when `to` is `from_`.
     to = to or from_
-    shutil.copyfile(tmp_dst.name, to)
-    os.unlink(tmp_dst.name)
-
-    verify_mar_signature(cert_type, fmt, to, keyid)
+    tmp_dst = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(to)), prefix=".", suffix=".mar", delete=False)
+    try:
+        with tmp_dst as dst:
+            with open(from_, "rb") as src:
+                productinfo, h, sig_offset = _write_mar_with_signature_block(src, dst, algorithm_id, expected_signature_length)
+            validate_mar_channel(context, productinfo)
+
+            signature = await sign_hash_with_autograph(context, h, fmt, keyid)
+
+            if len(signature) != expected_signature_length:
+                raise SigningScriptError(
+                    "signed mar hash signature has invalid length for hash algo {}. Got {} expected {}.".format(
+                        hash_algo, len(signature), expected_signature_length
+                    )
+                )
+            verify_mar_hash_signature(cert_type, fmt, h, signature, keyid)
+
+            dst.seek(sig_offset)
+            dst.write(signature)
+        shutil.copymode(from_, tmp_dst.name)
+        os.replace(tmp_dst.name, to)
+    except BaseException:
+        os.unlink(tmp_dst.name)
+        raise
 
     log.info("wrote mar with autograph signed hash %s to %s", from_, to)
     return to
@@ -1308,7 +2208,9 @@ async def sign_widevine_with_autograph(context, from_, blessed, fmt, to=None):
     to = to or f"{from_}.sig"
     flags = 1 if blessed else 0
 
-    h = widevine.generate_widevine_hash(from_, flags)
+    # Hashing large binaries is CPU bound; do it in the process pool so it
+    # overlaps with the autograph requests for other files
+    h = await utils.run_in_process_pool(context, widevine.generate_widevine_hash, from_, flags)
 
     signature = await sign_hash_with_autograph(context, h, fmt)
 
@@ -1344,9 +2246,7 @@ async def sign_omnija_with_autograph(context, from_, fmt):
 
     await sign_file_with_autograph(context, from_, fmt, to=signed_out, extension_id="omni.ja@mozilla.org")
     await merge_omnija_files(orig=from_, signed=signed_out, to=merged_out)
-    with open(from_, "wb") as fout:
-        with open(merged_out, "rb") as fin:
-            fout.write(fin.read())
+    _replace_file(merged_out, from_)
     return from_
 
 
@@ -1369,20 +2269,144 @@ async def merge_omnija_files(orig, signed, to):
         bool: always True if function succeeded.
 
     """
-    orig_jarreader = mozjar.JarReader(orig)
-    with mozjar.JarWriter(to, compress=orig_jarreader.compression) as to_writer:
+    # Map the original rather than reading it in; the members we copy over
+    # are written straight from the mapping.
+    with open(orig, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        try:
+            _merge_omnija_data(data, signed, to)
+        except Exception as e:
+            # The traceback holds views of the mapping, which would keep it from closing
+            traceback.clear_frames(e.__traceback__)
+            raise
+    return True
+
+
+def _merge_omnija_data(data, signed, to):
+    """Merge the signed META-INF files into the original omnijar data.
+
+    Every view of `data` is released by the time this returns, so the
+    caller can close it.
+
+    Args:
+        data (mmap.mmap): the original omnijar
+        signed (str): the signed file, without optimizations
+        to (str): the output path for the merge
+
+    """
+    orig_jarreader = mozjar.JarReader(data=data)
+    # Use ZipFile here because mozjar can't read the signed copies
+    signed_zip = zipfile.ZipFile(signed, "r")
+    signed_names = [fname for fname in signed_zip.namelist() if fname.startswith("META-INF")]
+    preloads = []
+    if orig_jarreader.last_preloaded:
+        jarlog = list(orig_jarreader.entries.keys())
+        preloads = jarlog[: jarlog.index(orig_jarreader.last_preloaded) + 1]
+    names = list(orig_jarreader.entries.keys()) + signed_names
+    with _StreamingJarWriter(to, names, preloads=preloads, compress=orig_jarreader.compression) as to_writer:
         for origjarfile in orig_jarreader:
             to_writer.add(origjarfile.filename, origjarfile, compress=origjarfile.compress)
-        # Use ZipFile here because mozjar can't read the signed copies
-        signed_zip = zipfile.ZipFile(signed, "r")
-        for fname in signed_zip.namelist():
-            if fname.startswith("META-INF"):
-                to_writer.add(fname, signed_zip.open(fname, "r"))
-        if orig_jarreader.last_preloaded:
-            jarlog = list(orig_jarreader.entries.keys())
-            preloads = jarlog[: jarlog.index(orig_jarreader.last_preloaded) + 1]
-            to_writer.preload(preloads)
-    return True
+        for fname in signed_names:
+            to_writer.add(fname, signed_zip.open(fname, "r"))
+
+
+class _StreamingJarWriter(mozjar.JarWriter):
+    """A `mozjar.JarWriter` that writes members out as soon as they're added.
+
+    `mozjar.JarWriter` keeps every compressed member in memory until
+    `finish`. This writes each one to disk in `add` instead, producing the
+    same output. In jars optimized for preloading, the central directory
+    comes before the members, so the names of all the members have to be
+    known up front to leave room for it, and the preloaded members have to
+    be added first, in preload order.
+
+    Args:
+        file (str): the path to write the jar to
+        names (list): the names of all the members that will be added
+        preloads (list, optional): the names of the members to preload
+        compress (int, optional): the default compression for members
+
+    """
+
+    def __init__(self, file, names, preloads=(), compress=True):
+        """Initialize _StreamingJarWriter."""
+        super().__init__(file=file, compress=compress)
+        self._names = [mozpath.normsep(name) for name in names]
+        self._preloads = []
+        self._entries = {}
+        self._preload_size = 0
+        self._offset = 0
+        self.preload(preloads)
+
+    def __exit__(self, type, value, tb):
+        """Finish the jar, unless we're exiting because of an exception."""
+        if type is None:
+            self.finish()
+        else:
+            self._data.close()
+
+    def add(self, name, data, compress=None, mode=None, skip_duplicates=False):
+        """Add a member to the jar and write it out. See `mozjar.JarWriter.add`."""
+        name = mozpath.normsep(name)
+        if name in self._entries:
+            if skip_duplicates:
+                return
+            raise mozjar.JarWriterError("File %s already in JarWriter" % name)
+        if len(self._entries) < len(self._preloads) and name != self._preloads[len(self._entries)]:
+            raise mozjar.JarWriterError("Preloaded files must be added first, in order; got %s" % name)
+        super().add(name, data, compress=compress, mode=mode)
+        entry, content = self._contents.pop(name)
+        header = mozjar.JarLocalFileHeader()
+        for field in entry.STRUCT:
+            if field in header:
+                header[field] = entry[field]
+        entry["offset"] = self._offset
+        self._data.write(header.serialize())
+        self._data.write(content)
+        self._offset += header.size + len(content)
+        self._entries[name] = entry
+        if self._preloads and name == self._preloads[-1]:
+            self._preload_size = self._offset
+
+    def preload(self, files):
+        """Set the members to preload. This has to happen before any are added.
+
+        Args:
+            files (list): the names of the members to preload, in order
+
+        Raises:
+            JarWriterError: if members have already been added
+
+        """
+        if self._entries:
+            raise mozjar.JarWriterError("Preloads must be set before adding files")
+        self._preloads = [mozpath.normsep(name) for name in files]
+        self._offset = 0
+        if self._preloads:
+            # Preload size, then the central directory and its end record
+            self._offset = 4 + sum(mozjar.JarCdirEntry().size + len(name.encode("utf-8")) for name in self._names) + mozjar.JarCdirEnd().size
+        self._data.seek(self._offset)
+
+    def finish(self):
+        """Write the central directory and close the jar."""
+        if self._preloads and list(self._entries) != self._names:
+            raise mozjar.JarWriterError("Added files don't match the names given up front")
+        end = mozjar.JarCdirEnd()
+        end["disk_entries"] = len(self._entries)
+        end["cdir_entries"] = end["disk_entries"]
+        end["cdir_size"] = sum(entry.size for entry in self._entries.values())
+        if self._preloads:
+            end["cdir_offset"] = 4
+            self._data.seek(0)
+            self._data.write(struct.pack("<I", self._preload_size))
+        else:
+            end["cdir_offset"] = self._offset
+        for entry in self._entries.values():
+            self._data.write(entry.serialize())
+        if self._preloads:
+            self._data.write(end.serialize())
+            self._data.seek(self._offset)
+        self._data.write(end.serialize())
+        self._data.close()
 
 
 # sign_authenticode_file {{{1
@@ -1398,6 +2422,18 @@ async def _winsign_helper(error_message, *args, **kwargs):
         raise SigningScriptError(error_message)
 
 
+def _is_authenticode_signed(path):
+    """Return whether `path` has an authenticode signature.
+
+    PE files are parsed in-process with `winsign.pefile`, rather than running
+    osslsigncode for every one; anything else, e.g. MSI files, is still
+    checked with osslsigncode.
+    """
+    if winsign.pefile.is_pefile(path):
+        return winsign.pefile.is_signed(path)
+    return winsign.osslsigncode.is_signed(path)
+
+
 @time_async_function
 async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_comment=None):
     """Sign a file in-place with authenticode, using autograph as a backend.
@@ -1414,7 +2450,7 @@ async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_commen
         True on success, False otherwise
 
     """
-    if winsign.osslsigncode.is_signed(orig_path):
+    if await utils.run_in_process_pool(context, _is_authenticode_signed, orig_path):
         log.info("%s is already signed", orig_path)
         return True
 
@@ -1500,8 +2536,9 @@ async def sign_authenticode(context, orig_path, fmt, *, authenticode_comment=Non
 
     Supported formats are a single file or a zip.
 
-    If a zip is passed in, extract it and only sign unsigned files that don't
-    match certain patterns (see `_should_sign_windows`). Then recreate the zip.
+    If a zip is passed in, extract and sign only the files that don't match
+    certain patterns (see `_should_sign_windows`). Then rewrite the zip,
+    copying the unchanged members over without recompressing them.
 
     Args:
         context (Context): the signing context
@@ -1516,27 +2553,30 @@ async def sign_authenticode(context, orig_path, fmt, *, authenticode_comment=Non
 
     """
     _, file_extension = os.path.splitext(orig_path)
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_signcode`, to optimize task runtime
-    # speed over disk space.
+    # This will get cleaned up when we nuke `work_dir`, or once this artifact
+    # is done if eager workspace reclamation is on (see `workspace`).
     tmp_dir = None
-    # Extract the zipfile
     if file_extension == ".zip":
-        tmp_dir = tempfile.mkdtemp(prefix="zip", dir=context.config["work_dir"])
-        files = await _extract_zipfile(context, orig_path, tmp_dir=tmp_dir)
+        files = await _get_zipfile_files(orig_path)
     else:
         files = [orig_path]
     files_to_sign = [file for file in files if _should_sign_windows(file)]
     if not files_to_sign:
         raise SigningScriptError("Did not find any files to sign, all files: {}".format(files))
+    # Only extract the files we're going to sign; the rest of the zip is
+    # copied over as-is when we rewrite it
+    if file_extension == ".zip":
+        tmp_dir = workspace.mkdtemp("zip", context.config["work_dir"])
+        files_to_sign = await _extract_zipfile(context, orig_path, files=files_to_sign, tmp_dir=tmp_dir)
 
-    # Sign the appropriate inner files
+    # Sign the appropriate inner files. Each one checks whether it's already
+    # signed in the process pool first, so these checks run in parallel too
     tasks = [asyncio.create_task(sign_authenticode_file(context, file_, fmt, authenticode_comment=authenticode_comment)) for file_ in files_to_sign]
     done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
     [f.result() for f in done]
     if file_extension == ".zip":
-        # Recreate the zipfile
-        await _create_zipfile(context, orig_path, files, tmp_dir=tmp_dir)
+        # Rewrite the zipfile with the signed files
+        await _rewrite_zipfile(context, orig_path, files_to_sign, tmp_dir=tmp_dir)
     return orig_path
 
 
@@ -1598,10 +2638,9 @@ async def _notarize_pkg(context, path, workdir):
 async def _notarize_geckodriver(context, path, workdir):
     """Notarize geckodriver binary"""
     _, extension = os.path.splitext(path)
-    all_file_names = await _extract_tarfile(context, path, extension, tmp_dir=workdir)
     # Zip geckodriver to notarization_workdir
     #  rCodesign doesn't know how to notarize other types of containers
-    zip_path = await _create_zipfile(context, os.path.join(workdir, "geckodriver.zip"), all_file_names, workdir)
+    zip_path = await _transcode_tarfile_to_zipfile(context, path, extension, os.path.join(workdir, "geckodriver.zip"))
     # Notarize without stapling
     await _notarize_single(zip_path, context.apple_credentials_path, staple=False)
     # Return original signed file
@@ -1703,67 +2742,175 @@ async def sign_rpm_pkg(context, path, fmt, **kwargs):
     autograph_config = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
 
     with open(path, "rb") as f:
-        signed_files = await sign_with_autograph(context.session, autograph_config, [f], fmt, "files")
+        signed_files = await sign_with_autograph(
+            context.session,
+            autograph_config,
+            [f],
+            fmt,
+            "files",
+            tmp_dir=os.path.dirname(os.path.abspath(path)),
+            limiter=context.autograph_limiter,
+        )
 
-    signed_file = signed_files[0]
-    signed_content = base64.b64decode(signed_file["content"])
-    with open(path, "wb") as f:
-        f.write(signed_content)
+    _replace_file(signed_files[0]["content"], path)
 
     return path
 
 
-async def _notarize_wait_staple_batch(context, paths, attempts):
-    """Serial notarize-submit, notary-wait, then staple for a list of paths.
+@time_async_function
+async def sign_rpm_pkgs(context, paths, fmt):
+    """Sign several RPM packages using autograph, in as few requests as possible.
+
+    Like `sign_rpm_pkg`, but the packages are sent in multi-file `/sign/files`
+    requests of up to `autograph_files_batch_max_bytes` each.
+
+    Args:
+        context (Context): the signing context
+        paths (list): the paths of the RPM files to sign
+        fmt (str): the format to sign with
+
+    Returns:
+        list: the paths to the signed RPM files
+
+    Raises:
+        SigningScriptError: if a path isn't an RPM, or autograph doesn't
+            return every file it was sent
+
+    """
+    for path in paths:
+        if not path.endswith(".rpm"):
+            raise SigningScriptError(f"Expected a .rpm file, got: {path}")
+
+    cert_type = task.task_cert_type(context)
+    autograph_config = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
 
-    No-op on empty list. Each step wraps the rcodesign call in retry_async
-    with the given attempt budget, raising RCodesignError on exhaustion.
+    async def _sign_chunk(chunk):
+        with contextlib.ExitStack() as stack:
+            files = [stack.enter_context(open(path, "rb")) for path in chunk]
+            signed_files = await sign_with_autograph(
+                context.session,
+                autograph_config,
+                files,
+                fmt,
+                "files",
+                tmp_dir=context.config["work_dir"],
+                limiter=context.autograph_limiter,
+            )
+        # Autograph returns the files in the order they were sent
+        names = [os.path.basename(f["name"]) for f in signed_files]
+        if names != [os.path.basename(path) for path in chunk]:
+            for f in signed_files:
+                pathlib.Path(f["content"]).unlink(missing_ok=True)
+            raise SigningScriptError(f"Expected {len(chunk)} signed files from autograph, got {names}")
+        for path, f in zip(chunk, signed_files):
+            _replace_file(f["content"], path)
+
+    chunks = list(_chunk_paths_by_size(paths, context.config["autograph_files_batch_max_bytes"]))
+    log.info(f"Signing {len(paths)} RPM packages with {fmt} in {len(chunks)} requests")
+    await raise_future_exceptions([asyncio.ensure_future(_sign_chunk(chunk)) for chunk in chunks])
+    return paths
+
+
+async def _notarize_wait_staple_batch(context, paths, attempts, journal=None):
+    """Notarize-submit, notary-wait, then staple each of a list of paths.
+
+    No-op on empty list. Each path goes through the three steps on its own,
+    so it's stapled as soon as its own wait finishes. Up to
+    ``apple_notarization_concurrency`` submit and staple calls run at once;
+    waiting on Apple doesn't take up a slot. Each step wraps the rcodesign
+    call in retry_async with the given attempt budget.
+    Once every path is done, the first RCodesignError raised is re-raised.
+
+    If a ``journal`` is given, each submission is recorded in it, and a path
+    it already has a submission for is waited on instead of resubmitted. If
+    that wait fails, the path is submitted again.
     """
     if not paths:
         return
-    submissions_map = {}
-    for path in paths:
-        submissions_map[path] = await retry_async(
-            func=rcodesign_notarize,
-            args=(path, context.apple_credentials_path),
-            attempts=attempts,
-            retry_exceptions=RCodesignError,
-        )
-    for path, submission_id in submissions_map.items():
+    semaphore = asyncio.Semaphore(context.config.get("apple_notarization_concurrency") or 1)
+
+    async def _wait(submission_id):
         await retry_async(
             func=rcodesign_notary_wait,
             args=(submission_id, context.apple_credentials_path),
             attempts=attempts,
             retry_exceptions=RCodesignError,
         )
-    for path in submissions_map.keys():
-        await retry_async(
-            func=rcodesign_staple,
-            args=[path],
-            attempts=attempts,
-            retry_exceptions=RCodesignError,
-        )
+
+    async def _notarize_wait_staple(path):
+        submission_id = journal and journal.get_submission_id(path)
+        if submission_id:
+            log.info(f"Resuming notarization of {path}: waiting on submission {submission_id} from a previous run")
+            try:
+                await _wait(submission_id)
+            except RCodesignError as e:
+                log.warning(f"Submission {submission_id} of {path} failed ({e}); resubmitting")
+                submission_id = None
+        if not submission_id:
+            async with semaphore:
+                submission_id = await retry_async(
+                    func=rcodesign_notarize,
+                    args=(path, context.apple_credentials_path),
+                    attempts=attempts,
+                    retry_exceptions=RCodesignError,
+                )
+            if journal:
+                journal.update(path, submission_id, SUBMITTED)
+            await _wait(submission_id)
+        if journal:
+            journal.update(path, submission_id, ACCEPTED)
+        async with semaphore:
+            await retry_async(
+                func=rcodesign_staple,
+                args=[path],
+                attempts=attempts,
+                retry_exceptions=RCodesignError,
+            )
+        if journal:
+            journal.update(path, submission_id, STAPLED)
+        log.info(f"Notarized and stapled {path}")
+
+    await raise_future_exceptions([asyncio.ensure_future(_notarize_wait_staple(path)) for path in paths])
+
+
+def _get_notarization_digest(path):
+    """Return the sha256 of the upstream artifact `path`, to key the notarization journal by.
+
+    The journal is only an optimization, so if `path` can't be read, return None
+    and don't journal it.
+    """
+    try:
+        return utils.get_hash(path, "sha256")
+    except OSError as e:
+        log.warning(f"Not journaling the notarization of {path}: {e}")
+        return None
 
 
-async def _probe_staple_collect_failures(paths, probe_kwargs):
+async def _probe_staple_collect_failures(paths, probe_kwargs, concurrency=1):
     """Staple-probe each path; return the subset whose probe raised RCodesignError.
 
     A successful probe means the notarization ticket already exists server-side
     (transitively via a parent .pkg, a prior run, or a sibling task), so the path
     needs no fresh notarization. ``probe_kwargs`` is forwarded to retry_async.
+    Up to ``concurrency`` paths are probed at once.
     """
-    needs_notarization = []
-    for path in paths:
-        try:
-            await retry_async(
-                func=rcodesign_staple,
-                args=[path],
-                retry_exceptions=RCodesignError,
-                **probe_kwargs,
-            )
-        except RCodesignError:
-            needs_notarization.append(path)
-    return needs_notarization
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _probe(path):
+        async with semaphore:
+            try:
+                await retry_async(
+                    func=rcodesign_staple,
+                    args=[path],
+                    retry_exceptions=RCodesignError,
+                    **probe_kwargs,
+                )
+            except RCodesignError:
+                return False
+            return True
+
+    probed = await asyncio.gather(*(_probe(path) for path in paths))
+    return [path for path, stapled in zip(paths, probed) if not stapled]
 
 
 @time_async_function
@@ -1779,9 +2926,15 @@ async def apple_notarize_stacked(context, filelist_dict):
     On a rerun (RUN_ID != 0) the .pkgs were likely already submitted to Apple by
     a prior run, so their notarization tickets already exist server-side; we
     probe-staple each .pkg first and only re-notarize the ones whose probe fails.
+    Submissions are recorded in a `NotarizationJournal` artifact, so a rerun
+    waits on a submission a prior run made instead of submitting it again.
+
+    Within each phase, up to ``apple_notarization_concurrency`` paths are
+    submitted, waited on, stapled or probed concurrently.
     """
     ATTEMPTS = 5
     STAPLE_PROBE_RETRY_KWARGS = {"attempts": 3, "sleeptime_kwargs": {"delay_factor": 15}}
+    concurrency = context.config.get("apple_notarization_concurrency") or 1
 
     # Cast RUN_ID
     run_id = int(os.environ.get("RUN_ID") or 0)
@@ -1790,6 +2943,7 @@ async def apple_notarize_stacked(context, filelist_dict):
     relpath_index_map = {}
     paths_to_notarize = []
     task_index = 0
+    journal = NotarizationJournal(context.config["artifact_dir"])
 
     # Create list of files to be notarized + check for potential problems
     for relpath, path_dict in filelist_dict.items():
@@ -1799,10 +2953,13 @@ async def apple_notarize_stacked(context, filelist_dict):
         shutil.rmtree(notarization_workdir, ignore_errors=True)
         utils.mkdir(notarization_workdir)
         _, extension = os.path.splitext(relpath)
+        digest = _get_notarization_digest(path_dict["full_path"])
         if extension == ".pkg":
             path = os.path.join(notarization_workdir, relpath)
             utils.copy_to_dir(path_dict["full_path"], notarization_workdir, target=relpath)
             paths_to_notarize.append(path)
+            if digest:
+                journal.register(path, f"{digest}:{relpath}")
         elif extension == ".gz":
             await _extract_tarfile(context, path_dict["full_path"], extension, notarization_workdir)
             workdir_files = os.listdir(notarization_workdir)
@@ -1812,9 +2969,19 @@ async def apple_notarize_stacked(context, filelist_dict):
             for file in supported_files:
                 path = os.path.join(notarization_workdir, file)
                 paths_to_notarize.append(path)
+                if digest:
+                    journal.register(path, f"{digest}:{relpath}/{file}")
         else:
             raise SigningScriptError(f"Unsupported file extension: {extension} for file {relpath}")
 
+    # On a rerun, pick up the submissions of the previous runs. scriptworker sets
+    # TASK_ID and TASKCLUSTER_ROOT_URL along with RUN_ID.
+    task_id = os.environ.get("TASK_ID")
+    root_url = os.environ.get("TASKCLUSTER_ROOT_URL")
+    session = getattr(context, "session", None)
+    if run_id != 0 and task_id and task_id != "None" and root_url and session:
+        await journal.load_previous_run(session, root_url, task_id, run_id)
+
     pkg_paths = [p for p in paths_to_notarize if p.endswith(".pkg")]
     app_paths = [p for p in paths_to_notarize if p.endswith(".app")]
 
@@ -1824,13 +2991,13 @@ async def apple_notarize_stacked(context, filelist_dict):
     # and only re-notarize the ones whose probe fails.
     # The probe only succeeds for submissions Apple has already finished
     # processing (Accepted); a .pkg still in flight from the prior run can't be
-    # stapled yet, so it falls through and gets re-submitted. In order to fix this
-    # corner case we'd need to persist submission ids across runs.
+    # stapled yet, so it falls through, and we wait on its journaled submission
+    # instead of submitting it again.
     if run_id != 0:
-        pkgs_needing_notarization = await _probe_staple_collect_failures(pkg_paths, {"attempts": 1})
-        await _notarize_wait_staple_batch(context, pkgs_needing_notarization, ATTEMPTS)
+        pkgs_needing_notarization = await _probe_staple_collect_failures(pkg_paths, {"attempts": 1}, concurrency)
+        await _notarize_wait_staple_batch(context, pkgs_needing_notarization, ATTEMPTS, journal)
     else:
-        await _notarize_wait_staple_batch(context, pkg_paths, ATTEMPTS)
+        await _notarize_wait_staple_batch(context, pkg_paths, ATTEMPTS, journal)
 
     # Phase B: staple probe per .app; success means the .app was transitively
     # validated by its parent .pkg in Phase A. When no .pkg ran in Phase A,
@@ -1843,10 +3010,10 @@ async def apple_notarize_stacked(context, filelist_dict):
     # where every .pkg probe succeeds, the apps still have a parent ticket and
     # so still warrant the longer retry budget.
     probe_kwargs = STAPLE_PROBE_RETRY_KWARGS if pkg_paths else {"attempts": 1}
-    apps_needing_notarization = await _probe_staple_collect_failures(app_paths, probe_kwargs)
+    apps_needing_notarization = await _probe_staple_collect_failures(app_paths, probe_kwargs, concurrency)
 
     # Phase C: full pipeline fallback for .apps that failed the probe
-    await _notarize_wait_staple_batch(context, apps_needing_notarization, ATTEMPTS)
+    await _notarize_wait_staple_batch(context, apps_needing_notarization, ATTEMPTS, journal)
 
     # Wrap up
     stapled_files = []
@@ -8,13 +8,17 @@ Attributes:
 
 """
 
+import asyncio
+import contextlib
 import logging
 import os
+import time
 
 from immutabledict import immutabledict
 from scriptworker.exceptions import TaskVerificationError
 from scriptworker.utils import get_single_item_from_sequence
 
+from signingscript import metrics
 from signingscript.sign import (
     apple_notarize,
     apple_notarize_geckodriver,
@@ -23,11 +27,13 @@ from signingscript.sign import (
     sign_authenticode,
     sign_file,
     sign_file_detached,
+    sign_gpg_files_with_autograph,
     sign_gpg_with_autograph,
     sign_macapp,
     sign_mar384_with_autograph_hash,
     sign_omnija,
     sign_rpm_pkg,
+    sign_rpm_pkgs,
     sign_widevine,
     sign_xpi,
 )
@@ -67,6 +73,27 @@ FORMAT_TO_SIGNING_FUNCTION = immutabledict(
 )
 
 
+# These formats can sign many files in a single call, see `sign_batch`. Keyed
+# by format without the `stage_` or `gcp_prod_` prefix.
+FORMAT_TO_BATCH_SIGNING_FUNCTION = immutabledict(
+    {
+        "autograph_gpg": sign_gpg_files_with_autograph,
+        "autograph_rpmsign": sign_rpm_pkgs,
+    }
+)
+
+
+# These formats share a fixed working directory under `work_dir`, so they must
+# never run concurrently, whatever `max_concurrent_artifacts_per_format` says.
+_SERIALIZED_FORMATS = frozenset(
+    (
+        "apple_notarization",
+        "apple_notarization_geckodriver",
+        "apple_notarization_openh264_plugin",
+    )
+)
+
+
 # task_cert_type {{{1
 def task_cert_type(context):
     """Extract task certificate type.
@@ -158,14 +185,77 @@ async def sign(context, path, signing_formats, **kwargs):
             size = os.path.getsize(output)
         except OSError:
             size = "??"
-        log.info("sign(): Signing %s bytes in %s with %s...", size, output, fmt)
-        output = await signing_func(context, output, fmt, **kwargs)
+        with metrics.measure_operation(os.path.relpath(output, context.config["work_dir"]), fmt, size=size if isinstance(size, int) else None) as operation:
+            queued = time.monotonic()
+            async with _get_format_semaphore(context, fmt):
+                metrics.add_counters(queue_wait=time.monotonic() - queued)
+                log.info("sign(): Signing %s bytes in %s with %s...", size, output, fmt)
+                output = await signing_func(context, output, fmt, **kwargs)
+            operation["signed_size"] = _get_total_size(output)
     # We want to return a list
     if not isinstance(output, (tuple, list)):
         output = [output]
     return output
 
 
+# sign_batch {{{1
+def get_batch_signing_function(fmt_and_key_id):
+    """Return the function to sign many files with `fmt_and_key_id` at once, or None if there isn't one."""
+    fmt, _ = split_autograph_format(fmt_and_key_id)
+    return FORMAT_TO_BATCH_SIGNING_FUNCTION.get(fmt.removeprefix("stage_").removeprefix("gcp_prod_"))
+
+
+async def sign_batch(context, paths, fmt):
+    """Sign several files with a single format, in one call to its batch signing function.
+
+    Args:
+        context (Context): the signing context
+        paths (list): the source files to sign
+        fmt (str): the format to sign with; see `FORMAT_TO_BATCH_SIGNING_FUNCTION`
+
+    Returns:
+        list: the list of paths generated, including any detached sigfiles.
+
+    """
+    signing_func = get_batch_signing_function(fmt)
+    size = _get_total_size(paths)
+    with metrics.measure_operation(f"{len(paths)} files", fmt, size=size) as operation:
+        log.info("sign_batch(): Signing %s bytes in %d files with %s...", size, len(paths), fmt)
+        output = await signing_func(context, paths, fmt)
+        operation["signed_size"] = _get_total_size(output)
+    return output
+
+
+def _get_total_size(paths):
+    """Return the total size of the signing output `paths`, or None if it can't be read."""
+    if not isinstance(paths, (tuple, list)):
+        paths = [paths]
+    try:
+        return sum(os.path.getsize(path) for path in paths)
+    except (OSError, TypeError):
+        return None
+
+
+def _get_format_semaphore(context, fmt_and_key_id):
+    """Return the per-format concurrency limiter for `fmt_and_key_id`.
+
+    The semaphores are created lazily in `context.signing_format_semaphores`,
+    which `async_main` initializes. If it isn't set, or there is no
+    per-format limit, return a no-op context manager.
+
+    """
+    semaphores = getattr(context, "signing_format_semaphores", None)
+    fmt, _ = split_autograph_format(fmt_and_key_id)
+    limit = context.config.get("max_concurrent_artifacts_per_format")
+    if fmt.removeprefix("stage_").removeprefix("gcp_prod_") in _SERIALIZED_FORMATS:
+        limit = 1
+    if semaphores is None or not limit:
+        return contextlib.nullcontext()
+    if fmt not in semaphores:
+        semaphores[fmt] = asyncio.Semaphore(limit)
+    return semaphores[fmt]
+
+
 def _get_signing_function_from_format(fmt_and_key_id):
     fmt, _ = split_autograph_format(fmt_and_key_id)
 
@@ -1,18 +1,29 @@
 """Signingscript general utility functions."""
 
 import asyncio
+import fcntl
 import hashlib
 import json
 import logging
 import os
+import tempfile
 from asyncio.subprocess import PIPE, STDOUT
 from dataclasses import dataclass
-from shutil import copyfile
+from shutil import copyfileobj
 
 from signingscript.exceptions import FailedSubprocess, SigningScriptError, SigningServerError
 
 log = logging.getLogger(__name__)
 
+# The ioctl to clone the extents of one file into another on copy-on-write
+# filesystems like btrfs and xfs (FICLONE in linux/fs.h)
+_FICLONE = 0x40049409
+_COPY_FILE_RANGE_SIZE = 1 << 30
+# Reading the umask means setting it, so read it once at import, before any
+# other threads or processes might be creating files
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 
 @dataclass
 class Autograph:
@@ -47,6 +58,11 @@ def mkdir(path):
         pass
 
 
+def get_default_file_mode():
+    """Return the permissions a newly created file would get, given the umask."""
+    return 0o666 & ~_UMASK
+
+
 def get_hash(path, hash_type="sha512"):
     """Get the hash of a given path.
 
@@ -145,14 +161,55 @@ async def log_output(fh, log_level=logging.INFO):
             break
 
 
-def copy_to_dir(source, parent_dir, target=None):
+def _clone_file(source, target_path):
+    """Copy `source` to `target_path`, sharing its data blocks where possible.
+
+    Reflink first: on filesystems that support it, that's a copy-on-write
+    clone made in constant time, which is still a separate file, so it's safe
+    to sign in place. Otherwise copy within the kernel with
+    `os.copy_file_range`, and as a last resort, through userspace.
+
+    Returns:
+        str: how the file was copied, for logging
+
+    """
+    with open(source, "rb") as src, open(target_path, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return "Reflinked"
+        except OSError:
+            pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(src.fileno(), dst.fileno(), _COPY_FILE_RANGE_SIZE):
+                    pass
+                return "Copied"
+            except OSError:
+                # e.g. across filesystems on older kernels; start over
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+        copyfileobj(src, dst)
+        return "Copied"
+
+
+def copy_to_dir(source, parent_dir, target=None, hardlink=False):
     """Copy `source` to `parent_dir`, optionally renaming.
 
+    The copy is a reflink where the filesystem supports it (see
+    `_clone_file`). It's written next to the target and moved into place, so
+    an existing target that's hardlinked elsewhere is replaced rather than
+    overwritten.
+
     Args:
         source (str): the source path
         parent_dir (str): the target parent dir. This doesn't have to exist
         target (str, optional): the basename of the target file.  If None,
             use the basename of `source`. Defaults to None.
+        hardlink (bool, optional): hardlink the target to `source` rather
+            than copying it, if they're on the same filesystem. Only use this
+            if neither will be modified in place afterwards, e.g. never for
+            files that are about to be signed. Defaults to False.
 
     Raises:
         SigningServerError: on failure
@@ -164,8 +221,26 @@ def copy_to_dir(source, parent_dir, target=None):
         parent_dir = os.path.dirname(target_path)
         mkdir(parent_dir)
         if source != target_path:
-            log.info("Copying %s to %s" % (source, target_path))
-            copyfile(source, target_path)
+            fd, tmp_path = tempfile.mkstemp(prefix=".copy", dir=parent_dir)
+            os.close(fd)
+            try:
+                method = None
+                if hardlink:
+                    os.unlink(tmp_path)
+                    try:
+                        os.link(source, tmp_path)
+                        method = "Hardlinked"
+                    except OSError:
+                        pass
+                if method is None:
+                    method = _clone_file(source, tmp_path)
+                    os.chmod(tmp_path, get_default_file_mode())
+                os.replace(tmp_path, target_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            log.info("%s %s to %s" % (method, source, target_path))
             return target_path
         else:
             log.info("Not copying %s to itself" % (source))
@@ -200,6 +275,27 @@ async def execute_subprocess(command, log_level=logging.INFO, **kwargs):
         raise FailedSubprocess("Command `{}` failed".format(" ".join(command)))
 
 
+async def run_in_process_pool(context, func, *args):
+    """Run CPU bound `func(*args)` in `context.process_pool`.
+
+    If there's no process pool, run it in this process instead, blocking the
+    event loop. `func` and `args` have to be picklable.
+
+    Args:
+        context (Context): the signing context
+        func (callable): the function to run
+        *args: the arguments to pass to `func`
+
+    Returns:
+        the return value of `func`
+
+    """
+    pool = getattr(context, "process_pool", None)
+    if pool is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+
+
 def is_apk_autograph_signing_format(format_):
     """Return bool of whether a signing format is an APK.
 
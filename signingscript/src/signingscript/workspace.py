@@ -0,0 +1,179 @@
+"""Scratch directory tracking and a disk budget for `work_dir`.
+
+Several signing functions extract archives into `mkdtemp` trees under
+`work_dir`, and leave them there until the whole of `work_dir` is wiped,
+trading disk space for speed. On tasks with many large artifacts, that can
+fill the worker's disk.
+
+`WorkspaceManager` tracks the scratch directories made while signing each
+artifact, and removes them as soon as that artifact's outputs are in
+`artifact_dir`. If the scratch directories of the running artifacts take up
+more than `disk_budget` bytes, new artifacts wait for running ones to finish
+and be reclaimed before they start, rather than failing for lack of space.
+One artifact is always allowed to run, so an artifact bigger than the budget
+still gets signed. Only scratch directories count towards the budget, since
+they're all that gets reclaimed; the inputs and outputs in `work_dir` stay
+until the task is done.
+
+Scratch directories are measured when a new artifact is about to start, and
+when they're removed, in the default executor so the walk doesn't block the
+event loop.
+
+Like `metrics`, the active manager and the artifact being signed are held in
+context variables, so the signing functions only need to call `mkdtemp`.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import logging
+import os
+import shutil
+import tempfile
+
+log = logging.getLogger(__name__)
+
+_manager = contextvars.ContextVar("workspace_manager", default=None)
+_artifact = contextvars.ContextVar("workspace_artifact", default=None)
+
+
+def get_disk_usage(path):
+    """Return the disk space taken by the files under `path`, in bytes."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except FileNotFoundError:
+                # Removed while we were walking
+                pass
+    return total
+
+
+def _get_dirs_usage(paths):
+    """Return the disk space taken by the directories `paths`, in bytes."""
+    return sum(get_disk_usage(path) for path in paths)
+
+
+def _remove_dirs(paths):
+    """Remove the directories `paths`, and return how many bytes they took up."""
+    size = _get_dirs_usage(paths)
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+    return size
+
+
+class WorkspaceManager:
+    """Reclaim per-artifact scratch directories, and keep them to a disk budget.
+
+    Args:
+        work_dir (str): the directory the scratch directories are made in
+        disk_budget (int, optional): how many bytes the scratch directories of
+            running artifacts can take up before new artifacts have to wait.
+            If None or 0, never wait.
+
+    Attributes:
+        in_flight (int): the number of artifacts being signed
+        throttled (int): the number of artifacts that had to wait for the budget
+        reclaimed (int): the number of bytes of scratch directories removed
+
+    """
+
+    def __init__(self, work_dir, disk_budget=None):
+        """Initialize WorkspaceManager."""
+        self.work_dir = work_dir
+        self.disk_budget = disk_budget
+        self.in_flight = 0
+        self.throttled = 0
+        self.reclaimed = 0
+        self._scratch_dirs = {}
+        self._scratch_usage = {}
+        self._condition = asyncio.Condition()
+
+    def activate(self):
+        """Make this the manager for the current context, and any tasks started from it."""
+        _manager.set(self)
+
+    def mkdtemp(self, prefix, dir):
+        """Make a scratch directory under `dir`, to be reclaimed with the current artifact."""
+        path = tempfile.mkdtemp(prefix=prefix, dir=dir)
+        name = _artifact.get()
+        if name is not None:
+            self._scratch_dirs.setdefault(name, []).append(path)
+        return path
+
+    @property
+    def scratch_usage(self):
+        """int: the bytes taken up by running artifacts' scratch directories, as last measured."""
+        return sum(self._scratch_usage.values())
+
+    async def reclaim(self, name):
+        """Remove the scratch directories made while signing the artifact `name`."""
+        paths = self._scratch_dirs.pop(name, [])
+        self._scratch_usage.pop(name, None)
+        if paths:
+            size = await asyncio.get_running_loop().run_in_executor(None, _remove_dirs, paths)
+            self.reclaimed += size
+            log.debug("Reclaimed %d bytes of %s from %s", size, paths, name)
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        for name, paths in list(self._scratch_dirs.items()):
+            usage = await loop.run_in_executor(None, _get_dirs_usage, paths)
+            # Skip artifacts that were reclaimed while we were measuring
+            if name in self._scratch_dirs:
+                self._scratch_usage[name] = usage
+
+    def _over_budget(self):
+        return bool(self.disk_budget) and self.scratch_usage > self.disk_budget
+
+    @contextlib.asynccontextmanager
+    async def artifact(self, name):
+        """Sign the artifact `name` within this context, once the disk budget allows.
+
+        Scratch directories made with `mkdtemp` inside the context are
+        removed when it exits.
+        """
+        async with self._condition:
+            if self.in_flight and self.disk_budget:
+                await self._measure()
+            if self.in_flight and self._over_budget():
+                self.throttled += 1
+                log.info(
+                    "Scratch directories are over their budget of %d bytes; waiting for other artifacts to finish before signing %s", self.disk_budget, name
+                )
+                await self._condition.wait_for(lambda: not self.in_flight or not self._over_budget())
+            self.in_flight += 1
+        token = _artifact.set(name)
+        try:
+            yield
+        finally:
+            _artifact.reset(token)
+            await self.reclaim(name)
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def log_stats(self):
+        """Log how much was reclaimed, and how often the budget held artifacts back."""
+        log.info("Workspace: reclaimed %d bytes of scratch directories, throttled %d artifacts", self.reclaimed, self.throttled)
+
+
+def mkdtemp(prefix, dir):
+    """Make a scratch directory under `dir`.
+
+    If there is an active `WorkspaceManager`, it's removed once the current
+    artifact is done; otherwise it's left until `work_dir` is wiped.
+    """
+    manager = _manager.get()
+    if manager is None:
+        return tempfile.mkdtemp(prefix=prefix, dir=dir)
+    return manager.mkdtemp(prefix, dir)
+
+
+def artifact(name):
+    """Return the context to sign the artifact `name` in, on the active `WorkspaceManager` if there is one."""
+    manager = _manager.get()
+    if manager is None:
+        return contextlib.nullcontext()
+    return manager.artifact(name)
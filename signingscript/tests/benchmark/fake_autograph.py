@@ -0,0 +1,214 @@
+"""A local stand-in for autograph, for benchmarking signingscript offline.
+
+`FakeAutograph` implements `/sign/file`, `/sign/hash`, `/sign/data` and
+`/sign/files` closely enough for signingscript to accept the results:
+
+* every request is HAWK verified, including the payload hash
+* `/sign/hash` signs sha1, sha256 and sha384 digests with `rsa_private_key`
+  if it's set, or returns 512 arbitrary bytes otherwise
+* `/sign/data` returns a real detached gpg signature if `gpg_homedir` is set
+* `/sign/file` adds `META-INF` signature files to jars (omni.ja and other
+  xpi formats), and passes everything else through unchanged
+* `/sign/files` passes the files through unchanged
+
+Each request is delayed by `latency` seconds, plus up to `jitter` seconds
+more, to model the round trip to a real autograph. If `max_concurrency` is
+set, requests beyond it are answered with a 429, like an overloaded server.
+
+Run `start_fake_autograph` to serve it from a separate process, so its memory
+and CPU use don't skew the measurements of the signingscript process.
+"""
+
+import asyncio
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import random
+import subprocess
+import time
+import zipfile
+
+import mohawk
+from aiohttp import web
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, utils
+from mohawk.exc import CredentialsLookupError, HawkFail, MacMismatch, MisComputedContentHash, TokenExpired
+from mohawk.util import calculate_mac, calculate_payload_hash, parse_authorization_header, strings_match
+
+# Importing signingscript puts its vendored mozbuild on sys.path
+import signingscript.task  # noqa: F401
+
+from mozpack import mozjar  # noqa  # isort:skip
+
+# Autograph adds these to signed jars
+JAR_SIGNATURE_FILES = ("META-INF/cose.manifest", "META-INF/cose.sig", "META-INF/manifest.mf", "META-INF/mozilla.rsa", "META-INF/mozilla.sf")
+# The digest algorithm for each digest length we're asked to sign
+_DIGEST_ALGORITHMS = {20: hashes.SHA1, 32: hashes.SHA256, 48: hashes.SHA384}
+
+
+class FakeAutograph:
+    """An in-process fake autograph server.
+
+    Args:
+        credentials (dict): the HAWK key for each accepted client id
+        latency (float, optional): the minimum delay per request, in seconds
+        jitter (float, optional): the maximum extra random delay per request, in seconds
+        max_concurrency (int, optional): answer requests beyond this many in flight with a 429
+        gpg_homedir (str, optional): the gpg home directory holding the key to sign data with
+        rsa_private_key (bytes, optional): the PEM encoded RSA key to sign hashes with
+
+    Attributes:
+        requests (int): the number of requests received
+        rejected (int): the number of requests answered with a 429 or 401
+
+    """
+
+    def __init__(self, credentials, latency=0.0, jitter=0.0, max_concurrency=None, gpg_homedir=None, rsa_private_key=None):
+        """Initialize FakeAutograph."""
+        self.rsa_private_key = rsa_private_key and serialization.load_pem_private_key(rsa_private_key, password=None)
+        self.credentials = credentials
+        self.latency = latency
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self.gpg_homedir = gpg_homedir
+        self.in_flight = 0
+        self.requests = 0
+        self.rejected = 0
+
+    def make_app(self):
+        """Return the aiohttp application."""
+        # Requests carry whole files, base64 encoded
+        app = web.Application(client_max_size=1 << 40)
+        for method, handler in (("file", self._sign_file), ("hash", self._sign_hash), ("data", self._sign_data), ("files", self._sign_files)):
+            app.router.add_post(f"/sign/{method}", self._make_handler(handler))
+        return app
+
+    def _verify_hawk(self, request, body):
+        """Verify the HAWK header of `request`, and the hash of its `body`.
+
+        This is what `mohawk.Receiver` does, but mohawk pretty prints the
+        whole payload for its debug logs, which takes seconds for large files.
+        """
+        header = parse_authorization_header(request.headers.get("Authorization", ""))
+        if header["id"] not in self.credentials:
+            raise CredentialsLookupError(f"Unknown client id {header['id']}")
+        if abs(int(header["ts"]) - time.time()) > 60:
+            raise TokenExpired("Token has expired", localtime_in_seconds=int(time.time()), www_authenticate="")
+        credentials = {"id": header["id"], "key": self.credentials[header["id"]], "algorithm": "sha256"}
+        resource = mohawk.base.Resource(
+            credentials=credentials, url=str(request.url), method=request.method, timestamp=header["ts"], nonce=header["nonce"], ext=header.get("ext")
+        )
+        content_hash = calculate_payload_hash(body, "sha256", request.headers.get("Content-Type", "")).decode()
+        if not strings_match(calculate_mac("header", resource, header.get("hash", "")), header["mac"]):
+            raise MacMismatch("MACs do not match")
+        if not strings_match(content_hash, header.get("hash", "")):
+            raise MisComputedContentHash("Payload hashes do not match")
+
+    def _make_handler(self, handler):
+        async def handle(request):
+            self.requests += 1
+            self.in_flight += 1
+            try:
+                if self.max_concurrency and self.in_flight > self.max_concurrency:
+                    self.rejected += 1
+                    return web.json_response({"error": "too many requests"}, status=429)
+                body = await request.read()
+                try:
+                    self._verify_hawk(request, body)
+                except HawkFail as e:
+                    self.rejected += 1
+                    return web.json_response({"error": str(e)}, status=401)
+                await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+                sign_reqs = json.loads(body)
+                del body
+                if isinstance(sign_reqs, dict):
+                    sign_reqs = [sign_reqs]
+                loop = asyncio.get_running_loop()
+                return web.json_response([await loop.run_in_executor(None, handler, sign_req) for sign_req in sign_reqs])
+            finally:
+                self.in_flight -= 1
+
+        return handle
+
+    def _sign_hash(self, sign_req):
+        digest = base64.b64decode(sign_req["input"])
+        if self.rsa_private_key and len(digest) in _DIGEST_ALGORITHMS:
+            signature = self.rsa_private_key.sign(digest, padding.PKCS1v15(), utils.Prehashed(_DIGEST_ALGORITHMS[len(digest)]()))
+        else:
+            signature = hashlib.sha512(digest).digest() * 8
+        return {"signature": base64.b64encode(signature).decode("ascii")}
+
+    def _sign_data(self, sign_req):
+        data = base64.b64decode(sign_req["input"])
+        if not self.gpg_homedir:
+            return {"signature": f"-----BEGIN PGP SIGNATURE-----\n\n{hashlib.sha256(data).hexdigest()}\n-----END PGP SIGNATURE-----\n"}
+        signature = subprocess.run(
+            ["gpg", "--homedir", self.gpg_homedir, "--batch", "--armor", "--detach-sign"], input=data, stdout=subprocess.PIPE, check=True
+        ).stdout
+        return {"signature": signature.decode("ascii")}
+
+    def _sign_file(self, sign_req):
+        if "cose_algorithms" not in sign_req.get("options", {}):
+            return {"signed_file": sign_req["input"]}
+        data = base64.b64decode(sign_req["input"])
+        digest = hashlib.sha256(data).digest()
+        # Rewrite the jar as a plain zip, like autograph does
+        signed = io.BytesIO()
+        with zipfile.ZipFile(signed, "w", zipfile.ZIP_DEFLATED) as zf:
+            for entry in mozjar.JarReader(fileobj=io.BytesIO(data)):
+                zf.writestr(entry.filename, entry.read())
+            for name in JAR_SIGNATURE_FILES:
+                zf.writestr(name, hashlib.sha256(digest + name.encode()).hexdigest())
+        return {"signed_file": base64.b64encode(signed.getvalue()).decode("ascii")}
+
+    def _sign_files(self, sign_req):
+        return {"signed_files": [{"name": f["name"], "content": f["content"]} for f in sign_req["files"]]}
+
+
+async def _serve(conn, kwargs):
+    runner = web.AppRunner(FakeAutograph(**kwargs).make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    conn.send(runner.addresses[0][1])
+    # Serve until the parent closes its end of the pipe
+    await asyncio.get_running_loop().run_in_executor(None, _wait_for_close, conn)
+    await runner.cleanup()
+
+
+def _wait_for_close(conn):
+    with contextlib.suppress(EOFError):
+        conn.recv()
+
+
+def _run(conn, kwargs):
+    asyncio.run(_serve(conn, kwargs))
+
+
+@contextlib.contextmanager
+def start_fake_autograph(**kwargs):
+    """Serve a `FakeAutograph` from a separate process.
+
+    Args:
+        **kwargs: passed to `FakeAutograph`
+
+    Yields:
+        str: the url of the server
+
+    """
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=_run, args=(child_conn, kwargs), daemon=True)
+    process.start()
+    child_conn.close()
+    try:
+        port = parent_conn.recv()
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        parent_conn.close()
+        process.join(timeout=10)
+        if process.is_alive():
+            process.kill()
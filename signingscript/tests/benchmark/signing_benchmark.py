@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+"""Benchmark signingscript against a local fake autograph.
+
+This drives `task.sign` over synthetic inputs for a set of representative
+formats, against a `FakeAutograph` served from its own process, and reports
+throughput, p50/p99 latency per `task.sign` call, peak RSS and the autograph
+traffic for each format and input size. Each (format, size) pair runs in a
+fresh process, so peak RSS is per scenario.
+
+Example, from the signingscript directory::
+
+    PYTHONPATH=tests python tests/benchmark/signing_benchmark.py --sizes 1M,64M,1G --latency 0.05 --json results.json
+
+Scenarios whose tools aren't installed (osslsigncode for authenticode, the
+widevine module, gpg) are reported as skipped.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import importlib.util
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import secrets
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+from dataclasses import dataclass
+from unittest import mock
+
+import aiohttp
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fake_autograph import start_fake_autograph
+from mardor.writer import MarWriter
+from scriptworker.context import Context
+
+from signingscript import sign, task
+from signingscript.concurrency import AutographConcurrencyLimiter
+from signingscript.metrics import SigningMetrics, get_rss
+from signingscript.script import get_default_config, set_up_gpg_keyring
+from signingscript.utils import Autograph
+
+from mozpack import mozjar  # noqa  # isort:skip
+
+log = logging.getLogger(__name__)
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+CERT_TYPE = "project:releng:signing:cert:dep-signing"
+CLIENT_ID = "benchmark"
+MAR_CHANNEL = "benchmark"
+_BLOCK_SIZE = 1024 * 1024
+
+
+# synthetic inputs {{{1
+def _write_data(fh, size, rng):
+    """Write `size` bytes that compress about 2:1, like a typical build."""
+    while size > 0:
+        n = min(size, _BLOCK_SIZE)
+        fh.write(rng.randbytes(n // 2) + bytes(n - n // 2))
+        size -= n
+
+
+def _make_file(path, size, rng):
+    with open(path, "wb") as fh:
+        _write_data(fh, size, rng)
+
+
+def _make_pe(path, size, rng):
+    """Write a minimal PE32 executable with a `size` byte .text section."""
+    file_alignment, section_alignment = 0x200, 0x1000
+    raw_size = max(file_alignment, -(-size // file_alignment) * file_alignment)
+    image_size = section_alignment + -(-raw_size // section_alignment) * section_alignment
+    dos_header = b"MZ" + bytes(0x3A) + (0x40).to_bytes(4, "little")
+    coff_header = b"PE\0\0" + b"".join(
+        n.to_bytes(w, "little") for n, w in ((0x14C, 2), (1, 2), (0, 4), (0, 4), (0, 4), (0xE0, 2), (0x0102, 2))
+    )
+    optional_header = b"".join(
+        n.to_bytes(w, "little")
+        for n, w in (
+            (0x10B, 2),  # PE32
+            (0, 2),  # linker version
+            (raw_size, 4),  # size of code
+            (0, 4),
+            (0, 4),
+            (section_alignment, 4),  # entry point
+            (section_alignment, 4),  # base of code
+            (0, 4),  # base of data
+            (0x400000, 4),  # image base
+            (section_alignment, 4),
+            (file_alignment, 4),
+            (0, 8),  # OS, image and subsystem versions
+            (4, 2),
+            (0, 2),
+            (0, 4),  # win32 version
+            (image_size, 4),
+            (file_alignment, 4),  # size of headers
+            (0, 4),  # checksum
+            (3, 2),  # console subsystem
+            (0, 2),
+            (0x100000, 4),
+            (0x1000, 4),
+            (0x100000, 4),
+            (0x1000, 4),
+            (0, 4),
+            (16, 4),  # number of data directories
+        )
+    ) + bytes(16 * 8)
+    section_header = b".text\0\0\0" + b"".join(
+        n.to_bytes(4, "little") for n in (raw_size, section_alignment, raw_size, file_alignment, 0, 0, 0, 0x60000020)
+    )
+    header = dos_header + coff_header + optional_header + section_header
+    with open(path, "wb") as fh:
+        fh.write(header.ljust(file_alignment, b"\0"))
+        _write_data(fh, size, rng)
+        fh.write(bytes(raw_size - size))
+
+
+def _make_mar(path, size, rng, tmp_dir):
+    payload = os.path.join(tmp_dir, "libxul.so")
+    _make_file(payload, size, rng)
+    with open(path, "wb") as fh, MarWriter(fh, productversion="100.0", channel=MAR_CHANNEL) as writer, open(payload, "rb") as f:
+        writer.add_fileobj(f, "firefox/libxul.so", compress=None, flags=0o755)
+
+
+def _make_authenticode_zip(path, size, rng, tmp_dir):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        for name in ("firefox.exe", "xul.dll", "plugin-container.exe", "updater.exe"):
+            pe_path = os.path.join(tmp_dir, name)
+            _make_pe(pe_path, size // 4, rng)
+            zf.write(pe_path, f"firefox/{name}")
+
+
+def _add_synthetic_members(tf, files, rng, tmp_dir):
+    """Add a synthetic file to the tarfile `tf` for each `name: size` in `files`."""
+    for name, size in files.items():
+        member_path = os.path.join(tmp_dir, os.path.basename(name))
+        _make_file(member_path, size, rng)
+        tf.add(member_path, name)
+
+
+def _make_widevine_tar(path, size, rng, tmp_dir):
+    # Widevine signing regenerates the precomplete file, so it has to exist
+    precomplete = os.path.join(tmp_dir, "precomplete")
+    with open(precomplete, "w") as fh:
+        fh.write('remove "firefox"\n')
+    with tarfile.open(path, "w:gz", compresslevel=1) as tf:
+        tf.add(precomplete, "firefox/precomplete")
+        files = {"firefox/firefox": size // 8, "firefox/plugin-container": size // 8, "firefox/libxul.so": size // 2, "firefox/libmozgtk.so": size // 4}
+        _add_synthetic_members(tf, files, rng, tmp_dir)
+
+
+def _make_omnija(path, size, rng):
+    entry_size = 16 * 1024
+    with mozjar.JarWriter(path) as jar:
+        names = [f"chrome/content/file{i}.js" for i in range(max(1, size // entry_size))]
+        for name in names:
+            data = rng.randbytes(entry_size // 2) + bytes(entry_size // 2)
+            jar.add(name, data)
+        # Like the real omni.ja, preload the files needed at startup
+        jar.preload(names[: max(1, len(names) // 10)])
+
+
+def _make_omnija_tar(path, size, rng, tmp_dir):
+    for name, omnija_size in (("omni.ja", size // 2), ("browser-omni.ja", size // 4)):
+        _make_omnija(os.path.join(tmp_dir, name), omnija_size, rng)
+    with tarfile.open(path, "w:gz", compresslevel=1) as tf:
+        tf.add(os.path.join(tmp_dir, "omni.ja"), "firefox/omni.ja")
+        tf.add(os.path.join(tmp_dir, "browser-omni.ja"), "firefox/browser/omni.ja")
+        _add_synthetic_members(tf, {"firefox/libxul.so": size // 4}, rng, tmp_dir)
+
+
+# scenarios {{{1
+@dataclass
+class Scenario:
+    """A format to benchmark, and how to make inputs for it."""
+
+    fmt: str
+    filename: str
+    make_input: callable
+    requires: tuple = ()
+
+    def missing_requirement(self):
+        """Return what's needed to run this scenario but isn't installed, or None."""
+        for requirement in self.requires:
+            if requirement == "widevine":
+                if importlib.util.find_spec("widevine") is None:
+                    return "the widevine module is not installed"
+            elif shutil.which(requirement) is None:
+                return f"{requirement} is not installed"
+        return None
+
+
+SCENARIOS = {
+    "mar384": Scenario("autograph_hash_only_mar384", "target.complete.mar", lambda path, size, rng, tmp_dir: _make_mar(path, size, rng, tmp_dir)),
+    "authenticode": Scenario("autograph_authenticode_sha2", "target.zip", _make_authenticode_zip, requires=("osslsigncode",)),
+    "widevine": Scenario("autograph_widevine", "target.tar.gz", _make_widevine_tar, requires=("widevine",)),
+    "omnija": Scenario("autograph_omnija", "target.tar.gz", _make_omnija_tar),
+    "gpg": Scenario("autograph_gpg", "target.tar.bz2", lambda path, size, rng, tmp_dir: _make_file(path, size, rng), requires=("gpg", "gpgv")),
+    "rpm": Scenario("autograph_rpmsign", "target.rpm", lambda path, size, rng, tmp_dir: _make_file(path, size, rng)),
+    "apk": Scenario("autograph_focus", "target.apk", lambda path, size, rng, tmp_dir: _make_file(path, size, rng)),
+}
+
+
+# running {{{1
+def percentile(values, p):
+    """Return the nearest-rank `p`th percentile of `values`."""
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def _make_context(work_dir, autograph_url, access_key, gpg_pubkey=None, config_overrides=None):
+    context = Context()
+    context.config = get_default_config(work_dir)
+    context.config.update(
+        {
+            "work_dir": os.path.join(work_dir, "work"),
+            "artifact_dir": os.path.join(work_dir, "artifacts"),
+            "taskcluster_scope_prefixes": ["project:releng:signing:"],
+            "gpg_pubkey": gpg_pubkey,
+            "widevine_cert": os.path.join(TEST_DATA_DIR, "windows.crt"),
+            "authenticode_cert": os.path.join(TEST_DATA_DIR, "windows.crt"),
+            "authenticode_ca": os.path.join(TEST_DATA_DIR, "windows.crt"),
+            "authenticode_ca_timestamp": os.path.join(TEST_DATA_DIR, "windows.crt"),
+            "authenticode_url": "https://mozilla.org",
+            "authenticode_timestamp_style": None,
+            "authenticode_timestamp_url": None,
+        }
+    )
+    context.config.update(config_overrides or {})
+    os.makedirs(context.config["work_dir"], exist_ok=True)
+    context.task = {"scopes": [CERT_TYPE]}
+    formats = [scenario.fmt for scenario in SCENARIOS.values()]
+    context.autograph_configs = {CERT_TYPE: [Autograph(autograph_url, CLIENT_ID, access_key, formats)]}
+    context.mar_channels = {CERT_TYPE: [MAR_CHANNEL]}
+    return context
+
+
+async def run_scenario(
+    name, size, autograph_url, access_key, work_dir, iterations=5, concurrency=1, gpg_pubkey=None, rsa_public_key=None, config_overrides=None, seed=0
+):
+    """Sign `iterations` copies of a synthetic input with `task.sign`, and return the measurements.
+
+    Args:
+        name (str): the `SCENARIOS` key to run
+        size (int): the approximate input size, in bytes
+        autograph_url (str): the url of the fake autograph
+        access_key (str): the HAWK key for `CLIENT_ID`
+        work_dir (str): a scratch directory
+        iterations (int, optional): how many copies to sign
+        concurrency (int, optional): how many copies to sign at once
+        gpg_pubkey (str, optional): the public key the fake autograph signs data with
+        rsa_public_key (str, optional): the public key the fake autograph signs hashes with
+        config_overrides (dict, optional): signingscript config to override
+        seed (int, optional): the seed for the synthetic input
+
+    Returns:
+        dict: the measurements
+
+    """
+    scenario = SCENARIOS[name]
+    context = _make_context(work_dir, autograph_url, access_key, gpg_pubkey, config_overrides)
+    input_dir = tempfile.mkdtemp(prefix="input", dir=work_dir)
+    input_path = os.path.join(input_dir, scenario.filename)
+    scenario.make_input(input_path, size, random.Random(seed), input_dir)
+    input_size = os.path.getsize(input_path)
+    if scenario.fmt == "autograph_gpg":
+        await set_up_gpg_keyring(context)
+
+    start_rss = get_rss()
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession() as session:
+        # Set up the context the way `async_main` does
+        context.session = session
+        context.signing_format_semaphores = {}
+        context.signing_cache = None
+        context.autograph_limiter = None
+        if context.config.get("autograph_concurrency_max"):
+            context.autograph_limiter = AutographConcurrencyLimiter(
+                context.config["autograph_concurrency_initial"],
+                context.config["autograph_concurrency_max"],
+                latency_tolerance=context.config["autograph_concurrency_latency_tolerance"],
+            )
+        context.hash_batcher = None
+        if context.config.get("autograph_hash_batch_window"):
+            context.hash_batcher = sign.AutographHashBatcher(
+                session, context.config["autograph_hash_batch_window"], context.config["autograph_hash_batch_size"], limiter=context.autograph_limiter
+            )
+        context.signing_metrics = SigningMetrics()
+        context.signing_metrics.activate()
+
+        async def sign_copy(i):
+            async with semaphore:
+                path = os.path.join(context.config["work_dir"], str(i), scenario.filename)
+                os.makedirs(os.path.dirname(path))
+                shutil.copyfile(input_path, path)
+                start = time.monotonic()
+                await task.sign(context, path, [scenario.fmt])
+                latencies.append(time.monotonic() - start)
+                shutil.rmtree(os.path.dirname(path))
+
+        # Signed mars are verified against the production keys that ship with
+        # signingscript; verify them against the fake autograph's key instead.
+        with mock.patch.object(sign, "get_mar_verification_key", return_value=rsa_public_key):
+            start = time.monotonic()
+            await asyncio.gather(*(sign_copy(i) for i in range(iterations)))
+            wall_time = time.monotonic() - start
+
+    shutil.rmtree(input_dir)
+    totals = context.signing_metrics.to_dict()["totals"]
+    return {
+        "scenario": name,
+        "format": scenario.fmt,
+        "size": input_size,
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "wall_time": wall_time,
+        "throughput": input_size * iterations / wall_time,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "peak_rss": get_rss(),
+        "rss_delta": get_rss() - start_rss,
+        "autograph_requests": totals["autograph_requests"],
+        "autograph_retries": totals["autograph_retries"],
+        "autograph_bytes_sent": totals["autograph_bytes_sent"],
+        "autograph_bytes_received": totals["autograph_bytes_received"],
+    }
+
+
+def _run_scenario_process(kwargs):
+    logging.basicConfig(level=logging.WARNING)
+    return asyncio.run(run_scenario(**kwargs))
+
+
+def make_gpg_key(gpg_homedir):
+    """Create a throwaway gpg signing key in `gpg_homedir`, and return the path to its armored public key."""
+    gpg = ["gpg", "--homedir", gpg_homedir, "--batch"]
+    subprocess.run(gpg + ["--passphrase", "", "--quick-gen-key", "signingscript benchmark", "ed25519", "sign", "never"], check=True, capture_output=True)
+    pubkey = os.path.join(gpg_homedir, "pubkey.asc")
+    with open(pubkey, "wb") as fh:
+        subprocess.run(gpg + ["--armor", "--export"], check=True, stdout=fh)
+    return pubkey
+
+
+def make_rsa_key(tmp_dir):
+    """Create a throwaway RSA key, and return it PEM encoded along with the path to its public key."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    private_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    public_key = os.path.join(tmp_dir, "rsa_public_key.pem")
+    with open(public_key, "wb") as fh:
+        fh.write(key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+    return private_key, public_key
+
+
+def parse_size(size):
+    """Parse a size like `64K`, `16M` or `1G` into bytes."""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * units[size[-1].upper()])
+    return int(size)
+
+
+def format_size(size):
+    """Format a size in bytes for humans."""
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GiB"
+
+
+def print_results(results, fh=sys.stdout):
+    """Print a table of benchmark results."""
+    columns = ("scenario", "size", "iters", "wall s", "MiB/s", "p50 s", "p99 s", "peak RSS", "requests", "retries")
+    print("  ".join(f"{c:>12}" for c in columns), file=fh)
+    for r in results:
+        if "skipped" in r:
+            print(f"{r['scenario']:>12}  {format_size(r['size']):>12}  skipped: {r['skipped']}", file=fh)
+            continue
+        row = (
+            r["scenario"],
+            format_size(r["size"]),
+            r["iterations"],
+            f"{r['wall_time']:.2f}",
+            f"{r['throughput'] / 1024**2:.1f}",
+            f"{r['p50']:.3f}",
+            f"{r['p99']:.3f}",
+            format_size(r["peak_rss"] * 1024),
+            r["autograph_requests"],
+            r["autograph_retries"],
+        )
+        print("  ".join(f"{c:>12}" for c in row), file=fh)
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenarios to run (default: %(default)s)")
+    parser.add_argument("--sizes", default="64K,1M,16M", help="comma separated input sizes, e.g. 64K,16M,1G (default: %(default)s)")
+    parser.add_argument("--iterations", type=int, default=5, help="inputs to sign per scenario and size (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=1, help="inputs to sign at once (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake autograph latency per request, in seconds (default: %(default)s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random fake autograph latency, in seconds (default: %(default)s)")
+    parser.add_argument("--max-concurrency", type=int, help="have the fake autograph answer 429 beyond this many requests in flight")
+    parser.add_argument("--config", action="append", default=[], metavar="KEY=JSON", help="override a signingscript config value")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    config_overrides = {}
+    for override in args.config:
+        key, value = override.split("=", 1)
+        config_overrides[key] = json.loads(value)
+
+    access_key = secrets.token_hex(32)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="signing-benchmark") as tmp_dir:
+        gpg_homedir = os.path.join(tmp_dir, "gnupg")
+        os.mkdir(gpg_homedir, 0o700)
+        gpg_pubkey = make_gpg_key(gpg_homedir) if shutil.which("gpg") else None
+        rsa_private_key, rsa_public_key = make_rsa_key(tmp_dir)
+        fake_kwargs = {
+            "credentials": {CLIENT_ID: access_key},
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "max_concurrency": args.max_concurrency,
+            "gpg_homedir": gpg_homedir if gpg_pubkey else None,
+            "rsa_private_key": rsa_private_key,
+        }
+        mp_context = multiprocessing.get_context("spawn")
+        with start_fake_autograph(**fake_kwargs) as autograph_url:
+            for name in args.scenarios.split(","):
+                missing = SCENARIOS[name].missing_requirement()
+                for size in map(parse_size, args.sizes.split(",")):
+                    if missing:
+                        results.append({"scenario": name, "size": size, "skipped": missing})
+                        continue
+                    run_dir = tempfile.mkdtemp(prefix=name, dir=tmp_dir)
+                    kwargs = {
+                        "name": name,
+                        "size": size,
+                        "autograph_url": autograph_url,
+                        "access_key": access_key,
+                        "work_dir": run_dir,
+                        "iterations": args.iterations,
+                        "concurrency": args.concurrency,
+                        "gpg_pubkey": gpg_pubkey,
+                        "rsa_public_key": rsa_public_key,
+                        "config_overrides": config_overrides,
+                    }
+                    # A fresh process per run, so peak RSS is per scenario
+                    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+                        results.append(executor.submit(_run_scenario_process, kwargs).result())
+                    shutil.rmtree(run_dir)
+                    print_results(results[-1:])
+
+    print()
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import os
+import random
+import shutil
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestServer
+from fake_autograph import FakeAutograph
+from signing_benchmark import CLIENT_ID, SCENARIOS, _make_pe, make_gpg_key, make_rsa_key, parse_size, percentile, run_scenario
+from winsign.pefile import calc_authenticode_digest, is_pefile
+
+from signingscript import sign
+
+
+@pytest.fixture(scope="module")
+def rsa_key(tmp_path_factory):
+    return make_rsa_key(str(tmp_path_factory.mktemp("rsa")))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("name", ("mar384", "omnija", "gpg", "rpm", "apk"))
+async def test_run_scenario(tmp_path, rsa_key, name):
+    if SCENARIOS[name].missing_requirement():
+        pytest.skip(SCENARIOS[name].missing_requirement())
+    gpg_homedir = tmp_path / "gnupg"
+    gpg_homedir.mkdir(mode=0o700)
+    gpg_pubkey = make_gpg_key(str(gpg_homedir)) if name == "gpg" else None
+    fake = FakeAutograph({CLIENT_ID: "key"}, gpg_homedir=str(gpg_homedir), rsa_private_key=rsa_key[0])
+    async with TestServer(fake.make_app()) as server:
+        url = str(server.make_url("")).rstrip("/")
+        result = await run_scenario(
+            name, 16 * 1024, url, "key", str(tmp_path), iterations=3, concurrency=2, gpg_pubkey=gpg_pubkey, rsa_public_key=rsa_key[1]
+        )
+    assert result["iterations"] == 3
+    assert result["p50"] <= result["p99"]
+    assert result["throughput"] > 0
+    assert result["autograph_requests"] == fake.requests > 0
+    assert result["autograph_retries"] == 0
+    assert result["autograph_bytes_sent"] > 0
+
+
+@pytest.mark.asyncio
+async def test_fake_autograph_rejects_bad_requests(tmp_path):
+    fake = FakeAutograph({CLIENT_ID: "key"}, max_concurrency=1)
+    async with TestServer(fake.make_app()) as server, aiohttp.ClientSession() as session:
+        url = str(server.make_url("/sign/hash"))
+        assert await sign.call_autograph(session, url, CLIENT_ID, "key", [{"input": "aGFzaA=="}])
+        with pytest.raises(aiohttp.ClientResponseError) as excinfo:
+            await sign.call_autograph(session, url, CLIENT_ID, "wrong key", [{"input": "aGFzaA=="}])
+        assert excinfo.value.status == 401
+        fake.in_flight = 1
+        with pytest.raises(aiohttp.ClientResponseError) as excinfo:
+            await sign.call_autograph(session, url, CLIENT_ID, "key", [{"input": "aGFzaA=="}])
+        assert excinfo.value.status == 429
+    assert fake.rejected == 2
+
+
+@pytest.mark.parametrize("size", (0, 1000, 4096))
+def test_make_pe(tmp_path, size):
+    path = tmp_path / "test.exe"
+    _make_pe(str(path), size, random.Random(0))
+    assert is_pefile(str(path))
+    with open(path, "rb") as fh:
+        assert calc_authenticode_digest(fh)
+
+
+def test_percentile():
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([3, 1, 2], 99) == 3
+    assert percentile(list(range(1, 101)), 99) == 99
+
+
+def test_parse_size():
+    assert parse_size("64K") == 64 * 1024
+    assert parse_size("1.5M") == 1536 * 1024
+    assert parse_size("1G") == 1024**3
+    assert parse_size("100") == 100
+
+
+@pytest.mark.skipif(shutil.which("gpg") is None, reason="gpg is not installed")
+def test_make_gpg_key(tmp_path):
+    gpg_homedir = tmp_path / "gnupg"
+    gpg_homedir.mkdir(mode=0o700)
+    pubkey = make_gpg_key(str(gpg_homedir))
+    with open(pubkey) as fh:
+        assert "BEGIN PGP PUBLIC KEY BLOCK" in fh.read()
+    assert os.path.exists(pubkey)
@@ -1,4 +1,5 @@
 import os
+import struct
 import tempfile
 from contextlib import contextmanager
 
@@ -41,6 +42,29 @@ def tmpfile():
         return tmp.name
 
 
+def make_pe(path, body=b"\x90" * 1001, pe32plus=False, certificate=None):
+    """Write a minimal PE file, with `certificate` appended as its signature if given."""
+    optional_header_size = 240 if pe32plus else 224
+    optional_header = bytearray(optional_header_size)
+    struct.pack_into("<H", optional_header, 0, 0x20B if pe32plus else 0x10B)
+    struct.pack_into("<I", optional_header, 64, 0x1234)
+    struct.pack_into("<I", optional_header, 108 if pe32plus else 92, 16)
+    dos_header = bytearray(64)
+    dos_header[:2] = b"MZ"
+    struct.pack_into("<I", dos_header, 0x3C, 64)
+    coff_header = b"PE\0\0" + struct.pack("<HHIIIHH", 0x14C, 0, 0, 0, 0, optional_header_size, 0x102)
+    data = bytes(dos_header) + coff_header + bytes(optional_header) + body
+    if certificate is not None:
+        data += b"\0" * (-len(data) % 8)
+        certtable_entry_offset = 64 + 24 + (144 if pe32plus else 128)
+        data = data[:certtable_entry_offset] + struct.pack("<II", len(data), len(certificate) + 8) + data[certtable_entry_offset + 8 :]
+        # Signing also updates the checksum
+        data = data[: 64 + 24 + 64] + b"\xff" * 4 + data[64 + 24 + 68 :]
+        data += struct.pack("<IHH", len(certificate) + 8, 0x200, 2) + certificate
+    with open(path, "wb") as fh:
+        fh.write(data)
+
+
 def die(*args, **kwargs):
     raise SigningScriptError("dying!")
 
@@ -57,6 +81,7 @@ def context(tmpdir):
     context.autograph_configs = load_autograph_configs(SERVER_CONFIG_PATH)
     context.apple_credentials_path = "fakepath"
     context.mar_channels = {TEST_CERT_TYPE: ["*"]}
+    context.autograph_limiter = None
     mkdir(context.config["work_dir"])
     mkdir(context.config["artifact_dir"])
     context.task = {"scopes": [TEST_CERT_TYPE]}
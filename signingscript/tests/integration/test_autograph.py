@@ -126,7 +126,7 @@ async def test_integration_autograph_mar_sign_hash(context, tmpdir, mocker):
     for file_name in file_names:
         _copy_files_to_work_dir(file_name, context)
 
-    mocker.patch("signingscript.sign.verify_mar_signature", new=lambda *args: None)
+    mocker.patch("signingscript.sign.verify_mar_hash_signature", new=lambda *args: None)
     context.config["autograph_configs"] = _write_server_config(tmpdir)
     context.task = _craft_task(file_names, signing_format="autograph_hash_only_mar384")
 
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from signingscript.cache import SigningCache
+
+
+@pytest.fixture(scope="function")
+def cache(tmp_path):
+    return SigningCache(str(tmp_path / "cache"), 1000)
+
+
+def test_make_key():
+    key = SigningCache.make_key("digest", "autograph_gpg", "keyid", "cert", None)
+    assert key == SigningCache.make_key("digest", "autograph_gpg", "keyid", "cert", None)
+    assert key != SigningCache.make_key("digest", "autograph_gpg", "keyid2", "cert", None)
+    assert key != SigningCache.make_key("digest", "autograph_gpg", "keyid", "cert", "ext@mozilla.org")
+    assert key != SigningCache.make_key("digest2", "autograph_gpg", "keyid", "cert", None)
+
+
+def test_bytes_roundtrip(cache):
+    assert cache.get_bytes("a") is None
+    cache.put_bytes("a", b"signature")
+    assert cache.get_bytes("a") == b"signature"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_file_roundtrip(cache, tmp_path):
+    src = tmp_path / "signed"
+    src.write_bytes(b"signed bytes")
+    to = tmp_path / "to"
+    assert not cache.get_file("a", to)
+    cache.put_file("a", src)
+    assert cache.get_file("a", to)
+    assert to.read_bytes() == b"signed bytes"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_corrupt_entry(cache):
+    cache.put_bytes("a", b"signature")
+    with open(os.path.join(cache.cache_dir, "a"), "wb") as fh:
+        fh.write(b"tampered")
+    assert cache.get_bytes("a") is None
+    assert not os.path.exists(os.path.join(cache.cache_dir, "a"))
+    assert not os.path.exists(os.path.join(cache.cache_dir, "a.json"))
+    assert cache.misses == 1
+
+
+def test_lru_eviction(cache):
+    for key in ("a", "b", "c"):
+        cache.put_bytes(key, b"x" * 400)
+        os.utime(os.path.join(cache.cache_dir, f"{key}.json"), (0, {"a": 1, "b": 2, "c": 3}[key]))
+    # "c" pushed us over the limit, so the oldest entry "a" is gone
+    cache.evict()
+    assert cache.get_bytes("a") is None
+    # Using "b" makes "c" the least recently used entry
+    assert cache.get_bytes("b") == b"x" * 400
+    cache.put_bytes("d", b"x" * 400)
+    assert cache.get_bytes("c") is None
+    assert cache.get_bytes("b") is not None
+    assert cache.get_bytes("d") is not None
@@ -0,0 +1,174 @@
+import asyncio
+from unittest import mock
+
+import aiohttp
+import pytest
+
+from signingscript.concurrency import AutographConcurrencyLimiter
+
+
+def _response_error(status):
+    return aiohttp.ClientResponseError(mock.MagicMock(), (), status=status)
+
+
+async def _hold(limiter, url, event, running):
+    async with limiter.request(url):
+        running.append(url)
+        await event.wait()
+
+
+@pytest.mark.asyncio
+async def test_limiter_caps_in_flight_per_server():
+    limiter = AutographConcurrencyLimiter(2, 10)
+    event = asyncio.Event()
+    running = []
+    tasks = [asyncio.ensure_future(_hold(limiter, "https://a.example.com/sign/hash", event, running)) for _ in range(5)]
+    tasks.append(asyncio.ensure_future(_hold(limiter, "https://b.example.com/sign/file", event, running)))
+    await asyncio.sleep(0.01)
+    # Two requests for server a are in flight, and server b has its own window
+    assert sorted(running) == ["https://a.example.com/sign/hash"] * 2 + ["https://b.example.com/sign/file"]
+    server = limiter._get_server("https://a.example.com/sign/data")
+    assert (server.in_flight, len(server.waiters)) == (2, 3)
+    event.set()
+    await asyncio.gather(*tasks)
+    assert len(running) == 6
+    assert (server.in_flight, len(server.waiters), server.queued) == (0, 0, 3)
+    # The window grew as requests succeeded, letting more of the queue through
+    assert server.max_in_flight == 3
+
+
+@pytest.mark.asyncio
+async def test_limiter_additive_increase():
+    limiter = AutographConcurrencyLimiter(2, 4)
+    server = limiter._get_server("https://autograph")
+    # Empty requests take microseconds, so jitter could look like latency growing
+    server.latency[""] = 1
+    for _ in range(2):
+        async with limiter.request("https://autograph"):
+            pass
+    assert server.window == pytest.approx(2 + 1 / 2 + 1 / 2.5)
+    for _ in range(20):
+        async with limiter.request("https://autograph"):
+            pass
+    assert server.window == 4
+
+
+@pytest.mark.asyncio
+async def test_limiter_no_increase_when_latency_grows():
+    limiter = AutographConcurrencyLimiter(2, 4)
+    server = limiter._get_server("https://autograph")
+    server.latency["/sign/hash"] = 1e-9
+    async with limiter.request("https://autograph/sign/hash"):
+        await asyncio.sleep(0.01)
+    assert server.window == 2
+
+
+@pytest.mark.asyncio
+async def test_limiter_latency_per_endpoint():
+    limiter = AutographConcurrencyLimiter(2, 4)
+    server = limiter._get_server("https://autograph")
+    server.latency["/sign/hash"] = 1e-9
+    # Slow file signing doesn't look like hash signing slowing down
+    async with limiter.request("https://autograph/sign/file"):
+        await asyncio.sleep(0.01)
+    assert server.window == 2.5
+    assert server.latency["/sign/hash"] == 1e-9
+    assert server.latency["/sign/file"] >= 0.01
+
+
+@pytest.mark.asyncio
+async def test_limiter_latency_until_response_started():
+    limiter = AutographConcurrencyLimiter(2, 4)
+    server = limiter._get_server("https://autograph")
+    async with limiter.request("https://autograph/sign/file") as response_started:
+        response_started()
+        # Streaming the response body doesn't count
+        await asyncio.sleep(0.01)
+    assert server.latency["/sign/file"] < 0.01
+
+
+@pytest.mark.parametrize(
+    "exc, decrease",
+    (
+        (_response_error(429), True),
+        (_response_error(503), True),
+        (asyncio.TimeoutError(), True),
+        (aiohttp.ServerTimeoutError(), True),
+        (_response_error(401), False),
+        (ValueError(), False),
+    ),
+)
+@pytest.mark.asyncio
+async def test_limiter_multiplicative_decrease(exc, decrease):
+    limiter = AutographConcurrencyLimiter(8, 10)
+    server = limiter._get_server("https://autograph")
+    with pytest.raises(type(exc)):
+        async with limiter.request("https://autograph"):
+            raise exc
+    assert server.window == (4 if decrease else 8)
+    assert server.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_limiter_one_decrease_per_overload():
+    limiter = AutographConcurrencyLimiter(8, 10)
+    server = limiter._get_server("https://autograph")
+    event = asyncio.Event()
+
+    async def fail():
+        async with limiter.request("https://autograph"):
+            await event.wait()
+            raise _response_error(503)
+
+    tasks = [asyncio.ensure_future(fail()) for _ in range(4)]
+    await asyncio.sleep(0.01)
+    event.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # All four requests were in flight when autograph fell over
+    assert (server.window, server.decreases) == (4, 1)
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        async with limiter.request("https://autograph"):
+            raise _response_error(503)
+    assert (server.window, server.decreases) == (2, 2)
+
+    limiter.min_window = 2
+    with pytest.raises(aiohttp.ClientResponseError):
+        async with limiter.request("https://autograph"):
+            raise _response_error(503)
+    assert server.window == 2
+
+
+@pytest.mark.asyncio
+async def test_limiter_cancelled_waiter():
+    limiter = AutographConcurrencyLimiter(1, 1)
+    event = asyncio.Event()
+    running = []
+    holder = asyncio.ensure_future(_hold(limiter, "https://autograph", event, running))
+    waiter = asyncio.ensure_future(_hold(limiter, "https://autograph", event, running))
+    await asyncio.sleep(0.01)
+    server = limiter._get_server("https://autograph")
+    assert len(server.waiters) == 1
+    waiter.cancel()
+    await asyncio.sleep(0)
+    assert len(server.waiters) == 0
+    event.set()
+    await holder
+    assert server.in_flight == 0
+
+    # A waiter that is handed a slot but cancelled before it runs gives the slot back
+    event.clear()
+    holder = asyncio.ensure_future(_hold(limiter, "https://autograph", event, running))
+    await asyncio.sleep(0)
+    waiter = asyncio.ensure_future(_hold(limiter, "https://autograph", event, running))
+    await asyncio.sleep(0)
+    event.set()
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await asyncio.gather(holder, waiter, return_exceptions=True)
+    assert server.in_flight == 0
+
+
+def test_limiter_initial_window_bounds():
+    assert AutographConcurrencyLimiter(100, 10).initial_window == 10
+    assert AutographConcurrencyLimiter(0, 10).initial_window == 1
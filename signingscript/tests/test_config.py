@@ -19,6 +19,7 @@ COMMON_CONTEXT = {
     "ZIPALIGN_PATH": "",
     "GPG_PUBKEY_PATH": "",
     "WIDEVINE_CERT_PATH": "",
+    "SIGNING_CACHE_DIR": "",
     "AUTHENTICODE_CERT_PATH": "",
     "AUTHENTICODE_CERT_PATH_EV": "",
     "AUTHENTICODE_CROSS_CERT_PATH": "",
@@ -0,0 +1,65 @@
+import asyncio
+import json
+
+import pytest
+
+from signingscript import metrics
+from signingscript.metrics import SigningMetrics
+
+
+def test_inactive_collector_is_a_noop():
+    async def run():
+        metrics.add_counters(autograph_requests=1)
+        metrics.record_function("foo", 1.0, 0)
+        with metrics.measure_operation("path", "autograph_gpg") as operation:
+            operation["signed_size"] = 1
+
+    # No collector is active in a fresh context
+    asyncio.run(run())
+
+
+@pytest.mark.asyncio
+async def test_measure_operation():
+    collector = SigningMetrics()
+    collector.activate()
+    metrics.add_counters(autograph_calls=1, autograph_requests=1)
+    with metrics.measure_operation("public/build/target.tar.gz", "autograph_widevine", size=10) as operation:
+        metrics.add_counters(queue_wait=0.5)
+
+        async def sign_in_background():
+            # Tasks started while measuring record to the same operation
+            metrics.add_counters(autograph_calls=1, autograph_requests=3, autograph_bytes_sent=100, autograph_bytes_received=200)
+
+        await asyncio.ensure_future(sign_in_background())
+        operation["signed_size"] = 20
+    with pytest.raises(ValueError):
+        with metrics.measure_operation("public/build/target.zip", "autograph_widevine", size=5):
+            raise ValueError()
+    metrics.record_function("sign_widevine", 2.0, 10)
+    metrics.record_function("sign_widevine", 1.0, 20)
+
+    result = collector.to_dict()
+    first, second = result["operations"]
+    assert first["path"] == "public/build/target.tar.gz"
+    assert (first["size"], first["signed_size"], first["succeeded"], first["queue_wait"]) == (10, 20, True, 0.5)
+    assert (first["autograph_requests"], first["autograph_retries"], first["autograph_bytes_sent"], first["autograph_bytes_received"]) == (3, 2, 100, 200)
+    assert first["wall_time"] >= 0
+    assert "rss_delta" in first
+    assert (second["succeeded"], second["autograph_requests"]) == (False, 0)
+    assert result["totals"]["autograph_requests"] == 4
+    assert result["totals"]["autograph_retries"] == 2
+    assert result["formats"]["autograph_widevine"]["count"] == 2
+    assert result["formats"]["autograph_widevine"]["failures"] == 1
+    assert result["formats"]["autograph_widevine"]["size"] == 15
+    assert result["formats"]["autograph_widevine"]["autograph_retries"] == 2
+    assert result["functions"]["sign_widevine"] == {"calls": 2, "total_time": 3.0, "max_time": 2.0, "max_rss_delta": 20}
+
+
+def test_write(tmp_path):
+    collector = SigningMetrics()
+    path = tmp_path / "signing-metrics.json"
+    collector.write(str(path))
+    result = json.loads(path.read_text())
+    assert result["operations"] == []
+    assert result["totals"]["autograph_retries"] == 0
+    assert set(result) == {"wall_time", "max_rss", "rss_delta", "totals", "formats", "operations", "functions"}
@@ -0,0 +1,68 @@
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from signingscript.notarization_journal import ACCEPTED, JOURNAL_ARTIFACT, STAPLED, SUBMITTED, NotarizationJournal
+
+
+def test_update_and_write(tmp_path):
+    journal = NotarizationJournal(str(tmp_path))
+    journal.register("/work/apple_notarize-1/foo.pkg", "abc:foo.pkg")
+    assert journal.get_submission_id("/work/apple_notarize-1/foo.pkg") is None
+
+    journal.update("/work/apple_notarize-1/foo.pkg", "1234", SUBMITTED)
+    assert journal.get_submission_id("/work/apple_notarize-1/foo.pkg") == "1234"
+    journal.update("/work/apple_notarize-1/foo.pkg", "1234", ACCEPTED)
+    assert journal.get_submission_id("/work/apple_notarize-1/foo.pkg") == "1234"
+    # Unregistered paths aren't journaled
+    journal.update("/work/apple_notarize-2/bar.pkg", "5678", SUBMITTED)
+    assert journal.get_submission_id("/work/apple_notarize-2/bar.pkg") is None
+
+    with open(tmp_path / JOURNAL_ARTIFACT) as fh:
+        assert json.load(fh) == {"submissions": {"abc:foo.pkg": {"name": "foo.pkg", "submission_id": "1234", "state": ACCEPTED}}}
+
+    # Stapled submissions are done with
+    journal.update("/work/apple_notarize-1/foo.pkg", "1234", STAPLED)
+    assert journal.get_submission_id("/work/apple_notarize-1/foo.pkg") is None
+    assert [p.name for p in (tmp_path / JOURNAL_ARTIFACT).parent.iterdir()] == ["notarization-journal.json"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "run_id,responses,expected",
+    (
+        # The latest earlier run with a journal wins
+        (3, {2: 404, 1: {"abc:foo.pkg": "run1"}, 0: {"abc:foo.pkg": "run0"}}, "run1"),
+        # Failures to download are skipped
+        (2, {1: 500, 0: {"abc:foo.pkg": "run0"}}, "run0"),
+        (2, {1: "not json", 0: 404}, None),
+        (1, {0: 404}, None),
+    ),
+)
+async def test_load_previous_run(tmp_path, run_id, responses, expected):
+    requested = []
+
+    async def get_artifact(request):
+        assert request.match_info["task_id"] == "TASK"
+        assert request.match_info["name"] == JOURNAL_ARTIFACT
+        previous_run_id = int(request.match_info["run_id"])
+        requested.append(previous_run_id)
+        response = responses[previous_run_id]
+        if isinstance(response, int):
+            return web.Response(status=response)
+        if isinstance(response, str):
+            return web.Response(text=response)
+        submissions = {key: {"name": "foo.pkg", "submission_id": submission_id, "state": SUBMITTED} for key, submission_id in response.items()}
+        return web.json_response({"submissions": submissions})
+
+    app = web.Application()
+    app.router.add_get("/api/queue/v1/task/{task_id}/runs/{run_id}/artifacts/{name:.*}", get_artifact)
+    journal = NotarizationJournal(str(tmp_path))
+    journal.register("/work/foo.pkg", "abc:foo.pkg")
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        await journal.load_previous_run(session, str(server.make_url("/")), "TASK", run_id)
+    assert journal.get_submission_id("/work/foo.pkg") == expected
+    assert requested == sorted(responses, reverse=True)[: len(requested)]
@@ -1,3 +1,5 @@
+import asyncio
+import json
 import os
 import shutil
 from unittest import mock
@@ -7,6 +9,7 @@ from conftest import TEST_DATA_DIR, noop_async, noop_sync
 
 import signingscript.sign as sign
 from signingscript.exceptions import SigningScriptError
+from signingscript.notarization_journal import JOURNAL_ARTIFACT, STAPLED, SUBMITTED, NotarizationJournal
 
 # notarization {{{1
 
@@ -83,8 +86,7 @@ async def test_apple_notarize_fail_format(context):
 
 @pytest.mark.asyncio
 async def test_notarize_geckodriver(mocker, context):
-    mocker.patch.object(sign, "_extract_tarfile", noop_async)
-    mocker.patch.object(sign, "_create_zipfile", noop_async)
+    mocker.patch.object(sign, "_transcode_tarfile_to_zipfile", noop_async)
     mocker.patch.object(sign, "_notarize_single", noop_async)
     await sign._notarize_geckodriver(context, "/foo/geckodriver.tar.gz", "/foo")
 
@@ -117,6 +119,98 @@ async def test_probe_staple_collect_failures(mocker):
     assert staple.await_count == 3
 
 
+async def _no_retry(func=None, args=(), kwargs=None, attempts=1, retry_exceptions=Exception, **_):
+    kwargs = kwargs or {}
+    return await func(*args, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_probe_staple_collect_failures_concurrency(mocker):
+    in_flight = {"now": 0, "max": 0}
+
+    async def staple_side_effect(path):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+        if path.endswith(".fail"):
+            raise sign.RCodesignError("simulated probe failure")
+
+    mocker.patch.object(sign, "rcodesign_staple", mock.AsyncMock(side_effect=staple_side_effect))
+    paths = ["/a.fail", "/b.ok", "/c.fail", "/d.ok", "/e.fail"]
+    assert await sign._probe_staple_collect_failures(paths, {"attempts": 1}, 2) == ["/a.fail", "/c.fail", "/e.fail"]
+    assert in_flight["max"] == 2
+
+
+@pytest.mark.asyncio
+async def test_notarize_wait_staple_batch(mocker, context):
+    """Each path is stapled as soon as its own wait finishes, and only rcodesign calls count towards the concurrency cap."""
+    context.config["apple_notarization_concurrency"] = 2
+    context.apple_credentials_path = "/creds"
+    mocker.patch.object(sign, "retry_async", new=_no_retry)
+    events = []
+    wait_times = {"/slow.pkg": 0.05, "/fast.pkg": 0.01, "/queued.pkg": 0.02}
+    in_flight = {"calls": 0, "max_calls": 0, "waits": 0, "max_waits": 0}
+
+    async def rcodesign_call(event, path):
+        in_flight["calls"] += 1
+        in_flight["max_calls"] = max(in_flight["max_calls"], in_flight["calls"])
+        await asyncio.sleep(0.001)
+        events.append((event, path))
+        in_flight["calls"] -= 1
+
+    async def notarize(path, creds_path):
+        await rcodesign_call("submit", path)
+        return path
+
+    async def wait(submission_id, creds_path):
+        in_flight["waits"] += 1
+        in_flight["max_waits"] = max(in_flight["max_waits"], in_flight["waits"])
+        await asyncio.sleep(wait_times[submission_id])
+        in_flight["waits"] -= 1
+
+    async def staple(path):
+        await rcodesign_call("staple", path)
+
+    mocker.patch.object(sign, "rcodesign_notarize", notarize)
+    mocker.patch.object(sign, "rcodesign_notary_wait", wait)
+    mocker.patch.object(sign, "rcodesign_staple", staple)
+
+    await sign._notarize_wait_staple_batch(context, ["/slow.pkg", "/fast.pkg", "/queued.pkg"], 5)
+    assert events == [
+        ("submit", "/slow.pkg"),
+        ("submit", "/fast.pkg"),
+        # The third submission waits for a free slot, but not for the other waits
+        ("submit", "/queued.pkg"),
+        ("staple", "/fast.pkg"),
+        ("staple", "/queued.pkg"),
+        ("staple", "/slow.pkg"),
+    ]
+    assert in_flight["max_calls"] == 2
+    assert in_flight["max_waits"] == 3
+
+
+@pytest.mark.asyncio
+async def test_notarize_wait_staple_batch_failure(mocker, context):
+    """A failing path doesn't stop the others; its error is raised at the end."""
+    context.apple_credentials_path = "/creds"
+    mocker.patch.object(sign, "retry_async", new=_no_retry)
+
+    async def notarize(path, creds_path):
+        if path == "/bad.pkg":
+            raise sign.RCodesignError("simulated notarize failure")
+        return path
+
+    staple = mock.AsyncMock()
+    mocker.patch.object(sign, "rcodesign_notarize", notarize)
+    mocker.patch.object(sign, "rcodesign_notary_wait", mock.AsyncMock())
+    mocker.patch.object(sign, "rcodesign_staple", staple)
+
+    with pytest.raises(sign.RCodesignError):
+        await sign._notarize_wait_staple_batch(context, ["/bad.pkg", "/good1.pkg", "/good2.pkg"], 5)
+    assert sorted(c.args[0] for c in staple.await_args_list) == ["/good1.pkg", "/good2.pkg"]
+
+
 @pytest.mark.asyncio
 async def test_apple_notarize_stacked(mocker, context, monkeypatch):
     # First-run path: RUN_ID unset -> no .pkg probe, full notarize for every .pkg.
@@ -322,6 +416,55 @@ async def test_apple_notarize_stacked_rerun_pkg_probe_fails(mocker, context, mon
     assert len(notarized_pkgs) == 1
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("resumed_wait_fails", (False, True))
+async def test_apple_notarize_stacked_rerun_resumes_journal(mocker, context, monkeypatch, tmp_path, resumed_wait_fails):
+    """Rerun: a .pkg still in flight in the previous run is waited on, not resubmitted."""
+    monkeypatch.setenv("RUN_ID", "2")
+    monkeypatch.setenv("TASK_ID", "TASK")
+    monkeypatch.setenv("TASKCLUSTER_ROOT_URL", "https://tc.example.com")
+    context.session = mock.MagicMock()
+    context.apple_credentials_path = "/creds"
+    mocker.patch.object(sign, "retry_async", new=_no_retry)
+    upstream = tmp_path / "upstream.pkg"
+    upstream.write_bytes(b"pkg")
+    digest = sign.utils.get_hash(str(upstream), "sha256")
+
+    async def load_previous_run(journal, session, root_url, task_id, run_id):
+        assert (session, root_url, task_id, run_id) == (context.session, "https://tc.example.com", "TASK", 2)
+        journal.entries[f"{digest}:public/app.pkg"] = {"name": "app.pkg", "submission_id": "previous", "state": SUBMITTED}
+
+    mocker.patch.object(NotarizationJournal, "load_previous_run", load_previous_run)
+
+    async def notarize(path, creds_path):
+        return "new"
+
+    async def wait(submission_id, creds_path):
+        if submission_id == "previous" and resumed_wait_fails:
+            raise sign.RCodesignError("simulated invalid submission")
+
+    notarize = mock.AsyncMock(side_effect=notarize)
+    wait = mock.AsyncMock(side_effect=wait)
+    # The probe fails, because the previous submission is still in progress
+    staple = mock.AsyncMock(side_effect=[sign.RCodesignError("simulated probe failure"), None])
+    mocker.patch.object(sign, "rcodesign_notarize", notarize)
+    mocker.patch.object(sign, "rcodesign_notary_wait", wait)
+    mocker.patch.object(sign, "rcodesign_staple", staple)
+
+    await sign.apple_notarize_stacked(context, {"public/app.pkg": {"full_path": str(upstream), "formats": ["apple_notarize_stacked"]}})
+    if resumed_wait_fails:
+        assert [c.args[0] for c in wait.await_args_list] == ["previous", "new"]
+        notarize.assert_awaited_once()
+    else:
+        assert [c.args[0] for c in wait.await_args_list] == ["previous"]
+        notarize.assert_not_awaited()
+    assert staple.await_count == 2
+
+    with open(os.path.join(context.config["artifact_dir"], JOURNAL_ARTIFACT)) as fh:
+        entry = json.load(fh)["submissions"][f"{digest}:public/app.pkg"]
+    assert entry == {"name": "app.pkg", "submission_id": "new" if resumed_wait_fails else "previous", "state": STAPLED}
+
+
 @pytest.mark.asyncio
 async def test_apple_notarize_stacked_unsupported(mocker, context):
     """Test unsupported file extensions"""
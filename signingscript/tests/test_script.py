@@ -1,4 +1,6 @@
+import asyncio
 import builtins
+import json
 import os
 from unittest.mock import MagicMock, mock_open
 
@@ -7,7 +9,7 @@ import pytest
 import scriptworker.client
 from conftest import APPLE_CONFIG_PATH, BASE_DIR, TEST_CERT_TYPE, noop_sync
 
-from signingscript import script
+from signingscript import script, workspace
 from signingscript.exceptions import SigningScriptError
 from signingscript.utils import AppleNotarization
 
@@ -85,6 +87,36 @@ async def test_async_main_gpg_pubkey_doesnt_exist(tmpdir, mocker):
         assert e.args[0] == "gpg_pubkey (faaaaaaake) doesn't exist!"
 
 
+@pytest.mark.asyncio
+async def test_async_main_signing_metrics(tmpdir, mocker):
+    mocked_copy_to_dir = mocker.Mock()
+    mocker.patch.object(script, "copy_to_dir", new=mocked_copy_to_dir)
+    await async_main_helper(tmpdir, mocker, ["autograph_mar"])
+    mocked_copy_to_dir.assert_called_with(os.path.join(tmpdir, "signing-metrics.json"), tmpdir, target="public/logs/signing-metrics.json")
+    with open(os.path.join(tmpdir, "signing-metrics.json")) as fh:
+        assert json.load(fh)["operations"] == []
+
+
+@pytest.mark.asyncio
+async def test_async_main_signing_metrics_on_failure(tmpdir, mocker):
+    mocked_copy_to_dir = mocker.Mock()
+    mocker.patch.object(script, "copy_to_dir", new=mocked_copy_to_dir)
+    with pytest.raises(SigningScriptError):
+        await async_main_helper(tmpdir, mocker, ["autograph_mar", "apple_notarization_stacked"])
+    mocked_copy_to_dir.assert_called_with(os.path.join(tmpdir, "signing-metrics.json"), tmpdir, target="public/logs/signing-metrics.json")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("extra_config, workers", (({}, os.cpu_count()), ({"process_pool_workers": 0}, os.cpu_count()), ({"process_pool_workers": 2}, 2)))
+async def test_async_main_process_pool_shutdown_on_failure(tmpdir, mocker, extra_config, workers):
+    pool_cls = mocker.patch.object(script.concurrent.futures, "ProcessPoolExecutor")
+    mocker.patch.object(script, "copy_to_dir", new=noop_sync)
+    with pytest.raises(SigningScriptError):
+        await async_main_helper(tmpdir, mocker, ["autograph_mar", "apple_notarization_stacked"], extra_config)
+    assert pool_cls.call_args[0][0] == workers
+    pool_cls.return_value.shutdown.assert_called_once_with()
+
+
 @pytest.mark.asyncio
 async def test_async_main_multiple_formats(tmpdir, mocker):
     formats = ["mar", "jar"]
@@ -138,6 +170,132 @@ async def test_async_main_autograph_authenticode(tmpdir, mocker, use_comment):
     await async_main_helper(tmpdir, mocker, formats, {}, "autograph", use_comment=use_comment)
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_concurrent,expected_max", ((None, 1), (1, 1), (2, 2), (10, 4)))
+async def test_sign_paths_concurrency(tmpdir, mocker, max_concurrent, expected_max):
+    in_flight = 0
+    max_in_flight = 0
+    signed = []
+
+    async def fake_sign(_, path, formats, authenticode_comment=None):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        signed.append(path)
+        return [path]
+
+    mocker.patch.object(script, "copy_to_dir", new=noop_sync)
+    mocker.patch.object(script, "sign", new=fake_sign)
+    context = mock.MagicMock()
+    context.config = {"work_dir": str(tmpdir), "artifact_dir": str(tmpdir), "max_concurrent_artifacts": max_concurrent}
+    filelist_dict = {f"path{i}": {"full_path": f"full_path{i}", "formats": ["autograph_mar"]} for i in range(4)}
+    await script.sign_paths(context, filelist_dict)
+    assert max_in_flight == expected_max
+    assert sorted(signed) == sorted(os.path.join(str(tmpdir), p) for p in filelist_dict)
+
+
+@pytest.mark.asyncio
+async def test_sign_paths_fails_fast(tmpdir, mocker):
+    started = []
+
+    async def fake_sign(_, path, formats, authenticode_comment=None):
+        started.append(path)
+        if path.endswith("path0"):
+            raise SigningScriptError("path0 failed")
+        await asyncio.sleep(10)
+        return [path]
+
+    mocker.patch.object(script, "copy_to_dir", new=noop_sync)
+    mocker.patch.object(script, "sign", new=fake_sign)
+    context = mock.MagicMock()
+    context.config = {"work_dir": str(tmpdir), "artifact_dir": str(tmpdir), "max_concurrent_artifacts": 2}
+    filelist_dict = {f"path{i}": {"full_path": f"full_path{i}", "formats": ["autograph_mar"]} for i in range(4)}
+    with pytest.raises(SigningScriptError, match="path0 failed"):
+        await asyncio.wait_for(script.sign_paths(context, filelist_dict), timeout=5)
+    # The last queued path never started
+    assert len(started) < len(filelist_dict)
+
+
+@pytest.mark.asyncio
+async def test_sign_path_never_hardlinks_inputs(tmp_path, mocker):
+    source = tmp_path / "cot" / "target.dmg"
+    source.parent.mkdir()
+    source.write_bytes(b"unsigned")
+
+    async def fake_sign(_, path, formats, authenticode_comment=None):
+        # Sign in place
+        with open(path, "wb") as fh:
+            fh.write(b"signed")
+        return [path]
+
+    mocker.patch.object(script, "sign", new=fake_sign)
+    context = mock.MagicMock()
+    context.config = {"work_dir": str(tmp_path / "work"), "artifact_dir": str(tmp_path / "artifacts")}
+    await script.sign_path(context, "public/target.dmg", {"full_path": str(source), "formats": ["autograph_mar"]})
+    assert source.read_bytes() == b"unsigned"
+    assert (tmp_path / "artifacts/public/target.dmg").read_bytes() == b"signed"
+    assert os.path.samefile(tmp_path / "work/public/target.dmg", tmp_path / "artifacts/public/target.dmg")
+
+
+@pytest.mark.asyncio
+async def test_sign_path_reclaims_workspace(tmp_path, mocker):
+    scratch = []
+
+    async def fake_sign(context, path, formats, authenticode_comment=None):
+        scratch.append(workspace.mkdtemp("zip", context.config["work_dir"]))
+        return [path]
+
+    mocker.patch.object(script, "copy_to_dir", new=noop_sync)
+    mocker.patch.object(script, "sign", new=fake_sign)
+    context = mock.MagicMock()
+    context.config = {"work_dir": str(tmp_path), "artifact_dir": str(tmp_path)}
+    workspace.WorkspaceManager(str(tmp_path)).activate()
+    await script.sign_path(context, "public/target.zip", {"full_path": "full_path", "formats": ["autograph_authenticode_sha2"]})
+    assert len(scratch) == 1
+    assert not os.path.exists(scratch[0])
+
+
+@pytest.mark.asyncio
+async def test_sign_batches(tmpdir, mocker):
+    batches = []
+    copied = []
+
+    async def fake_sign_batch(_, paths, fmt):
+        batches.append((fmt, paths))
+        return paths + [f"{p}.asc" for p in paths if fmt == "autograph_gpg"]
+
+    mocker.patch.object(script, "copy_to_dir", new=lambda *args, target, hardlink=False: copied.append(target))
+    mocker.patch.object(script, "sign_batch", new=fake_sign_batch)
+    context = mock.MagicMock()
+    context.config = {"work_dir": str(tmpdir), "artifact_dir": str(tmpdir)}
+    filelist_dict = {
+        "a.deb": {"full_path": "full_a", "formats": ["autograph_gpg"]},
+        "b.rpm": {"full_path": "full_b", "formats": ["autograph_rpmsign"]},
+        "c.deb": {"full_path": "full_c", "formats": ["autograph_gpg"]},
+    }
+    await script.sign_batches(context, filelist_dict)
+    assert sorted(batches) == [
+        ("autograph_gpg", [os.path.join(str(tmpdir), "a.deb"), os.path.join(str(tmpdir), "c.deb")]),
+        ("autograph_rpmsign", [os.path.join(str(tmpdir), "b.rpm")]),
+    ]
+    assert sorted(copied) == ["a.deb", "a.deb", "a.deb.asc", "b.rpm", "b.rpm", "c.deb", "c.deb", "c.deb.asc"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_bytes,formats,batched", ((0, ["autograph_gpg"], False), (1000, ["autograph_gpg"], True), (1000, ["autograph_mar", "autograph_gpg"], False)))
+async def test_async_main_batches(tmpdir, tmpfile, mocker, max_bytes, formats, batched):
+    sign_batches = mocker.patch.object(script, "sign_batches")
+    sign_paths = mocker.patch.object(script, "sign_paths")
+    mocker.patch.object(script, "set_up_gpg_keyring")
+    mocker.patch.object(script, "copy_to_dir", new=noop_sync)
+    await async_main_helper(tmpdir, mocker, formats, {"gpg_pubkey": tmpfile, "autograph_files_batch_max_bytes": max_bytes})
+    expected = {"path1": {"full_path": "full_path1", "formats": formats}}
+    sign_batches.assert_called_once_with(mock.ANY, expected if batched else {})
+    sign_paths.assert_called_once_with(mock.ANY, {} if batched else expected)
+
+
 def test_get_default_config():
     parent_dir = os.path.dirname(os.getcwd())
     c = script.get_default_config()
@@ -1,28 +1,40 @@
 import asyncio
 import base64
+import concurrent.futures
+import difflib
+import glob
 import json
 import os
 import os.path
+import pathlib
 import re
 import shutil
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
+import time
 import zipfile
 from contextlib import contextmanager
-from hashlib import file_digest, sha256
+from hashlib import file_digest, sha256, sha384
 from io import BufferedRandom, BytesIO
 from unittest import mock
 
 import aiohttp
 import pytest
 import winsign.sign
-from conftest import BASE_DIR, SERVER_CONFIG_PATH, TEST_CERT_TYPE, TEST_DATA_DIR, die, does_not_raise, noop_async, noop_sync
+from conftest import BASE_DIR, SERVER_CONFIG_PATH, TEST_CERT_TYPE, TEST_DATA_DIR, die, does_not_raise, make_pe, noop_async, noop_sync
+from mardor.reader import MarReader
+from mardor.signing import make_rsa_keypair, sign_hash
+from mardor.writer import MarWriter, add_signature_block
+from mohawk.util import calculate_payload_hash
+from mozpack import mozjar
 from scriptworker.utils import makedirs
 
 import signingscript.sign as sign
 import signingscript.utils as utils
+from signingscript.createprecomplete import generate_precomplete
 from signingscript.exceptions import SigningScriptError
 from signingscript.script import set_up_gpg_keyring
 from signingscript.utils import get_hash
@@ -68,14 +80,23 @@ class MockedSession:
         self.signed_file = signed_file
         self.exception = exception
         self.signature = signature
+        self.request_bodies = []
         self.post = mock.MagicMock(wraps=self.post)
 
-    async def post(self, *args, **kwargs):
+    def post(self, *args, **kwargs):
+        return MockedRequestContext(self._post(*args, **kwargs))
+
+    async def _post(self, *args, data=None, **kwargs):
+        # The request body is closed once the request is done, so keep a copy
+        if hasattr(data, "read"):
+            self.request_bodies.append(data.read())
+            data.seek(0)
         resp = mock.MagicMock()
         resp.status = 200
         resp.json.return_value = asyncio.Future()
         if self.signed_file:
             resp.json.return_value.set_result([{"signed_file": self.signed_file}])
+            resp.content = MockedStreamReader(json.dumps([{"signed_file": self.signed_file}]).encode(), self.exception)
         if self.signature:
             resp.json.return_value.set_result([{"signature": self.signature}])
         if self.exception:
@@ -83,6 +104,32 @@ class MockedSession:
         return resp
 
 
+class MockedRequestContext:
+    def __init__(self, coro):
+        self.coro = coro
+
+    async def __aenter__(self):
+        return await self.coro
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class MockedStreamReader:
+    def __init__(self, data, exception=None):
+        self.data = data
+        self.exception = exception
+        self.total_bytes = 0
+
+    async def iter_chunked(self, n):
+        if self.exception:
+            raise self.exception
+        # Use tiny chunks to exercise the incremental parsing
+        for i in range(0, len(self.data), 3):
+            self.total_bytes += len(self.data[i : i + 3])
+            yield self.data[i : i + 3]
+
+
 async def assert_file_permissions(archive):
     with tarfile.open(archive, mode="r") as t:
         for member in t.getmembers():
@@ -152,7 +199,8 @@ async def test_sign_file_autograph(context, mocker, to, expected):
         ("to", "to", "autograph_apk_sha1", {"pkcs7_digest": "SHA1", "zip": "passthrough"}),
     ),
 )
-async def test_sign_file_with_autograph(context, mocker, to, expected, format, options):
+async def test_sign_file_with_autograph(context, mocker, monkeypatch, tmp_path, to, expected, format, options):
+    monkeypatch.chdir(tmp_path)
     open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
     mocker.patch("builtins.open", open_mock, create=True)
 
@@ -168,9 +216,8 @@ async def test_sign_file_with_autograph(context, mocker, to, expected, format, o
     if options:
         kwargs["options"] = options
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/file", headers=mocker.ANY, data=mocker.ANY)
-    data = mocked_session.post.call_args[1]["data"]
-    data.seek(0)
-    assert json.load(data) == [kwargs]
+    assert json.loads(mocked_session.request_bodies[-1]) == [kwargs]
+    assert (tmp_path / expected).read_bytes() == b"mozilla"
 
 
 @pytest.mark.asyncio
@@ -191,7 +238,10 @@ async def test_sign_file_with_autograph_no_suitable_servers_errors(context, mock
 
 @pytest.mark.asyncio
 @pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_file_with_autograph_raises_http_error(context, mocker, to, expected):
+async def test_sign_file_with_autograph_raises_http_error(context, mocker, monkeypatch, tmp_path, to, expected):
+    tmp_path = tmp_path / "cwd"
+    tmp_path.mkdir()
+    monkeypatch.chdir(tmp_path)
     open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
     mocker.patch("builtins.open", open_mock, create=True)
 
@@ -207,6 +257,7 @@ async def test_sign_file_with_autograph_raises_http_error(context, mocker, to, e
     with pytest.raises(aiohttp.ClientError):
         await sign.sign_file_with_autograph(context, "from", "autograph_mar", to=to)
     open_mock.assert_called()
+    assert list(tmp_path.iterdir()) == []
 
 
 # sign_file_detached {{{1
@@ -238,8 +289,7 @@ async def test_sign_file_detached(context, mocker):
     assert result == [path, f"{path}.sig"]
 
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
-    called_with_data = mocked_session.post.call_args[1]["data"]
-    assert json.loads(called_with_data.read())[0]["input"] == expected_hash
+    assert json.loads(mocked_session.request_bodies[-1])[0]["input"] == expected_hash
 
     open_mock.assert_called_with(f"{path}.sig", "wb")
     fh_mock = open_mock.return_value.__enter__.return_value
@@ -266,43 +316,17 @@ def test_get_mar_verification_key(format, cert_type, keyid, raises, expected):
         assert sign.get_mar_verification_key(cert_type, format, keyid) == expected
 
 
-# verify_mar_signature {{{1
-@pytest.mark.parametrize("raises", (True, False))
-def test_verify_mar_signature(mocker, raises):
-    def fake_check_call(*args, **kwargs):
-        if raises:
-            raise subprocess.CalledProcessError("x", "foo")
-
-    mocker.patch.object(subprocess, "check_call", new=fake_check_call)
-    if raises:
-        with pytest.raises(SigningScriptError):
-            sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo")
-    else:
-        sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo")
-
-
 # sign_mar384_with_autograph_hash {{{1
-@pytest.mark.asyncio
-@pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_mar384_with_autograph_hash(context, mocker, to, expected):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
-
-    mocked_session = MockedSession(signature=base64.b64encode(b"0" * 512))
-    mocker.patch.object(context, "session", new=mocked_session)
-
-    add_signature_mock = mocker.Mock()
-    mocker.patch("signingscript.sign.add_signature_block", add_signature_mock, create=True)
+@pytest.fixture(scope="module")
+def mar_key(tmp_path_factory):
+    private_key, public_key = make_rsa_keypair(4096)
+    public_key_path = tmp_path_factory.mktemp("mar_key") / "mar_key.pem"
+    public_key_path.write_bytes(public_key)
+    return private_key, str(public_key_path)
 
-    m_mock = mocker.MagicMock()
-    m_mock.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    m_mock.productinfo = ("149.0a1", "firefox-mozilla-central")
-    MarReader_mock = mocker.Mock()
-    MarReader_mock.return_value.__enter__ = mocker.Mock(return_value=m_mock)
-    MarReader_mock.return_value.__exit__ = mocker.Mock(return_value=None)
-    mocker.patch("signingscript.sign.MarReader", MarReader_mock, create=True)
-    mocker.patch("signingscript.sign.verify_mar_signature")
 
+@pytest.fixture
+def mar_dir(context, tmp_path):
     context.autograph_configs = {
         TEST_CERT_TYPE: [
             utils.Autograph(
@@ -310,17 +334,90 @@ async def test_sign_mar384_with_autograph_hash(context, mocker, to, expected):
             )
         ]
     }
-    assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384", to=to) == expected
-    open_mock.assert_called()
-    add_signature_mock.assert_called()
-    MarReader_mock.assert_called()
-    m_mock.calculate_hashes.assert_called()
+    mar_dir = tmp_path / "mar"
+    mar_dir.mkdir()
+    return mar_dir
+
+
+def _write_mar(path, channel="firefox-mozilla-central"):
+    with open(path, "wb") as fh, MarWriter(fh, productversion="149.0a1", channel=channel) as writer:
+        writer.add_fileobj(BytesIO(b"libxul" * 1000), "firefox/libxul.so", compress=None, flags=0o755)
+        writer.add_fileobj(BytesIO(b"precomplete"), "precomplete", compress="xz", flags=0o644)
+
+
+def _fake_sign_hash(private_key):
+    async def fake_sign_hash(context, h, fmt, keyid):
+        return sign_hash(private_key, h, "sha384")
+
+    return mock.MagicMock(wraps=fake_sign_hash)
+
+
+@pytest.mark.parametrize("valid", (True, False))
+def test_verify_mar_hash_signature(mocker, mar_key, valid):
+    private_key, public_key = mar_key
+    mocker.patch.object(sign, "get_mar_verification_key", return_value=public_key)
+    digest = sha384(b"mar").digest()
+    signature = sign_hash(private_key, digest, "sha384")
+    if valid:
+        sign.verify_mar_hash_signature("dep-signing", "autograph_hash_only_mar384", digest, signature)
+    else:
+        with pytest.raises(SigningScriptError):
+            sign.verify_mar_hash_signature("dep-signing", "autograph_hash_only_mar384", digest, b"0" * 512)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("to", (None, "to.mar"))
+async def test_sign_mar384_with_autograph_hash(context, mocker, mar_dir, mar_key, to):
+    private_key, public_key = mar_key
+    from_ = mar_dir / "from.mar"
+    _write_mar(from_)
+    os.chmod(from_, 0o644)
+    to = to and str(mar_dir / to)
+    fake_sign_hash = _fake_sign_hash(private_key)
+    mocker.patch.object(sign, "sign_hash_with_autograph", fake_sign_hash)
+    mocker.patch.object(sign, "get_mar_verification_key", return_value=public_key)
+
+    # The hash signed is what mardor would sign
+    unsigned = BytesIO(from_.read_bytes())
+    expected = BytesIO()
+    add_signature_block(unsigned, expected, "sha384")
+    expected.seek(0)
+    with MarReader(expected) as m:
+        expected_hash = m.calculate_hashes()[0][1]
+
+    result = await sign.sign_mar384_with_autograph_hash(context, str(from_), "autograph_hash_only_mar384", to=to)
+    assert result == (to or str(from_))
+    fake_sign_hash.assert_called_once_with(context, expected_hash, "autograph_hash_only_mar384", None)
+
+    # The signed mar is what mardor would write, and verifies
+    expected = BytesIO()
+    add_signature_block(unsigned, expected, "sha384", sign_hash(private_key, expected_hash, "sha384"))
+    with open(result, "rb") as fh:
+        assert fh.read() == expected.getvalue()
+    with open(result, "rb") as fh, open(public_key, "rb") as key, MarReader(fh) as m:
+        assert m.verify(key.read())
+        assert m.productinfo == ("149.0a1", "firefox-mozilla-central")
+    assert os.stat(result).st_mode & 0o777 == 0o644
+    assert sorted(os.listdir(mar_dir)) == sorted({"from.mar", os.path.basename(result)})
+
+
+@pytest.mark.asyncio
+async def test_sign_mar384_with_autograph_hash_session(context, mocker, mar_dir, mar_key):
+    private_key, public_key = mar_key
+    _write_mar(mar_dir / "from.mar")
+    mocked_session = MockedSession(signature=base64.b64encode(b"0" * 512))
+    mocker.patch.object(context, "session", new=mocked_session)
+    verify = mocker.patch.object(sign, "verify_mar_hash_signature")
+    path = str(mar_dir / "from.mar")
+    assert await sign.sign_mar384_with_autograph_hash(context, path, "autograph_hash_only_mar384") == path
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
-    assert json.load(mocked_session.post.call_args[1]["data"]) == [{"input": "YjY0bWFyaGFzaA=="}]
+    digest = verify.call_args[0][2]
+    assert json.loads(mocked_session.request_bodies[-1]) == [{"input": base64.b64encode(digest).decode()}]
+    verify.assert_called_once_with(TEST_CERT_TYPE, "autograph_hash_only_mar384", digest, b"0" * 512, None)
 
 
 @pytest.mark.asyncio
-async def test_sign_mar384_with_autograph_hash_keyid(context, mocker):
+async def test_sign_mar384_with_autograph_hash_keyid(context, mocker, mar_dir, mar_key):
     context.autograph_configs = {
         TEST_CERT_TYPE: [
             utils.Autograph(
@@ -332,22 +429,16 @@ async def test_sign_mar384_with_autograph_hash_keyid(context, mocker):
             )
         ]
     }
-
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
-    mocker.patch("signingscript.sign.add_signature_block")
-    mar_reader = mocker.patch("signingscript.sign.MarReader")
-    mar_reader.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    mocker.patch("signingscript.sign.verify_mar_signature")
-
-    async def fake_sign_hash(context, h, fmt, keyid):
-        return b"#" * 512
-
-    fake_sign_hash = mock.MagicMock(wraps=fake_sign_hash)
+    private_key, public_key = mar_key
+    path = str(mar_dir / "from.mar")
+    _write_mar(path)
+    get_key = mocker.patch.object(sign, "get_mar_verification_key", return_value=public_key)
+    fake_sign_hash = _fake_sign_hash(private_key)
     mocker.patch("signingscript.sign.sign_hash_with_autograph", fake_sign_hash)
 
-    assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384:keyid1") == "from"
+    assert await sign.sign_mar384_with_autograph_hash(context, path, "autograph_hash_only_mar384:keyid1") == path
     fake_sign_hash.assert_called_with(mocker.ANY, mocker.ANY, "autograph_hash_only_mar384", "keyid1")
+    get_key.assert_called_once_with(TEST_CERT_TYPE, "autograph_hash_only_mar384", "keyid1")
 
 
 @pytest.mark.asyncio
@@ -367,79 +458,46 @@ async def test_sign_mar384_with_autograph_hash_no_suitable_servers_errors(contex
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_mar384_with_autograph_hash_returns_invalid_signature_length(context, mocker, to, expected):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
-
-    mocked_session = MockedSession(signature=base64.b64encode(b"0"))
-    mocker.patch.object(context, "session", new=mocked_session)
-
-    add_signature_mock = mocker.Mock()
-    mocker.patch("signingscript.sign.add_signature_block", add_signature_mock, create=True)
-
-    m_mock = mocker.MagicMock()
-    m_mock.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    MarReader_mock = mocker.Mock()
-    MarReader_mock.return_value.__enter__ = mocker.Mock(return_value=m_mock)
-    MarReader_mock.return_value.__exit__ = mocker.Mock(return_value=None)
-    mocker.patch("signingscript.sign.MarReader", MarReader_mock, create=True)
-
-    context.autograph_configs = {
-        TEST_CERT_TYPE: [
-            utils.Autograph(
-                "https://autograph-hsm.dev.mozaws.net", "alice", "fs5wgcer9qj819kfptdlp8gm227ewxnzvsuj9ztycsx08hfhzu", ["autograph_hash_only_mar384"]
-            )
-        ]
-    }
+@pytest.mark.parametrize("signature", (b"0", b"0" * 512), ids=("length", "invalid"))
+async def test_sign_mar384_with_autograph_hash_bad_signature(context, mocker, mar_dir, mar_key, signature):
+    from_ = mar_dir / "from.mar"
+    _write_mar(from_)
+    unsigned = from_.read_bytes()
+    mocker.patch.object(sign, "get_mar_verification_key", return_value=mar_key[1])
+
+    async def fake_sign_hash(*args):
+        return signature
+
+    mocker.patch.object(sign, "sign_hash_with_autograph", fake_sign_hash)
+    # Neither an invalid length or a signature that doesn't verify is written
     with pytest.raises(SigningScriptError):
-        assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384", to=to) == expected
-
-    open_mock.assert_called()
-    add_signature_mock.assert_called()
-    MarReader_mock.assert_called()
-    m_mock.calculate_hashes.assert_called()
-    mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
-    assert json.load(mocked_session.post.call_args[1]["data"]) == [{"input": "YjY0bWFyaGFzaA=="}]
+        await sign.sign_mar384_with_autograph_hash(context, str(from_), "autograph_hash_only_mar384", to=str(mar_dir / "to.mar"))
+    with pytest.raises(SigningScriptError):
+        await sign.sign_mar384_with_autograph_hash(context, str(from_), "autograph_hash_only_mar384")
+    assert os.listdir(mar_dir) == ["from.mar"]
+    assert from_.read_bytes() == unsigned
 
 
 @pytest.mark.asyncio
 @pytest.mark.parametrize("channel,raises", (("firefox-mozilla-central", False), ("firefox-nightly-pine", False), ("firefox-mozilla-beta", True), ("firefox-mozilla-release", True)))
-async def test_sign_mar384_with_autograph_hash_channel(context, mocker, channel, raises):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
-
-    mocked_session = MockedSession(signature=base64.b64encode(b"0" * 512))
-    mocker.patch.object(context, "session", new=mocked_session)
-
-    add_signature_mock = mocker.Mock()
-    mocker.patch("signingscript.sign.add_signature_block", add_signature_mock, create=True)
-
-    m_mock = mocker.MagicMock()
-    m_mock.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    m_mock.productinfo = ("149.0a1", channel)
-    MarReader_mock = mocker.Mock()
-    MarReader_mock.return_value.__enter__ = mocker.Mock(return_value=m_mock)
-    MarReader_mock.return_value.__exit__ = mocker.Mock(return_value=None)
-    mocker.patch("signingscript.sign.MarReader", MarReader_mock, create=True)
-    mocker.patch("signingscript.sign.verify_mar_signature")
-
-    context.autograph_configs = {
-        TEST_CERT_TYPE: [
-            utils.Autograph(
-                "https://autograph-hsm.dev.mozaws.net", "alice", "fs5wgcer9qj819kfptdlp8gm227ewxnzvsuj9ztycsx08hfhzu", ["autograph_hash_only_mar384"]
-            )
-        ]
-    }
+async def test_sign_mar384_with_autograph_hash_channel(context, mocker, mar_dir, mar_key, channel, raises):
+    private_key, public_key = mar_key
+    path = str(mar_dir / "from.mar")
+    _write_mar(path, channel=channel)
+    fake_sign_hash = _fake_sign_hash(private_key)
+    mocker.patch.object(sign, "sign_hash_with_autograph", fake_sign_hash)
+    mocker.patch.object(sign, "get_mar_verification_key", return_value=public_key)
     context.mar_channels = {
         TEST_CERT_TYPE: ["firefox-mozilla-central", "firefox-nightly-*"],
     }
 
     if raises:
         with pytest.raises(SigningScriptError):
-            await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384")
+            await sign.sign_mar384_with_autograph_hash(context, path, "autograph_hash_only_mar384")
+        fake_sign_hash.assert_not_called()
+        assert os.listdir(mar_dir) == ["from.mar"]
     else:
-        assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384") == "from"
+        assert await sign.sign_mar384_with_autograph_hash(context, path, "autograph_hash_only_mar384") == path
 
 
 # sign_macapp {{{1
@@ -557,18 +615,22 @@ async def test_sign_widevine(context, mocker, filename, fmt, raises, should_sign
     def fake_isfile(path):
         return "isdir" not in path
 
-    mocker.patch.object(sign, "_get_tarfile_files", new=fake_filelist)
+    async def fake_tar_members(*args, **kwargs):
+        return [tarfile.TarInfo(f) for f in files]
+
+    mocker.patch.object(sign, "_get_tarfile_members", new=fake_tar_members)
     mocker.patch.object(sign, "_extract_tarfile", new=fake_untar)
     mocker.patch.object(sign, "_get_zipfile_files", new=fake_filelist)
     mocker.patch.object(sign, "_extract_zipfile", new=fake_unzip)
     mocker.patch.object(sign, "_convert_dmg_to_tar_gz", new=fake_undmg)
     mocker.patch.object(sign, "sign_file", new=noop_async)
     mocker.patch.object(sign, "sign_widevine_with_autograph", new=noop_async)
+    mocker.patch.object(sign, "_get_tar_precomplete", return_value=("precomplete", b""))
+    mocker.patch.object(sign, "_rewrite_tarfile", new=noop_async)
     mocker.patch.object(sign, "makedirs", new=noop_sync)
-    mocker.patch.object(sign, "generate_precomplete", new=noop_sync)
-    mocker.patch.object(sign, "_create_tarfile", new=noop_async)
-    mocker.patch.object(sign, "_create_zipfile", new=noop_async)
-    mocker.patch.object(sign, "_run_generate_precomplete", new=noop_sync)
+    mocker.patch.object(sign, "_rewrite_zipfile", new=noop_async)
+    mocker.patch.object(sign, "_get_zip_precomplete", return_value=("precomplete", b""))
+    mocker.patch.object(sign, "_write_precomplete", new=noop_sync)
     mocker.patch.object(os.path, "isfile", new=fake_isfile)
 
     if raises:
@@ -587,45 +649,32 @@ def test_should_sign_windows(filenames, expected):
         assert sign._should_sign_windows(f) == expected
 
 
-# _run_generate_precomplete {{{1
-@pytest.mark.parametrize("num_precomplete,raises", ((1, False), (0, True), (2, True)))
-def test_run_generate_precomplete(context, num_precomplete, raises, mocker):
-    mocker.patch.object(sign, "generate_precomplete", new=noop_sync)
-    work_dir = context.config["work_dir"]
-    for i in range(0, num_precomplete):
-        path = os.path.join(work_dir, "foo", str(i))
-        makedirs(path)
-        with open(os.path.join(path, "precomplete"), "w") as fh:
-            fh.write("blah")
-    if raises:
-        with pytest.raises(SigningScriptError):
-            sign._run_generate_precomplete(context, work_dir)
-    else:
-        sign._run_generate_precomplete(context, work_dir)
-
-
-# remove_extra_files {{{1
-def test_remove_extra_files(context):
-    extra = ["a", "b/c"]
-    good = ["d", "e/f"]
-    work_dir = context.config["work_dir"]
-    all_files = []
-    for f in extra + good:
-        path = os.path.join(work_dir, f)
-        makedirs(os.path.dirname(path))
-        with open(path, "w") as fh:
-            fh.write("x")
-        if f in good:
-            all_files.append(path)
-    for f in good:
-        assert os.path.exists(os.path.join(work_dir, f))
-    output = sign.remove_extra_files(work_dir, all_files)
-    for f in extra:
-        path = os.path.realpath(os.path.join(work_dir, f))
-        assert path in output
-        assert not os.path.exists(path)
-    for f in good:
-        assert os.path.exists(os.path.join(work_dir, f))
+# _iter_line_diff {{{1
+@pytest.mark.parametrize(
+    "before,after",
+    (
+        ([], []),
+        (["a\n", "b\n"], ["a\n", "b\n"]),
+        (["d\n", "c\n", "b\n", "a\n"], ["e\n", "d\n", "b\n", "a\n", "0\n"]),
+        (["c\n", "b\n", "a\n"], ["a\n", "b\n", "c\n"]),
+        (["a\n"], []),
+        ([], ["a\n"]),
+    ),
+)
+def test_iter_line_diff(before, after):
+    diff = list(sign._iter_line_diff(before, after))
+    # Like difflib.restore, minus the ? hint lines ndiff adds
+    assert [line[2:] for line in diff if line[0] in " -"] == before
+    assert [line[2:] for line in diff if line[0] in " +"] == after
+    if before == after:
+        assert all(line.startswith("  ") for line in diff)
+
+
+def test_iter_line_diff_matches_ndiff():
+    before = [f'remove "file{i}"\n' for i in range(1000, 0, -1)]
+    after = [line for line in before if "file5" not in line]
+    after.insert(10, 'remove "file.sig"\n')
+    assert list(sign._iter_line_diff(before, after)) == list(difflib.ndiff(before, after))
 
 
 # _convert_dmg_to_tar_gz {{{1
@@ -653,7 +702,7 @@ async def test_convert_dmg_to_tar_gz(context, monkeypatch, tmpdir):
     await sign._convert_dmg_to_tar_gz(context, dmg_path)
 
 
-# _extract_zipfile _create_zipfile {{{1
+# _extract_zipfile {{{1
 @pytest.mark.asyncio
 async def test_get_zipfile_files():
     assert sorted(await sign._get_zipfile_files(os.path.join(TEST_DATA_DIR, "test.zip"))) == ["a", "b", "c/", "c/d", "c/e/", "c/e/f"]
@@ -661,22 +710,16 @@ async def test_get_zipfile_files():
 
 @pytest.mark.asyncio
 async def test_working_zipfile(context):
-    await helper_archive(context, "foo.zip", sign._create_zipfile, sign._extract_zipfile)
-    files = ["c/d", "c/e/f"]
     tmp_dir = os.path.join(context.config["work_dir"], "foo")
+    all_files = await sign._extract_zipfile(context, os.path.join(TEST_DATA_DIR, "test.zip"), tmp_dir=tmp_dir)
+    assert sorted(os.path.relpath(f, tmp_dir) for f in all_files if os.path.isfile(f)) == ["a", "b", "c/d", "c/e/f"]
+    files = ["c/d", "c/e/f"]
     expected = [os.path.join(tmp_dir, f) for f in files]
     assert await sign._extract_zipfile(context, os.path.join(TEST_DATA_DIR, "test.zip"), files=files, tmp_dir=tmp_dir) == expected
     for f in expected:
         assert os.path.exists(f)
 
 
-@pytest.mark.asyncio
-async def test_bad_create_zipfile(context, mocker):
-    mocker.patch.object(zipfile, "ZipFile", new=context_die)
-    with pytest.raises(SigningScriptError):
-        await sign._create_zipfile(context, "foo.zip", [])
-
-
 @pytest.mark.asyncio
 async def test_bad_extract_zipfile(context, mocker):
     mocker.patch.object(sign, "rm", new=die)
@@ -685,22 +728,62 @@ async def test_bad_extract_zipfile(context, mocker):
 
 
 @pytest.mark.asyncio
-async def test_zipfile_append_write(context):
-    top_dir = os.path.dirname(os.path.dirname(__file__))
-    rel_files = ["tests/test_script.py", "tests/test_sign.py"]
-    abs_files = [os.path.join(top_dir, f) for f in rel_files]
-    full_rel_files = ["a", "b", "c/", "c/d", "c/e/", "c/e/f"] + rel_files
-    to = os.path.join(context.config["work_dir"], "test.zip")
+async def test_rewrite_zipfile(context, tmp_path):
+    orig = tmp_path / "orig.zip"
+    with zipfile.ZipFile(orig, "w") as z:
+        z.writestr("stored", b"stored data", compress_type=zipfile.ZIP_STORED)
+        z.writestr("dir/", b"")
+        z.writestr("dir/unchanged", b"unchanged data" * 100, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+        z.writestr("dir/changed", b"changed data", compress_type=zipfile.ZIP_STORED)
+    with zipfile.ZipFile(orig) as z:
+        orig_infos = {i.filename: i for i in z.infolist()}
+
+    tmp_dir = os.path.join(context.config["work_dir"], "unzipped")
+    extracted = await sign._extract_zipfile(context, orig, files=["dir/unchanged", "dir/changed"], tmp_dir=tmp_dir)
+    with open(extracted[1], "wb") as fh:
+        fh.write(b"signed data")
+    new_file = os.path.join(tmp_dir, "dir", "changed.sig")
+    with open(new_file, "wb") as fh:
+        fh.write(b"sig")
+
+    to = tmp_path / "new.zip"
+    assert await sign._rewrite_zipfile(context, orig, extracted + [new_file], tmp_dir=tmp_dir, to=to) == to
+    with zipfile.ZipFile(to) as z:
+        assert z.testzip() is None
+        assert z.namelist() == ["stored", "dir/", "dir/unchanged", "dir/changed", "dir/changed.sig"]
+        infos = {i.filename: i for i in z.infolist()}
+        # Unchanged members keep their compressed data and metadata
+        for name in ("stored", "dir/", "dir/unchanged"):
+            for attr in ("compress_type", "compress_size", "CRC", "date_time", "external_attr"):
+                assert getattr(infos[name], attr) == getattr(orig_infos[name], attr)
+        assert z.read("dir/unchanged") == b"unchanged data" * 100
+        # Changed and new members are deflated
+        assert infos["dir/changed"].compress_type == zipfile.ZIP_DEFLATED
+        assert infos["dir/changed"].date_time == orig_infos["dir/changed"].date_time
+        assert z.read("dir/changed") == b"signed data"
+        assert z.read("dir/changed.sig") == b"sig"
 
-    # mode='w' -- zipfile should only have these two files
-    shutil.copyfile(os.path.join(TEST_DATA_DIR, "test.zip"), to)
-    await sign._create_zipfile(context, to, abs_files, tmp_dir=top_dir, mode="w")
-    assert sorted(await sign._get_zipfile_files(to)) == rel_files
 
-    # mode='a' -- zipfile should have previous files + new files
+@pytest.mark.asyncio
+async def test_rewrite_zipfile_in_place(context):
+    to = os.path.join(context.config["work_dir"], "test.zip")
     shutil.copyfile(os.path.join(TEST_DATA_DIR, "test.zip"), to)
-    await sign._create_zipfile(context, to, abs_files, tmp_dir=top_dir, mode="a")
-    assert sorted(await sign._get_zipfile_files(to)) == full_rel_files
+    os.chmod(to, 0o644)
+    tmp_dir = os.path.join(context.config["work_dir"], "unzipped")
+    all_files = await sign._extract_zipfile(context, to, tmp_dir=tmp_dir)
+    await sign._rewrite_zipfile(context, to, all_files, tmp_dir=tmp_dir)
+    with zipfile.ZipFile(to) as z, zipfile.ZipFile(os.path.join(TEST_DATA_DIR, "test.zip")) as orig:
+        assert z.testzip() is None
+        assert [(i.filename, i.compress_size, i.CRC) for i in z.infolist()] == [(i.filename, i.compress_size, i.CRC) for i in orig.infolist()]
+    assert os.stat(to).st_mode & 0o777 == 0o644
+    assert not [f for f in os.listdir(context.config["work_dir"]) if f.startswith("rezip")]
+
+
+@pytest.mark.asyncio
+async def test_bad_rewrite_zipfile(context):
+    with pytest.raises(SigningScriptError):
+        await sign._rewrite_zipfile(context, os.path.join(context.config["work_dir"], "missing.zip"), [])
+    assert not [f for f in os.listdir(context.config["work_dir"]) if f.startswith("rezip")]
 
 
 # tarfile {{{1
@@ -766,6 +849,302 @@ async def test_tarfile_append_write(context):
     assert sorted(await sign._get_tarfile_files(to, "bz2")) == rel_files
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ("gz", "bz2", "xz"))
+@pytest.mark.parametrize("threads", (0, 1, 4))
+async def test_create_tarfile_threads(context, mocker, compression, threads):
+    context.config["tarball_compression_threads"] = threads
+    mocker.patch.object(os, "cpu_count", return_value=16)
+    popen = mocker.spy(subprocess, "Popen")
+    to = os.path.join(context.config["work_dir"], f"foo.tar.{compression}")
+    await sign._create_tarfile(context, to, [__file__, SERVER_CONFIG_PATH], compression, tmp_dir=BASE_DIR)
+    with tarfile.open(to, f"r:{compression}") as t:
+        assert t.getnames() == [os.path.relpath(__file__, BASE_DIR), os.path.relpath(SERVER_CONFIG_PATH, BASE_DIR)]
+        assert t.extractfile(t.getnames()[0]).read() == open(__file__, "rb").read()
+    tool = sign._get_parallel_compressor(compression, 2)
+    if threads != 1 and tool:
+        assert popen.call_args[0][0][0] == tool[0]
+    else:
+        popen.assert_not_called()
+
+
+def test_get_parallel_compressor_missing(mocker):
+    mocker.patch.object(shutil, "which", return_value=None)
+    assert sign._get_parallel_compressor("xz", 4) is None
+
+
+@pytest.mark.asyncio
+async def test_create_tarfile_compressor_fails(context, mocker):
+    context.config["tarball_compression_threads"] = 4
+    mocker.patch.object(sign, "_get_parallel_compressor", return_value=["sh", "-c", "cat > /dev/null; exit 3"])
+    with pytest.raises(SigningScriptError, match="exit code 3"):
+        await sign._create_tarfile(context, os.path.join(context.config["work_dir"], "foo.tar.gz"), [__file__], "gz", tmp_dir=BASE_DIR)
+
+
+def _make_test_tarball(path, compression, top="firefox"):
+    """Create a tarball with the member types `_rewrite_tarfile` has to handle."""
+
+    def add(t, name, type_=tarfile.REGTYPE, data=b"", linkname="", mode=0o644):
+        info = tarfile.TarInfo(name)
+        info.type = type_
+        info.mode = mode
+        info.mtime = 1500000000
+        info.uid = info.gid = 1000
+        info.uname = info.gname = "builder"
+        info.linkname = linkname
+        info.size = len(data)
+        t.addfile(info, BytesIO(data) if data else None)
+
+    with tarfile.open(path, f"w:{compression}") as t:
+        add(t, f"./{top}", tarfile.DIRTYPE, mode=0o755)
+        add(t, f"./{top}/firefox", data=b"firefox binary", mode=0o755)
+        add(t, f"./{top}/forward-link", tarfile.SYMTYPE, linkname="later")
+        add(t, f"./{top}/precomplete", data=b'remove "old"\n')
+        add(t, f"./{top}/browser/omni.ja", data=b"omni data")
+        add(t, f"./{top}/hardlink", tarfile.LNKTYPE, linkname=f"./{top}/firefox", mode=0o755)
+        add(t, f"./{top}/dir-link", tarfile.SYMTYPE, linkname="browser")
+        add(t, f"./{top}/broken-link", tarfile.SYMTYPE, linkname="missing")
+        add(t, f"./{top}/empty", tarfile.DIRTYPE, mode=0o755)
+        add(t, f"./{top}/later", data=b"later")
+        add(t, f"./{top}/defaults/pref/channel-prefs.js", data=b"prefs")
+
+
+def _tar_summary(path):
+    with tarfile.open(path) as t:
+        return [
+            (m.name, m.type, m.mode, m.linkname, m.uid, m.gid, m.uname, m.gname, t.extractfile(m).read() if m.isreg() else None) for m in t.getmembers()
+        ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ("gz", "bz2", "xz"))
+async def test_rewrite_tarfile(context, tmp_path, compression):
+    # Compare with the old extract + _create_tarfile approach
+    orig = tmp_path / f"orig.tar.{compression}"
+    _make_test_tarball(orig, compression)
+    old = tmp_path / f"old.tar.{compression}"
+    all_files = await sign._extract_tarfile(context, str(orig), compression, tmp_dir=str(tmp_path / "old"))
+    (tmp_path / "old/firefox/browser/omni.ja").write_bytes(b"signed omni")
+    (tmp_path / "old/firefox/firefox.sig").write_bytes(b"sig")
+    await sign._create_tarfile(context, str(old), all_files + [str(tmp_path / "old/firefox/firefox.sig")], compression, tmp_dir=str(tmp_path / "old"))
+
+    tmp_dir = str(tmp_path / "new")
+    extracted = await sign._extract_tarfile(context, str(orig), compression, tmp_dir=tmp_dir, files=["firefox/browser/omni.ja", "firefox/firefox"])
+    assert extracted == [os.path.join(tmp_dir, "firefox/firefox"), os.path.join(tmp_dir, "firefox/browser/omni.ja")]
+    (tmp_path / "new/firefox/browser/omni.ja").write_bytes(b"signed omni")
+    (tmp_path / "new/firefox/firefox.sig").write_bytes(b"sig")
+    all_files = await sign._get_tarfile_files(str(orig), compression)
+    append_files = [os.path.join(tmp_dir, "firefox/firefox.sig")]
+    assert await sign._rewrite_tarfile(context, str(orig), compression, all_files, extracted, append_files, tmp_dir=tmp_dir) == str(orig)
+    # Only the members we asked for are extracted
+    assert sorted(str(p.relative_to(tmp_dir)) for p in pathlib.Path(tmp_dir).rglob("*") if p.is_file()) == [
+        "firefox/browser/omni.ja",
+        "firefox/firefox",
+        "firefox/firefox.sig",
+    ]
+    old_summary = _tar_summary(old)
+    new_summary = _tar_summary(orig)
+    assert new_summary == old_summary
+    assert [m[0] for m in new_summary] == [
+        "firefox/firefox",
+        "firefox/forward-link",
+        "firefox/precomplete",
+        "firefox/browser/omni.ja",
+        "firefox/hardlink",
+        "firefox/later",
+        "firefox/defaults/pref/channel-prefs.js",
+        "firefox/firefox.sig",
+    ]
+    assert all(m[4:8] == (0, 0, "", "") for m in new_summary)
+
+
+@pytest.mark.asyncio
+async def test_rewrite_tarfile_error(context, tmp_path):
+    orig = tmp_path / "orig.tar.gz"
+    _make_test_tarball(orig, "gz")
+    orig_bytes = orig.read_bytes()
+
+    all_files = await sign._get_tarfile_files(str(orig), "gz")
+    # The replacement for `firefox/later` is missing
+    with pytest.raises(SigningScriptError):
+        await sign._rewrite_tarfile(context, str(orig), "gz", all_files, [str(tmp_path / "new/firefox/later")], tmp_dir=str(tmp_path / "new"))
+    assert orig.read_bytes() == orig_bytes
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith("retar")] == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ("gz", "bz2"))
+async def test_transcode_tarfile_to_zipfile(context, tmp_path, compression):
+    # Compare with extracting the tarball and zipping up the extracted files
+    orig = tmp_path / f"orig.tar.{compression}"
+    _make_test_tarball(orig, compression)
+    old = tmp_path / "old.zip"
+    all_files = await sign._extract_tarfile(context, str(orig), compression, tmp_dir=str(tmp_path / "old"))
+    with zipfile.ZipFile(old, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        for f in all_files:
+            z.write(f, arcname=os.path.relpath(f, tmp_path / "old"))
+
+    new = tmp_path / "new.zip"
+    assert await sign._transcode_tarfile_to_zipfile(context, str(orig), compression, str(new)) == str(new)
+    # Nothing is extracted
+    assert sorted(p.name for p in tmp_path.iterdir() if p.name not in ("artifact", "work")) == ["new.zip", "old", "old.zip", f"orig.tar.{compression}"]
+
+    def summary(path):
+        with zipfile.ZipFile(path) as z:
+            return {i.filename: (i.external_attr >> 16, z.read(i)) for i in z.infolist()}
+
+    new_summary = summary(new)
+    assert new_summary == summary(old)
+    assert new_summary["firefox/firefox"] == (0o100755, b"firefox binary")
+    assert new_summary["firefox/hardlink"] == (0o100755, b"firefox binary")
+    assert new_summary["firefox/forward-link"] == (0o100644, b"later")
+    with zipfile.ZipFile(new) as z:
+        assert z.getinfo("firefox/firefox").date_time == time.gmtime(1500000000)[:6]
+
+
+@pytest.mark.asyncio
+async def test_transcode_tarfile_to_zipfile_error(context, tmp_path):
+    to = tmp_path / "new.zip"
+    with pytest.raises(SigningScriptError):
+        await sign._transcode_tarfile_to_zipfile(context, str(tmp_path / "missing.tar.gz"), "gz", str(to))
+    assert not to.exists()
+
+
+@pytest.mark.parametrize("top", ("firefox", "Firefox.app/Contents/Resources", "."))
+def test_get_tar_precomplete(tmp_path, top):
+    # Compare with running generate_precomplete on the extracted tarball
+    orig = tmp_path / "orig.tar.gz"
+    _make_test_tarball(orig, "gz", top=top)
+    extracted = tmp_path / "extracted"
+    with tarfile.open(orig) as t:
+        t.extractall(extracted)
+    (extracted / top / "firefox.sig").write_bytes(b"sig")
+    generate_precomplete(str(extracted / top))
+    with tarfile.open(orig) as t:
+        name, contents = sign._get_tar_precomplete(t.getmembers(), [os.path.join(top, "firefox.sig")])
+    assert name == os.path.normpath(os.path.join(top, "precomplete"))
+    assert contents == (extracted / top / "precomplete").read_bytes()
+    assert b'empty/"\n' in contents
+    assert b"channel-prefs.js" not in contents
+
+
+@pytest.mark.asyncio
+async def test_sign_widevine_tar_streaming(context, mocker, tmp_path):
+    orig = tmp_path / "target.tar.gz"
+    _make_test_tarball(orig, "gz")
+    # `firefox` is one of the widevine files to sign
+
+    async def fake_sign(context, from_, blessed, fmt, to=None):
+        assert not blessed
+        with open(to, "wb") as fh:
+            fh.write(b"sig")
+
+    mocker.patch.object(sign, "sign_widevine_with_autograph", new=fake_sign)
+    assert await sign.sign_widevine_tar(context, str(orig), "autograph_widevine") == str(orig)
+    with tarfile.open(orig) as t:
+        assert t.getnames()[-1] == "firefox/firefox.sig"
+        assert t.extractfile("firefox/firefox.sig").read() == b"sig"
+        precomplete = t.extractfile("firefox/precomplete").read()
+    assert b'remove "firefox.sig"\n' in precomplete
+    with open(os.path.join(context.config["artifact_dir"], "public/logs/precomplete.diff")) as fh:
+        assert '- remove "old"\n' in fh.read()
+    # The per-artifact diff in work_dir is cleaned up
+    assert glob.glob(os.path.join(context.config["work_dir"], "precomplete*.diff")) == []
+
+
+@pytest.mark.asyncio
+async def test_sign_omnija_tar_concurrent(context, mocker, tmp_path):
+    orig = tmp_path / "target.tar.gz"
+    with tarfile.open(orig, "w:gz") as t:
+        for name in ("firefox/omni.ja", "firefox/browser/omni.ja", "firefox/firefox"):
+            info = tarfile.TarInfo(name)
+            info.size = len(name)
+            t.addfile(info, BytesIO(name.encode()))
+    started = []
+    both_started = asyncio.Event()
+
+    async def fake_sign(context, from_, fmt):
+        # Each omni.ja waits for the other, so this only finishes if they're signed concurrently
+        started.append(from_)
+        if len(started) == 2:
+            both_started.set()
+        await asyncio.wait_for(both_started.wait(), 5)
+        with open(from_, "wb") as fh:
+            fh.write(b"signed")
+
+    mocker.patch.object(sign, "sign_omnija_with_autograph", new=fake_sign)
+    assert await sign.sign_omnija_tar(context, str(orig), "autograph_omnija") == str(orig)
+    with tarfile.open(orig) as t:
+        assert t.getnames() == ["firefox/omni.ja", "firefox/browser/omni.ja", "firefox/firefox"]
+        assert t.extractfile("firefox/omni.ja").read() == b"signed"
+        assert t.extractfile("firefox/browser/omni.ja").read() == b"signed"
+        assert t.extractfile("firefox/firefox").read() == b"firefox/firefox"
+
+
+def _make_test_zipfile(path, top="firefox"):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr(f"{top}/", b"")
+        z.writestr(f"{top}/firefox", b"firefox binary")
+        z.writestr(f"{top}/precomplete", b'remove "old"\n')
+        z.writestr(f"{top}/browser/omni.ja", b"omni data")
+        z.writestr(f"{top}/empty/", b"")
+        z.writestr(f"{top}/defaults/pref/channel-prefs.js", b"prefs")
+        z.writestr(f"{top}/distribution/policies.json", b"{}")
+
+
+@pytest.mark.parametrize("top", ("firefox", "Firefox.app/Contents/Resources"))
+def test_get_zip_precomplete(tmp_path, top):
+    # Compare with running generate_precomplete on the extracted zipfile
+    orig = tmp_path / "orig.zip"
+    _make_test_zipfile(orig, top=top)
+    extracted = tmp_path / "extracted"
+    with zipfile.ZipFile(orig) as z:
+        z.extractall(extracted)
+        names = z.namelist()
+    (extracted / top / "firefox.sig").write_bytes(b"sig")
+    generate_precomplete(str(extracted / top))
+    name, contents = sign._get_zip_precomplete(names, [f"{top}/firefox.sig"])
+    assert name == f"{top}/precomplete"
+    assert contents == (extracted / top / "precomplete").read_bytes()
+    assert b'empty/"\n' in contents
+    assert b"channel-prefs.js" not in contents
+
+
+@pytest.mark.parametrize("names", ([], ["a/precomplete", "b/precomplete"]))
+def test_get_zip_precomplete_errors(names):
+    with pytest.raises(SigningScriptError):
+        sign._get_zip_precomplete(names)
+
+
+@pytest.mark.asyncio
+async def test_sign_widevine_zip_partial_extraction(context, mocker, tmp_path):
+    orig = tmp_path / "target.zip"
+    _make_test_zipfile(orig)
+    extract = mocker.spy(sign, "_extract_zipfile")
+
+    async def fake_sign(context, from_, blessed, fmt, to=None):
+        assert not blessed
+        with open(to, "wb") as fh:
+            fh.write(b"sig")
+
+    mocker.patch.object(sign, "sign_widevine_with_autograph", new=fake_sign)
+    assert await sign.sign_widevine_zip(context, str(orig), "autograph_widevine") == str(orig)
+    assert sorted(extract.call_args.kwargs["files"]) == ["firefox/firefox", "firefox/precomplete"]
+    with zipfile.ZipFile(orig) as z:
+        assert z.read("firefox/firefox.sig") == b"sig"
+        assert z.read("firefox/browser/omni.ja") == b"omni data"
+        precomplete = z.read("firefox/precomplete")
+    assert b'remove "firefox.sig"\n' in precomplete
+    with open(os.path.join(context.config["artifact_dir"], "public/logs/precomplete.diff")) as fh:
+        assert '- remove "old"\n' in fh.read()
+
+
+@pytest.mark.parametrize("names", ([], ["a/precomplete", "b/precomplete"]))
+def test_get_tar_precomplete_errors(names):
+    with pytest.raises(SigningScriptError):
+        sign._get_tar_precomplete([tarfile.TarInfo(n) for n in names])
+
+
 def test_signreq_task_keyid():
     fmt = "autograph_hash_only_mar384"
     req = sign.make_signing_req(None, fmt, "hash", keyid="newkeyid")
@@ -841,6 +1220,29 @@ async def test_widevine_autograph(context, mocker, tmp_path, blessed):
     assert called_format == "autograph_widevine"
 
 
+@pytest.mark.asyncio
+async def test_widevine_autograph_process_pool(context, mocker, tmp_path):
+    hashed_in = []
+
+    def fake_hash(from_, flags):
+        hashed_in.append(threading.get_ident())
+        return b"hashhashash"
+
+    wv = mocker.patch("signingscript.sign.widevine")
+    wv.generate_widevine_hash = fake_hash
+    wv.generate_widevine_signature.return_value = b"sigwidevinesig"
+    mocker.patch("signingscript.sign.sign_hash_with_autograph", new=noop_async)
+    cert = tmp_path / "widevine.crt"
+    cert.write_bytes(b"TMPCERT")
+    context.config["widevine_cert"] = cert
+
+    # The hashing has to be picklable for a real process pool, which mocks
+    # aren't, so use a thread pool to check it's offloaded
+    with concurrent.futures.ThreadPoolExecutor(1) as context.process_pool:
+        await sign.sign_widevine_with_autograph(context, "from", True, "autograph_widevine", to=tmp_path / "signed.sig")
+    assert hashed_in and hashed_in[0] != threading.get_ident()
+
+
 @pytest.mark.asyncio
 async def test_no_widevine(context, mocker, tmp_path):
     async def fake_sign_hash(*args, **kwargs):
@@ -922,8 +1324,8 @@ async def test_sign_omnija(context, mocker, filename, raises, nofiles):
     mocker.patch.object(sign, "_extract_zipfile", new=fake_unzip)
     mocker.patch.object(sign, "_convert_dmg_to_tar_gz", new=fake_undmg)
     mocker.patch.object(sign, "sign_omnija_with_autograph", new=noop_async)
-    mocker.patch.object(sign, "_create_tarfile", new=noop_async)
-    mocker.patch.object(sign, "_create_zipfile", new=noop_async)
+    mocker.patch.object(sign, "_rewrite_tarfile", new=noop_async)
+    mocker.patch.object(sign, "_rewrite_zipfile", new=noop_async)
     mocker.patch.object(os.path, "isfile", new=fake_isfile)
 
     if raises:
@@ -987,6 +1389,62 @@ async def test_omnija_sign(tmpdir, mocker, context, orig, signed, sha256_expecte
     assert sha256_actual == sha256_expected
 
 
+@pytest.mark.parametrize("preloads", ([], ["b", "a"]))
+def test_streaming_jar_writer(tmp_path, preloads):
+    members = [("b", b"b" * 1000), ("a", b"a"), ("c/d", b"d" * 100)]
+    expected = tmp_path / "expected.ja"
+    with mozjar.JarWriter(str(expected)) as writer:
+        for name, data in members:
+            writer.add(name, data)
+        writer.preload(preloads)
+    actual = tmp_path / "actual.ja"
+    ordered = sorted(members, key=lambda m: preloads.index(m[0]) if m[0] in preloads else len(preloads))
+    with sign._StreamingJarWriter(str(actual), [m[0] for m in ordered], preloads=preloads) as writer:
+        for name, data in ordered:
+            writer.add(name, data)
+    assert actual.read_bytes() == expected.read_bytes()
+    reader = mozjar.JarReader(str(actual))
+    assert reader.last_preloaded == (preloads[-1] if preloads else None)
+    assert [(f.filename, f.read()) for f in reader] == ordered
+
+
+def test_streaming_jar_writer_errors(tmp_path):
+    with pytest.raises(mozjar.JarWriterError, match="in order"):
+        with sign._StreamingJarWriter(str(tmp_path / "out.ja"), ["a", "b"], preloads=["a"]) as writer:
+            writer.add("b", b"b")
+    with pytest.raises(mozjar.JarWriterError, match="already in"):
+        with sign._StreamingJarWriter(str(tmp_path / "out.ja"), ["a"]) as writer:
+            writer.add("a", b"a")
+            writer.add("a", b"a")
+    with pytest.raises(mozjar.JarWriterError, match="don't match"):
+        with sign._StreamingJarWriter(str(tmp_path / "out.ja"), ["a", "b"], preloads=["a"]) as writer:
+            writer.add("a", b"a")
+    with pytest.raises(mozjar.JarWriterError, match="before adding"):
+        with sign._StreamingJarWriter(str(tmp_path / "out.ja"), ["a", "b"]) as writer:
+            writer.add("a", b"a")
+            writer.preload(["b"])
+
+
+def test_streaming_jar_writer_preload(tmp_path):
+    expected = tmp_path / "expected.ja"
+    with sign._StreamingJarWriter(str(expected), ["b", "a"], preloads=["b"]) as writer:
+        writer.add("b", b"b")
+        writer.add("a", b"a")
+    actual = tmp_path / "actual.ja"
+    with sign._StreamingJarWriter(str(actual), ["b", "a"]) as writer:
+        writer.preload(["b"])
+        writer.add("b", b"b")
+        writer.add("a", b"a")
+    assert actual.read_bytes() == expected.read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_merge_omnija_files_error(tmp_path):
+    # The original error comes through, not a failure to unmap the original
+    with pytest.raises(FileNotFoundError):
+        await sign.merge_omnija_files(os.path.join(TEST_DATA_DIR, "preload_unsigned_omni.ja"), str(tmp_path / "missing.ja"), str(tmp_path / "out.ja"))
+
+
 def test_langpack_id_regex():
     assert sign.LANGPACK_RE.match("langpack-en-CA@firefox.mozilla.org") is not None
     assert sign.LANGPACK_RE.match("langpack-ja-JP-mac@devedition.mozilla.org") is not None
@@ -1264,7 +1722,7 @@ async def test_sign_gpg_temporary_error(tmpdir, mocker, context, caplog):
     }
     mocked_session = MockedSession(signature="GPG SIGNATURE HERE")
     mocked_session.count = 0
-    real_post = mocked_session.post
+    real_post = mocked_session._post
 
     async def flaky_post(self, *args, **kwargs):
         self.count += 1
@@ -1272,8 +1730,7 @@ async def test_sign_gpg_temporary_error(tmpdir, mocker, context, caplog):
             raise Exception("BAD!")
         return await real_post(*args, **kwargs)
 
-    mocked_session.post = flaky_post.__get__(mocked_session, MockedSession)
-    mocked_session.post = mock.MagicMock(wraps=mocked_session.post)
+    mocked_session._post = flaky_post.__get__(mocked_session, MockedSession)
 
     mocker.patch.object(context, "session", new=mocked_session)
     mocker.patch.object(sign, "verify_gpg")
@@ -1323,6 +1780,47 @@ async def test_authenticode_sign_single_file(tmpdir, mocker, context):
     assert os.path.exists(result)
 
 
+def test_is_authenticode_signed(tmp_path, mocker):
+    make_pe(tmp_path / "signed.dll", certificate=b"pkcs7")
+    make_pe(tmp_path / "unsigned.exe")
+    (tmp_path / "setup.msi").write_bytes(b"not a PE file")
+    is_signed = mocker.patch.object(winsign.osslsigncode, "is_signed", return_value=True)
+
+    # osslsigncode is only needed for files that aren't PE files
+    assert sign._is_authenticode_signed(str(tmp_path / "signed.dll"))
+    assert not sign._is_authenticode_signed(str(tmp_path / "unsigned.exe"))
+    is_signed.assert_not_called()
+    assert sign._is_authenticode_signed(str(tmp_path / "setup.msi"))
+    is_signed.assert_called_once_with(str(tmp_path / "setup.msi"))
+
+
+@pytest.mark.asyncio
+async def test_authenticode_sign_file_skips_signed_files(tmp_path, mocker, context):
+    context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_ca"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_ca_timestamp"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_url"] = "https://example.com"
+    context.config["authenticode_timestamp_style"] = None
+    context.config["authenticode_timestamp_url"] = None
+    test_file = tmp_path / "helper.exe"
+    make_pe(test_file)
+    calls = []
+
+    async def mocked_winsign(infile, outfile, digest_algo, certs, signer, cafile, **kwargs):
+        calls.append(infile)
+        make_pe(outfile, certificate=b"pkcs7")
+        return True
+
+    mocker.patch.object(sign, "retry_async", new=fake_retry_async)
+    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+
+    assert await sign.sign_authenticode_file(context, str(test_file), "autograph_authenticode_sha2")
+    assert winsign.pefile.is_signed(str(test_file))
+    # Already signed files are left alone
+    assert await sign.sign_authenticode_file(context, str(test_file), "autograph_authenticode_sha2")
+    assert calls == [str(test_file)]
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("keyid", ("202404", "foo"))
 async def test_authenticode_sign_keyids(tmpdir, mocker, context, keyid):
@@ -1417,13 +1915,17 @@ class MockedFilesSession:
     def __init__(self, signed_files):
         self.signed_files = signed_files
 
-    async def post(self, *args, **kwargs):
+    def post(self, *args, **kwargs):
+        return MockedRequestContext(self._post(*args, **kwargs))
+
+    async def _post(self, *args, **kwargs):
         resp = mock.MagicMock()
         resp.status = 200
         resp.ok = True
         future = asyncio.Future()
         future.set_result([{"signed_files": self.signed_files}])
         resp.json.return_value = future
+        resp.content = MockedStreamReader(json.dumps([{"signed_files": self.signed_files}]).encode())
         return resp
 
 
@@ -1456,6 +1958,135 @@ async def test_sign_rpm_pkg_wrong_extension(context):
         await sign.sign_rpm_pkg(context, "/path/to/file.txt", "autograph_rpmsign")
 
 
+@pytest.mark.parametrize(
+    "sizes,max_bytes,expected",
+    (
+        ([], 10, []),
+        ([4, 4, 4], 8, [[0, 1], [2]]),
+        ([4, 20, 4], 8, [[0], [1], [2]]),
+        ([1, 2, 3], 100, [[0, 1, 2]]),
+    ),
+)
+def test_chunk_paths_by_size(tmp_path, sizes, max_bytes, expected):
+    paths = []
+    for i, size in enumerate(sizes):
+        path = tmp_path / str(i)
+        path.write_bytes(b"x" * size)
+        paths.append(str(path))
+    assert list(sign._chunk_paths_by_size(paths, max_bytes)) == [[paths[i] for i in chunk] for chunk in expected]
+
+
+def _make_batch_files(context, names):
+    paths = []
+    for name in names:
+        path = os.path.join(context.config["work_dir"], name)
+        with open(path, "wb") as fh:
+            fh.write(f"{name} content".encode())
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.asyncio
+async def test_sign_inputs_with_autograph(context):
+    session = MockedBatchSession()
+    server = utils.Autograph("https://autograph", "alice", "secret", ["autograph_gpg"], "defaultkey")
+    signatures = await sign.sign_inputs_with_autograph(session, server, [BytesIO(b"one"), BytesIO(b"two")], "autograph_gpg", "data")
+    assert [base64.b64decode(s) for s in signatures] == [b"sig-one", b"sig-two"]
+    [(url, reqs)] = session.requests
+    assert url == "https://autograph/sign/data"
+    assert [r["keyid"] for r in reqs] == ["defaultkey", "defaultkey"]
+
+
+@pytest.mark.asyncio
+async def test_sign_inputs_with_autograph_errors(context, mocker):
+    server = utils.Autograph("https://autograph", "alice", "secret", ["autograph_gpg"])
+    with pytest.raises(SigningScriptError, match="Unsupported autograph method"):
+        await sign.sign_inputs_with_autograph(MockedBatchSession(), server, [BytesIO(b"one")], "autograph_gpg", "files")
+    mocker.patch.object(sign, "retry_async", return_value=[{"signature": "sig"}])
+    with pytest.raises(SigningScriptError, match="Expected 2 signatures"):
+        await sign.sign_inputs_with_autograph(MockedBatchSession(), server, [BytesIO(b"one"), BytesIO(b"two")], "autograph_gpg", "data")
+
+
+@pytest.mark.asyncio
+async def test_sign_gpg_files_with_autograph(context, mocker):
+    context.autograph_configs = {TEST_CERT_TYPE: [utils.Autograph("https://autograph", "alice", "secret", ["autograph_gpg"])]}
+    context.config["autograph_files_batch_max_bytes"] = 20
+    paths = _make_batch_files(context, ("a", "b", "c"))
+    requests = []
+    verified = []
+
+    async def fake_sign_inputs(session, server, inputs, fmt, autograph_method, **kwargs):
+        assert autograph_method == "data"
+        requests.append([f.name for f in inputs])
+        return [f"sig of {f.read().decode()}" for f in inputs]
+
+    running = []
+    max_running = []
+
+    async def fake_verify(context, from_, signature):
+        running.append(from_)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(from_)
+        verified.append(from_)
+
+    mocker.patch.object(sign, "sign_inputs_with_autograph", new=fake_sign_inputs)
+    mocker.patch.object(sign, "verify_gpg", new=fake_verify)
+    mocker.patch.object(sign.os, "cpu_count", return_value=2)
+    result = await sign.sign_gpg_files_with_autograph(context, paths, "autograph_gpg")
+
+    assert result == [paths[0], f"{paths[0]}.asc", paths[1], f"{paths[1]}.asc", paths[2], f"{paths[2]}.asc"]
+    # Each file is 9 bytes, so two fit in the budget
+    assert requests == [paths[:2], paths[2:]]
+    assert sorted(verified) == paths
+    # Only one gpgv per cpu runs at a time
+    assert max(max_running) == 2
+    with open(f"{paths[1]}.asc") as fh:
+        assert fh.read() == "sig of b content"
+
+
+@pytest.mark.asyncio
+async def test_sign_rpm_pkgs(context, mocker):
+    context.autograph_configs = {TEST_CERT_TYPE: [utils.Autograph("https://autograph", "alice", "secret", ["autograph_rpmsign"])]}
+    context.config["autograph_files_batch_max_bytes"] = 30
+    paths = _make_batch_files(context, ("a.rpm", "b.rpm", "c.rpm"))
+    requests = []
+
+    async def fake_sign(session, server, files, fmt, autograph_method, tmp_dir=None, **kwargs):
+        assert autograph_method == "files"
+        requests.append([f.name for f in files])
+        signed_files = []
+        for f in files:
+            fd, path = tempfile.mkstemp(dir=tmp_dir)
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(b"signed " + f.read())
+            signed_files.append({"name": os.path.basename(f.name), "content": path})
+        return signed_files
+
+    mocker.patch.object(sign, "sign_with_autograph", new=fake_sign)
+    assert await sign.sign_rpm_pkgs(context, paths, "autograph_rpmsign") == paths
+    assert requests == [paths[:2], paths[2:]]
+    for path in paths:
+        with open(path, "rb") as fh:
+            assert fh.read() == f"signed {os.path.basename(path)} content".encode()
+
+
+@pytest.mark.asyncio
+async def test_sign_rpm_pkgs_errors(context, mocker):
+    context.autograph_configs = {TEST_CERT_TYPE: [utils.Autograph("https://autograph", "alice", "secret", ["autograph_rpmsign"])]}
+    context.config["autograph_files_batch_max_bytes"] = 100
+    with pytest.raises(SigningScriptError, match="Expected a .rpm file"):
+        await sign.sign_rpm_pkgs(context, ["a.rpm", "b.txt"], "autograph_rpmsign")
+    paths = _make_batch_files(context, ("a.rpm", "b.rpm"))
+    signed = os.path.join(context.config["work_dir"], "signed")
+    with open(signed, "wb") as fh:
+        fh.write(b"signed")
+    mocker.patch.object(sign, "sign_with_autograph", return_value=[{"name": "a.rpm", "content": signed}])
+    with pytest.raises(SigningScriptError, match="Expected 2 signed files"):
+        await sign.sign_rpm_pkgs(context, paths, "autograph_rpmsign")
+    assert not os.path.exists(signed)
+
+
 def test_encode_multiple_files():
     output_file = tempfile.TemporaryFile("w+b")
     input_files = [
@@ -1463,7 +2094,7 @@ def test_encode_multiple_files():
         {"name": "file2.rpm", "content": BufferedRandom(BytesIO(b"content2"))},
     ]
     signing_req = {"keyid": "testkey", "files": input_files}
-    sign._encode_multiple_files(output_file, signing_req)
+    sign.write_signing_req_to_disk(output_file, signing_req)
     output_file.seek(0)
     result = json.loads(output_file.read().decode())
     expected = [
@@ -1486,3 +2117,205 @@ async def test_verify_gpg(context):
     from_ = os.path.join(TEST_DATA_DIR, "SHA256SUMS")
     to = os.path.join(TEST_DATA_DIR, "SHA256SUMS.asc")
     await sign.verify_gpg(context, from_, to)
+
+
+# _read_streamed_response {{{1
+@pytest.mark.asyncio
+async def test_read_streamed_response(tmp_path):
+    resp = mock.MagicMock()
+    resp.content = MockedStreamReader(json.dumps([{"signed_file": "YWJj"}]).encode())
+    result = await sign._read_streamed_response(resp, {"signed_file"}, str(tmp_path))
+    assert pathlib.Path(result[0]["signed_file"]).read_bytes() == b"abc"
+
+
+@pytest.mark.asyncio
+async def test_read_streamed_response_errors(tmp_path):
+    resp = mock.MagicMock()
+    resp.content = MockedStreamReader(b'[{"signed_file": "YWJj')
+    with pytest.raises(SigningScriptError, match="Truncated"):
+        await sign._read_streamed_response(resp, {"signed_file"}, str(tmp_path))
+    assert list(tmp_path.iterdir()) == []
+
+
+# request encoding {{{1
+def test_write_signing_req_to_disk_hash(tmp_path):
+    path = tmp_path / "input"
+    path.write_bytes(os.urandom(100000))
+    with open(path, "rb") as f:
+        signing_req = [{"input": f, "keyid": "a"}, {"input": BytesIO(b"hash"), "options": {"x": 1}}]
+        output_file = tempfile.TemporaryFile("w+b")
+        content_hash = sign.write_signing_req_to_disk(output_file, signing_req)
+        output_file.seek(0)
+        assert content_hash == calculate_payload_hash(output_file, "sha256", "application/json").decode()
+        output_file.seek(0)
+        expected = [{"input": base64.b64encode(path.read_bytes()).decode(), "keyid": "a"}, {"input": "aGFzaA==", "options": {"x": 1}}]
+        assert json.load(output_file) == expected
+
+
+def test_signing_request_body(tmp_path):
+    path = tmp_path / "input"
+    for size in (0, 1, 2, 3, 1000001):
+        path.write_bytes(os.urandom(size))
+        with open(path, "rb") as f:
+            signing_req = {"files": [{"name": "dir/foo.rpm", "content": f}], "keyid": "a"}
+            body = sign.SigningRequestBody.from_signing_req(signing_req)
+            encoded = b"".join(sign.iter_signing_req(signing_req))
+            assert body.size == len(encoded)
+            assert body.content_hash("application/json") == calculate_payload_hash(encoded, "sha256", "application/json").decode()
+            assert json.loads(encoded) == [{"files": [{"name": "foo.rpm", "content": base64.b64encode(path.read_bytes()).decode()}], "keyid": "a"}]
+
+    assert sign.SigningRequestBody.from_signing_req({"input": BytesIO(b"not a real file")}) is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("spool_max_size", (0, 1024 * 1024))
+async def test_call_autograph_request_body(tmp_path, mocker, spool_max_size):
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    mocker.patch.object(sign, "_SPOOL_MAX_SIZE", spool_max_size)
+    received = []
+
+    async def handler(request):
+        body = await request.read()
+        received.append((request.headers, body))
+        return web.json_response([{"signature": "c2ln"}])
+
+    app = web.Application()
+    app.router.add_post("/sign/hash", handler)
+    path = tmp_path / "input"
+    path.write_bytes(os.urandom(5000))
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        url = str(server.make_url("/sign/hash"))
+        for _ in range(2):
+            with open(path, "rb") as f:
+                resp = await sign.call_autograph(session, url, "user", "password", {"input": f})
+            assert resp == [{"signature": "c2ln"}]
+
+    for headers, body in received:
+        assert int(headers["Content-Length"]) == len(body)
+        assert json.loads(body) == [{"input": base64.b64encode(path.read_bytes()).decode()}]
+        content_hash = calculate_payload_hash(body, "sha256", "application/json").decode()
+        assert f'hash="{content_hash}"' in headers["Authorization"]
+
+
+@pytest.mark.asyncio
+async def test_call_autograph_limiter_and_metrics():
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from signingscript.concurrency import AutographConcurrencyLimiter
+    from signingscript.metrics import SigningMetrics
+
+    statuses = [503, 200]
+
+    async def handler(request):
+        await request.read()
+        return web.json_response([{"signature": "c2ln"}], status=statuses.pop(0))
+
+    app = web.Application()
+    app.router.add_post("/sign/hash", handler)
+    limiter = AutographConcurrencyLimiter(4, 8)
+    signing_metrics = SigningMetrics()
+    signing_metrics.activate()
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        url = str(server.make_url("/sign/hash"))
+        with pytest.raises(aiohttp.ClientResponseError):
+            await sign.call_autograph(session, url, "user", "password", [{"input": "aGFzaA=="}], limiter=limiter)
+        window = limiter._get_server(url)
+        assert (window.window, window.in_flight) == (2, 0)
+        resp = await sign.call_autograph(session, url, "user", "password", [{"input": "aGFzaA=="}], limiter=limiter)
+        assert resp == [{"signature": "c2ln"}]
+        assert (window.window, window.in_flight) == (2.5, 0)
+        assert list(window.latency) == ["/sign/hash"]
+    assert signing_metrics.totals["autograph_requests"] == 2
+    assert signing_metrics.totals["autograph_bytes_sent"] > 0
+    assert signing_metrics.totals["autograph_bytes_received"] == len(b'[{"signature": "c2ln"}]')
+
+
+# signing cache {{{1
+@pytest.mark.asyncio
+async def test_sign_with_signing_cache(context, mocker, tmp_path):
+    from signingscript.cache import SigningCache
+
+    context.signing_cache = SigningCache(str(tmp_path / "cache"), 1024 * 1024)
+    context.autograph_configs = {
+        TEST_CERT_TYPE: [utils.Autograph("https://autograph-hsm.dev.mozaws.net", "alice", "secret", ["autograph_rsa", "autograph_mar", "autograph_gpg"])]
+    }
+    mocker.patch.object(sign, "verify_gpg", new=noop_async)
+    src = tmp_path / "file"
+    src.write_bytes(b"data")
+
+    for _ in range(2):
+        mocked_session = MockedSession(signature=base64.b64encode(b"sig").decode())
+        mocker.patch.object(context, "session", new=mocked_session)
+        assert await sign.sign_hash_with_autograph(context, b"hash", "autograph_rsa") == b"sig"
+
+        mocked_session = MockedSession(signature="--- GPG SIG ---")
+        mocker.patch.object(context, "session", new=mocked_session)
+        await sign.sign_gpg_with_autograph(context, str(src), "autograph_gpg")
+        assert (tmp_path / "file.asc").read_text() == "--- GPG SIG ---"
+
+        mocked_session = MockedSession(signed_file=base64.b64encode(b"signed").decode())
+        mocker.patch.object(context, "session", new=mocked_session)
+        await sign.sign_file_with_autograph(context, str(src), "autograph_mar", to=str(tmp_path / "signed"))
+        assert (tmp_path / "signed").read_bytes() == b"signed"
+
+    # The second round was served from the cache
+    mocked_session.post.assert_not_called()
+    assert context.signing_cache.hits == 3
+    assert context.signing_cache.misses == 3
+
+
+# AutographHashBatcher {{{1
+class MockedBatchSession:
+    def __init__(self, exception=None):
+        self.exception = exception
+        self.requests = []
+
+    def post(self, *args, **kwargs):
+        return MockedRequestContext(self._post(*args, **kwargs))
+
+    async def _post(self, url, data=None, headers=None):
+        reqs = json.loads(data.read())
+        self.requests.append((url, reqs))
+        if self.exception:
+            raise self.exception
+        resp = mock.MagicMock()
+        resp.ok = True
+        future = asyncio.Future()
+        future.set_result([{"signature": base64.b64encode(b"sig-" + base64.b64decode(r["input"])).decode()} for r in reqs])
+        resp.json.return_value = future
+        return resp
+
+
+@pytest.mark.asyncio
+async def test_autograph_hash_batcher(context):
+    session = MockedBatchSession()
+    batcher = sign.AutographHashBatcher(session, 0.01, 3)
+    server = utils.Autograph("https://autograph", "alice", "secret", ["autograph_authenticode_sha2"], "defaultkey")
+    other_server = utils.Autograph("https://other", "alice", "secret", ["autograph_authenticode_sha2"])
+    results = await asyncio.gather(
+        *(batcher.sign_hash(server, f"hash{i}".encode(), "autograph_authenticode_sha2") for i in range(4)),
+        batcher.sign_hash(server, b"keyhash", "autograph_authenticode_sha2", "otherkey"),
+        batcher.sign_hash(other_server, b"otherhash", "autograph_authenticode_sha2"),
+    )
+    assert results == [b"sig-hash0", b"sig-hash1", b"sig-hash2", b"sig-hash3", b"sig-keyhash", b"sig-otherhash"]
+    # 4 hashes split by max_batch_size, plus one request per (server, fmt, keyid)
+    assert sorted((url, [r["input"] for r in reqs], {r.get("keyid") for r in reqs}) for url, reqs in session.requests) == sorted([
+        ("https://autograph/sign/hash", [base64.b64encode(b"hash3").decode()], {"defaultkey"}),
+        ("https://autograph/sign/hash", [base64.b64encode(b"keyhash").decode()], {"otherkey"}),
+        ("https://autograph/sign/hash", [base64.b64encode(f"hash{i}".encode()).decode() for i in range(3)], {"defaultkey"}),
+        ("https://other/sign/hash", [base64.b64encode(b"otherhash").decode()], {None}),
+    ])
+
+
+@pytest.mark.asyncio
+async def test_autograph_hash_batcher_error(context, mocker):
+    mocker.patch.object(sign, "retry_async", new=fake_retry_async)
+    session = MockedBatchSession(exception=aiohttp.ClientError("BAD!"))
+    context.hash_batcher = sign.AutographHashBatcher(session, 0.01, 10)
+    context.autograph_configs = {TEST_CERT_TYPE: [utils.Autograph("https://autograph", "alice", "secret", ["autograph_rsa"])]}
+    results = await asyncio.gather(*(sign.sign_hash_with_autograph(context, b"hash", "autograph_rsa") for _ in range(2)), return_exceptions=True)
+    assert all(isinstance(r, aiohttp.ClientError) for r in results)
+    assert len(session.requests) == 1
@@ -1,3 +1,4 @@
+import asyncio
 import os
 
 import pytest
@@ -140,6 +141,59 @@ async def test_sign(context, mocker, format, filename, post_files):
     await stask.sign(context, filename, [format])
 
 
+@pytest.mark.asyncio
+async def test_sign_metrics(context, mocker):
+    from signingscript.metrics import SigningMetrics
+
+    path = os.path.join(context.config["work_dir"], "public", "target.tar.gz")
+    mkdir(os.path.dirname(path))
+    with open(path, "wb") as fh:
+        fh.write(b"x" * 10)
+
+    async def fake_gpg(_, path, *args, **kwargs):
+        with open(f"{path}.asc", "wb") as fh:
+            fh.write(b"sig")
+        return [path, f"{path}.asc"]
+
+    mocker.patch.object(stask, "FORMAT_TO_SIGNING_FUNCTION", new={"autograph_gpg": fake_gpg})
+    context.signing_metrics = SigningMetrics()
+    context.signing_metrics.activate()
+    await stask.sign(context, path, ["autograph_gpg"])
+    (operation,) = context.signing_metrics.operations
+    assert (operation["path"], operation["format"], operation["size"], operation["signed_size"]) == ("public/target.tar.gz", "autograph_gpg", 10, 13)
+    assert operation["succeeded"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "format,limit,expected_max",
+    (
+        ("autograph_gpg", None, 3),
+        ("autograph_gpg", 2, 2),
+        ("autograph_gpg:keyid", 1, 1),
+        ("apple_notarization", None, 1),
+        ("gcp_prod_apple_notarization_geckodriver", 3, 1),
+    ),
+)
+async def test_sign_per_format_limit(context, mocker, format, limit, expected_max):
+    in_flight = 0
+    max_in_flight = 0
+
+    async def fake_signer(_, path, *args, **kwargs):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return path
+
+    mocker.patch.object(stask, "_get_signing_function_from_format", return_value=fake_signer)
+    context.config["max_concurrent_artifacts_per_format"] = limit
+    context.signing_format_semaphores = {}
+    await asyncio.gather(*(stask.sign(context, f"file{i}", [format]) for i in range(3)))
+    assert max_in_flight == expected_max
+
+
 @pytest.mark.parametrize(
     "format, expected",
     (
@@ -193,6 +247,46 @@ def test_get_signing_function_from_format(format, expected):
     assert stask._get_signing_function_from_format(format) == expected
 
 
+@pytest.mark.parametrize(
+    "format,expected",
+    (
+        ("autograph_gpg", stask.sign_gpg_files_with_autograph),
+        ("stage_autograph_gpg", stask.sign_gpg_files_with_autograph),
+        ("gcp_prod_autograph_rpmsign", stask.sign_rpm_pkgs),
+        ("autograph_rpmsign:202404", stask.sign_rpm_pkgs),
+        ("autograph_mar", None),
+    ),
+)
+def test_get_batch_signing_function(format, expected):
+    assert stask.get_batch_signing_function(format) == expected
+
+
+@pytest.mark.asyncio
+async def test_sign_batch(context, mocker):
+    from signingscript.metrics import SigningMetrics
+
+    paths = []
+    for name in ("a", "b"):
+        path = os.path.join(context.config["work_dir"], name)
+        with open(path, "wb") as fh:
+            fh.write(b"1234")
+        paths.append(path)
+
+    async def fake_sign(context, paths, fmt):
+        for path in paths:
+            with open(f"{path}.asc", "w") as fh:
+                fh.write("sig")
+        return [p for path in paths for p in (path, f"{path}.asc")]
+
+    mocker.patch.object(stask, "FORMAT_TO_BATCH_SIGNING_FUNCTION", new={"autograph_gpg": fake_sign})
+    context.signing_metrics = SigningMetrics()
+    context.signing_metrics.activate()
+    assert await stask.sign_batch(context, paths, "autograph_gpg") == [paths[0], f"{paths[0]}.asc", paths[1], f"{paths[1]}.asc"]
+    (operation,) = context.signing_metrics.operations
+    assert (operation["path"], operation["format"], operation["size"], operation["signed_size"]) == ("2 files", "autograph_gpg", 8, 14)
+    assert operation["succeeded"]
+
+
 # build_filelist_dict {{{1
 def test_build_filelist_dict(context, task_defn):
     full_path = os.path.join(context.config["work_dir"], "cot", "VALID_TASK_ID", "public/build/firefox-52.0a1.en-US.win64.installer.exe")
@@ -1,3 +1,4 @@
+import concurrent.futures
 import json
 import os
 
@@ -39,6 +40,12 @@ def test_mkdir_mutes_os_errors(mocker):
 
 
 # get_hash {{{1
+def test_get_default_file_mode(tmp_path):
+    path = tmp_path / "new"
+    path.touch()
+    assert utils.get_default_file_mode() == path.stat().st_mode & 0o777
+
+
 def test_get_hash():
     assert utils.get_hash(PUB_KEY_PATH, hash_type="sha512") == ID_RSA_PUB_HASH
 
@@ -121,6 +128,65 @@ def test_copy_to_dir_no_copy():
     assert utils.copy_to_dir(SERVER_CONFIG_PATH, os.path.dirname(SERVER_CONFIG_PATH)) is None
 
 
+@pytest.mark.parametrize("hardlink", (True, False))
+def test_copy_to_dir_hardlink(tmp_path, hardlink):
+    source = tmp_path / "source"
+    source.write_bytes(b"signed")
+    newpath = utils.copy_to_dir(str(source), str(tmp_path / "artifacts"), target="public/build/target", hardlink=hardlink)
+    assert read_file(newpath) == "signed"
+    assert os.path.samefile(source, newpath) == hardlink
+    assert [p.name for p in (tmp_path / "artifacts/public/build").iterdir()] == ["target"]
+
+
+@pytest.mark.parametrize("failing", ((), ("ioctl",), ("ioctl", "copy_file_range"), ("ioctl", "copy_file_range", "link")))
+def test_copy_to_dir_fallbacks(tmp_path, mocker, failing):
+    def fail(*args, **kwargs):
+        raise OSError("not supported")
+
+    def fail_after_one_block(src, dst, count):
+        os.write(dst, os.pread(src, 1, 0))
+        os.lseek(src, 1, os.SEEK_SET)
+        fail()
+
+    if "ioctl" in failing:
+        mocker.patch.object(utils.fcntl, "ioctl", new=fail)
+    if "copy_file_range" in failing:
+        mocker.patch.object(utils.os, "copy_file_range", new=fail_after_one_block, create=True)
+    if "link" in failing:
+        mocker.patch.object(utils.os, "link", new=fail)
+    source = tmp_path / "source"
+    source.write_bytes(os.urandom(100000))
+    source.chmod(0o600)
+    newpath = utils.copy_to_dir(str(source), str(tmp_path / "artifacts"), hardlink="link" in failing)
+    with open(newpath, "rb") as fh:
+        assert fh.read() == source.read_bytes()
+    assert not os.path.samefile(source, newpath)
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(newpath).st_mode & 0o777 == 0o666 & ~umask
+
+
+def test_copy_to_dir_replaces_hardlinked_target(tmp_path):
+    # Copying over a target must not change other hardlinks to it
+    first = tmp_path / "first"
+    first.write_bytes(b"first")
+    target = utils.copy_to_dir(str(first), str(tmp_path / "artifacts"), hardlink=True)
+    second = tmp_path / "second"
+    second.write_bytes(b"second")
+    assert utils.copy_to_dir(str(second), str(tmp_path / "artifacts"), target="first") == target
+    assert read_file(target) == "second"
+    assert first.read_bytes() == b"first"
+
+
+def test_copy_to_dir_cleans_up(tmp_path, mocker):
+    mocker.patch.object(utils, "_clone_file", side_effect=OSError("disk full"))
+    source = tmp_path / "source"
+    source.write_bytes(b"data")
+    with pytest.raises(SigningServerError):
+        utils.copy_to_dir(str(source), str(tmp_path / "artifacts"))
+    assert list((tmp_path / "artifacts").iterdir()) == []
+
+
 # execute_subprocess {{{1
 @pytest.mark.asyncio
 @pytest.mark.parametrize("exit_code", (1, 0))
@@ -133,6 +199,21 @@ async def test_execute_subprocess(exit_code):
         await utils.execute_subprocess(command, cwd="/tmp")
 
 
+# run_in_process_pool {{{1
+@pytest.mark.asyncio
+async def test_run_in_process_pool_inline():
+    context = Context()
+    assert await utils.run_in_process_pool(context, max, 1, 3) == 3
+
+
+@pytest.mark.asyncio
+async def test_run_in_process_pool():
+    context = Context()
+    with concurrent.futures.ProcessPoolExecutor(1) as context.process_pool:
+        assert await utils.run_in_process_pool(context, max, 1, 3) == 3
+        assert await utils.run_in_process_pool(context, os.getpid) != os.getpid()
+
+
 # is_sha1_apk_autograph_signing_format {{{1
 @pytest.mark.parametrize(
     "format,expected", (("autograph_apk_sha1", True), ("autograph_apk_not_sha1_but_sha384", False), ("foobar_sha1", False), ("foobar_sha384", False))
@@ -0,0 +1,125 @@
+import asyncio
+import os
+
+import pytest
+
+from signingscript import workspace
+
+
+def test_get_disk_usage(tmp_path):
+    assert workspace.get_disk_usage(tmp_path) == 0
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "file").write_bytes(os.urandom(100000))
+    assert workspace.get_disk_usage(tmp_path) >= 100000
+    assert workspace.get_disk_usage(tmp_path / "missing") == 0
+
+
+def test_mkdtemp_no_manager(tmp_path):
+    path = workspace.mkdtemp("zip", tmp_path)
+    assert os.path.isdir(path)
+    assert os.path.basename(path).startswith("zip")
+
+
+@pytest.mark.asyncio
+async def test_reclaim(tmp_path):
+    manager = workspace.WorkspaceManager(str(tmp_path))
+    manager.activate()
+    untracked = workspace.mkdtemp("untracked", tmp_path)
+
+    async def extract(prefix):
+        path = workspace.mkdtemp(prefix, tmp_path)
+        with open(os.path.join(path, "file"), "wb") as fh:
+            fh.write(b"x" * 10000)
+        return path
+
+    async with workspace.artifact("a.zip"):
+        # Tasks started while signing an artifact inherit it
+        paths = await asyncio.gather(extract("one"), extract("two"))
+        assert all(os.path.isdir(p) for p in paths)
+        async with workspace.artifact("b.zip"):
+            other = await extract("three")
+        assert not os.path.exists(other)
+        assert all(os.path.isdir(p) for p in paths)
+    assert not any(os.path.exists(p) for p in paths)
+    assert os.path.isdir(untracked)
+    assert manager.reclaimed >= 30000
+    assert manager.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_reclaim_on_failure(tmp_path):
+    workspace.WorkspaceManager(str(tmp_path)).activate()
+    with pytest.raises(ValueError):
+        async with workspace.artifact("a.zip"):
+            path = workspace.mkdtemp("zip", tmp_path)
+            raise ValueError("failed")
+    assert not os.path.exists(path)
+
+
+@pytest.mark.asyncio
+async def test_disk_budget(tmp_path):
+    manager = workspace.WorkspaceManager(str(tmp_path), disk_budget=50000)
+    manager.activate()
+    events = []
+    big_file_written = asyncio.Event()
+
+    async def sign(name, size):
+        async with workspace.artifact(name):
+            events.append(f"start {name}")
+            path = workspace.mkdtemp(name, tmp_path)
+            with open(os.path.join(path, "file"), "wb") as fh:
+                fh.write(os.urandom(size))
+            big_file_written.set()
+            await asyncio.sleep(0.05)
+            events.append(f"end {name}")
+
+    async def sign_later(name, size):
+        await big_file_written.wait()
+        await sign(name, size)
+
+    # The first artifact is over the budget on its own, but still runs; the
+    # second waits for it to be reclaimed
+    await asyncio.gather(sign("big", 100000), sign_later("small", 1000))
+    assert events == ["start big", "end big", "start small", "end small"]
+    assert manager.throttled == 1
+    assert manager.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_disk_budget_only_counts_scratch_dirs(tmp_path):
+    manager = workspace.WorkspaceManager(str(tmp_path), disk_budget=50000)
+    manager.activate()
+    # Inputs and outputs in work_dir aren't reclaimed, so they don't count
+    (tmp_path / "input.zip").write_bytes(os.urandom(100000))
+    in_flight = []
+
+    async def sign(name):
+        async with workspace.artifact(name):
+            with open(os.path.join(workspace.mkdtemp(name, tmp_path), "file"), "wb") as fh:
+                fh.write(os.urandom(10000))
+            in_flight.append(manager.in_flight)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(sign(f"artifact{i}") for i in range(3)))
+    assert max(in_flight) == 3
+    assert manager.throttled == 0
+    assert manager.scratch_usage == 0
+    assert manager.reclaimed >= 30000
+
+
+@pytest.mark.asyncio
+async def test_no_disk_budget(tmp_path):
+    manager = workspace.WorkspaceManager(str(tmp_path))
+    manager.activate()
+    in_flight = []
+
+    async def sign(name):
+        async with workspace.artifact(name):
+            with open(os.path.join(workspace.mkdtemp(name, tmp_path), "file"), "wb") as fh:
+                fh.write(os.urandom(100000))
+            in_flight.append(manager.in_flight)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(sign(f"artifact{i}") for i in range(3)))
+    assert max(in_flight) == 3
+    assert manager.throttled == 0